@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Timing benchmarks for physio.h5 (not collected by nose)
+
+Run with: python benchmarks/bench_h5.py
+"""
+
+import os, shutil, sys, tempfile, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from physio.h5 import combine, events
+from physio.h5.tests.test_combine import make_channel_files
+from physio.h5.tests.test_events import make_events_file
+
+def bench_add_events_file(nevents = 1000000):
+    np.random.seed(3)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        make_events_file(eventsFilename, nevents)
+        
+        tic = time.time()
+        events.add_events_file(eventsFilename, os.path.join(tmp, 'data.h5'))
+        fast_time = time.time() - tic
+        
+        tic = time.time()
+        events.add_events_file(eventsFilename, os.path.join(tmp, 'compressed.h5'), complevel = 5)
+        compressed_time = time.time() - tic
+        
+        tic = time.time()
+        events.slow_add_events_file(eventsFilename, os.path.join(tmp, 'slow.h5'))
+        slow_time = time.time() - tic
+        
+        sizes = [os.path.getsize(os.path.join(tmp, n)) / 1048576. for n in \
+                ('data.h5', 'compressed.h5', 'slow.h5')]
+        print("%i events: add_events_file time = %f (%.1f MB), compressed time = %f (%.1f MB), " \
+                "slow time = %f (%.1f MB)" % (nevents, fast_time, sizes[0], compressed_time, \
+                sizes[1], slow_time, sizes[2]))
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_combine(nchannels = 32, nspikes = 20000):
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filenames = make_channel_files(tmp, nchannels, nspikes)
+        outFilename = os.path.join(tmp, 'combined.h5')
+        tic = time.time()
+        combine.combine(filenames, outFilename)
+        fast_time = time.time() - tic
+        tic = time.time()
+        combine.slow_combine(filenames, outFilename)
+        slow_time = time.time() - tic
+        print("%i channels x %i spikes: combine time = %f, slow time = %f" % \
+                (nchannels, nspikes, fast_time, slow_time))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    bench_add_events_file()
+    bench_combine()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Timing benchmarks for physio.dsp.peaks (not collected by nose)
+
+Run with: python benchmarks/bench_peaks.py
+"""
+
+import os, sys, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from physio.dsp import peaks
+
+def bench_refine_crossings():
+    np.random.seed(0)
+    t = np.arange(441000) / 44100.
+    x = np.sin(t * 1000. * 2 * np.pi) * np.sin(t * 0.5 * 2 * np.pi) + \
+            np.random.randn(len(t)) * 0.01
+    gi = peaks.find_both_threshold_crossings(x, 0.03, 2)
+    
+    tic = time.time()
+    rt = peaks.refine_crossings(x, gi)
+    fast_time = time.time() - tic
+    
+    tic = time.time()
+    srt = peaks.slow_refine_crossings(x, gi)
+    slow_time = time.time() - tic
+    
+    print("%i crossings: refine time = %f, slow refine time = %f" % \
+            (len(gi), fast_time, slow_time))
+    
+    assert all(rt == srt)
+
+if __name__ == '__main__':
+    bench_refine_crossings()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Timing benchmarks for physio.clock.pixelclock (not collected by nose)
+
+Run with: python benchmarks/bench_pixelclock.py
+"""
+
+import os, sys, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from physio.clock import pixelclock
+from physio.clock.tests.test_pixelclock import make_codes, make_events
+
+def bench_events_to_codes():
+    np.random.seed(0)
+    events = make_events(100000, noise = 0.001)
+    
+    tic = time.time()
+    codes, _ = pixelclock.events_to_codes(events, 4, 441)
+    fast_time = time.time() - tic
+    
+    tic = time.time()
+    slowCodes, _ = pixelclock.slow_events_to_codes(events, 4, 441)
+    slow_time = time.time() - tic
+    
+    print("%i events: events_to_codes time = %f, slow time = %f" % \
+            (len(events), fast_time, slow_time))
+    
+    assert np.all(codes == np.array(slowCodes))
+
+def bench_match_codes():
+    np.random.seed(0)
+    mwCodes = make_codes(20000)
+    auCodes = list(mwCodes)
+    for e in xrange(200):
+        auCodes.pop(np.random.randint(0, len(auCodes)))
+    mwCodes += make_codes(2000) # mworks codes not seen in audio
+    auTimes = np.arange(len(auCodes))
+    mwTimes = np.arange(len(mwCodes))
+    
+    tic = time.time()
+    matches = pixelclock.match_codes(auTimes, auCodes, mwTimes, mwCodes, 10, 0)
+    fast_time = time.time() - tic
+    
+    tic = time.time()
+    lookupMatches = pixelclock.lookup_match_codes(auTimes, auCodes, mwTimes, mwCodes, 10, 0)
+    lookup_time = time.time() - tic
+    
+    print("%i codes: match_codes time = %f, lookup time = %f" % \
+            (len(mwCodes), fast_time, lookup_time))
+    
+    assert matches == lookupMatches
+
+if __name__ == '__main__':
+    bench_events_to_codes()
+    bench_match_codes()
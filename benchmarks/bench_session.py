@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Timing benchmarks for physio.session (not collected by nose)
+
+Run with: python benchmarks/bench_session.py
+"""
+
+import os, shutil, sys, tempfile, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from physio import session
+from physio.tests.test_session import make_session_file
+
+def bench_spike_times_index(nspikes = 200000, nclusters = 10):
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_session_file(tmp, 1, nspikes)
+        s = session.Session(filename)
+        tic = time.time()
+        for clu in xrange(nclusters):
+            s.get_spike_times(1, clu, (1., 100.))
+        indexTime = time.time() - tic
+        tic = time.time()
+        for clu in xrange(nclusters):
+            s.slow_get_spike_times(1, clu, (1., 100.))
+        slowTime = time.time() - tic
+        s.close()
+        print("%i spikes x %i clusters: index time = %f, slow time = %f" % \
+                (nspikes, nclusters, indexTime, slowTime))
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_spike_waveforms(nspikes = 200000):
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_session_file(tmp, 1, nspikes)
+        s = session.Session(filename)
+        tic = time.time()
+        waves = s.get_spike_waveforms(1, 0)
+        fastTime = time.time() - tic
+        tic = time.time()
+        slow = s.slow_get_spike_waveforms(1, 0)
+        slowTime = time.time() - tic
+        s.close()
+        print("%i spikes: get_spike_waveforms time = %f (%.1f MB), slow time = %f (%.1f MB)" % \
+                (len(waves), fastTime, waves.nbytes / 1024. ** 2, slowTime, slow.nbytes / 1024. ** 2))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    bench_spike_times_index()
+    bench_spike_waveforms()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import analysis
+import catalog
 import cfg
 import channelmapping
 import clock
@@ -19,4 +20,4 @@ import utils
 # Increment this when resulting hdf5 file format is broken
 __version__ = '1.0.4'
 
-__all__ = ['analysis', 'cfg', 'channelmapping', 'clock', 'dsp', 'events', 'h5', 'notebook', 'plotting', 'reports', 'spikes', 'session', 'summary', 'timeseries', 'utils']
+__all__ = ['analysis', 'catalog', 'cfg', 'channelmapping', 'clock', 'dsp', 'events', 'h5', 'notebook', 'plotting', 'reports', 'spikes', 'session', 'summary', 'timeseries', 'utils']
@@ -47,6 +47,15 @@ def analyze(session, customCfgFile = None):
     matches, _ = clock.pixelclock.process_from_config(config) # [:,0] = audio, [:,1] = mworks
     if len(matches) == 0: utils.error("No pixel clock matches found")
     
+    # write session events once and link them from each epoch
+    eventsFilename = config.get('session','dir') + '/' + session + '.h5'
+    shareEvents = config.getboolean('mworks','shareevents')
+    if shareEvents:
+        storeFilename = config.get('mworks','eventsstore')
+        if os.path.abspath(storeFilename) != os.path.abspath(eventsFilename):
+            logging.debug("writing events store: %s" % storeFilename)
+            h5.events.add_events_file(eventsFilename, storeFilename)
+    
     # process each epoch
     for epoch_audio in epochs_audio:
         logging.debug("Processing epoch: %s" % str(epoch_audio))
@@ -71,7 +80,9 @@ def analyze(session, customCfgFile = None):
         logging.debug("collating")
         resultsFilename = config.get('session','output') + '/' + session + '.h5'
         channelFiles = glob.glob(config.get('session','output')+'/*/*.h5')
-        h5.combine.combine(channelFiles, resultsFilename)
+        h5.combine.combine(channelFiles, resultsFilename, \
+                complevel = config.getint('combine','complevel'), \
+                complib = config.get('combine','complib'))
         
         # find cells
         logging.debug("finding cells")
@@ -79,8 +90,10 @@ def analyze(session, customCfgFile = None):
         
         # add events
         logging.debug("adding events")
-        eventsFilename = config.get('session','dir') + '/' + session + '.h5'
-        h5.events.add_events_file(eventsFilename, resultsFilename)
+        if shareEvents:
+            h5.events.link_events_file(storeFilename, resultsFilename)
+        else:
+            h5.events.add_events_file(eventsFilename, resultsFilename)
         #resultsFile.add_session_h5_file(config.get('mworks','file'))
         
         # add pixelclock
@@ -90,6 +103,8 @@ def analyze(session, customCfgFile = None):
         #offsetMatches[:,0] = (offsetMatches[:,0] / float(config.getint('audio','samprate'))) - epoch_audio[0]
         offsetMatches[:,0] = (offsetMatches[:,0] / float(config.getint('audio','samprate')))
         h5.utils.write_array(resultsFilename, offsetMatches, 'TimeMatches', 'PC - MW Time Matches')
+        timebase = clock.timebase.TimeBase(offsetMatches, interpolate = True)
+        h5.utils.write_array(resultsFilename, timebase.segments, 'TimeSegments', 'PC - MW Time Segments')
         
         # add session info
         logging.debug("adding sesison information")
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import re
+
+import tables
+
+import cfg
+import utils
+
+# Increment this when the catalog file format changes
+CATALOG_VERSION = 1
+
+SESSION_REGEX = r'^[a-zA-Z]+\d+_\d+/?$'
+EPOCH_REGEX = r'^\d+_\d+/?$'
+
+# catalogs loaded in this process, keyed by catalog filename
+CATALOGS = {}
+
+
+def get_catalog_filename(config):
+    filename = config.get('filesystem', 'catalog').strip()
+    if filename == '':
+        filename = '/'.join((config.get('filesystem', 'resultsrepo'),
+                'catalog.json'))
+    return filename
+
+
+def get_catalog(config=None):
+    """
+    Load and refresh the catalog of the results repository
+
+    The catalog is refreshed on every call (see Catalog.refresh) so it
+    always reflects the repository on disk.
+
+    Parameters
+    ----------
+    config : cfg.Config
+        Configuration with filesystem.resultsrepo (default = user config)
+
+    Returns
+    -------
+    catalog : Catalog
+        Up to date catalog
+    """
+    if config is None:
+        config = cfg.Config()
+        config.read_user_config()
+    filename = get_catalog_filename(config)
+    catalog = CATALOGS.get(filename, None)
+    if catalog is None:
+        catalog = Catalog(config.get('filesystem', 'resultsrepo'), filename)
+        CATALOGS[filename] = catalog
+    if catalog.refresh():
+        catalog.save()
+    return catalog
+
+
+def is_h5_file(directory, name):
+    """
+    Test if a directory entry is a (non-hidden) hdf5 file (as matched by glob('*.h5'))
+    """
+    return (name[0] != '.') and (os.path.splitext(name)[1] == '.h5') and \
+            os.path.isfile('/'.join((directory, name)))
+
+
+def read_file_info(filename, st, readVersion):
+    """
+    Describe a results file for the catalog
+
+    Parameters
+    ----------
+    filename : string
+        Hdf5 file
+    st : stat result
+        os.stat of filename
+    readVersion : bool
+        Open the file and read the PHYSIO_VERSION attribute
+
+    Returns
+    -------
+    info : dict
+        mtime, size, fingerprint (see utils.file_fingerprint) and version
+        (None if not read or not found)
+    """
+    info = dict(mtime=st.st_mtime, size=st.st_size, version=None,
+            fingerprint=utils.file_fingerprint(filename))
+    if readVersion:
+        try:
+            f = tables.openFile(filename, 'r')
+            if 'PHYSIO_VERSION' in f.root._v_attrs:
+                info['version'] = f.root._v_attrs.PHYSIO_VERSION
+            f.close()
+        except Exception as E:
+            logging.warning("Failed to read version from %s: %s" % \
+                    (filename, E))
+    return info
+
+
+class Catalog(object):
+    """
+    Persistent (json) index of the sessions, epochs and result files
+    of a results repository
+
+    Layout (as written by analysis.analyze):
+        <resultsrepo>/<session>/<session files>.h5
+        <resultsrepo>/<session>/<subdirectory>/<epoch files>.h5
+    Epochs are the subdirectories named <start>_<end>.
+
+    Entries are only updated for directories and files whose modification
+    time (or size) changed since the last refresh so refreshing an up to
+    date catalog takes one stat per directory and file.
+    """
+    def __init__(self, resultsDir, filename):
+        """
+        Parameters
+        ----------
+        resultsDir : string
+            Results repository directory
+        filename : string
+            Catalog (json) file
+        """
+        self.resultsDir = resultsDir
+        self.filename = filename
+        self.sessions = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError) as E:
+            logging.warning("Failed to read catalog %s: %s" % \
+                    (self.filename, E))
+            return
+        if data.get('version', None) != CATALOG_VERSION:
+            logging.debug("Ignoring out of date catalog %s" % self.filename)
+            return
+        self.sessions = data['sessions']
+
+    def save(self):
+        data = dict(version=CATALOG_VERSION, sessions=self.sessions)
+        tmpFilename = '%s.%i.tmp' % (self.filename, os.getpid())
+        try:
+            with open(tmpFilename, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmpFilename, self.filename)
+        except (IOError, OSError) as E:
+            logging.warning("Failed to write catalog %s: %s" % \
+                    (self.filename, E))
+
+    def refresh(self):
+        """
+        Update the entries of sessions, directories and files that changed
+
+        Returns
+        -------
+        changed : bool
+            True if any entry was updated
+        """
+        changed = False
+        names = [os.path.basename(sd) for sd in \
+                utils.regex_glob(self.resultsDir, SESSION_REGEX)[0]] \
+                if os.path.isdir(self.resultsDir) else []
+        for name in set(self.sessions.keys()) - set(names):
+            logging.debug("Removing session %s from catalog" % name)
+            del self.sessions[name]
+            changed = True
+        for name in names:
+            changed |= self.refresh_session(name)
+        return changed
+
+    def refresh_session(self, name):
+        sessionDir = '/'.join((self.resultsDir, name))
+        st = os.stat(sessionDir)
+        entry = self.sessions.get(name, None)
+        changed = False
+        if (entry is None) or (entry['mtime'] != st.st_mtime):
+            # the listing changed
+            entry = self.sessions.setdefault(name, dict(dirs={}, files={}))
+            entry['mtime'] = st.st_mtime
+            listing = os.listdir(sessionDir)
+            dirs = [d for d in listing if (d[0] != '.') and \
+                    os.path.isdir('/'.join((sessionDir, d)))]
+            files = [f for f in listing if is_h5_file(sessionDir, f)]
+            for d in set(entry['dirs'].keys()) - set(dirs):
+                del entry['dirs'][d]
+            for d in dirs:
+                entry['dirs'].setdefault(d, dict(mtime=None, files={}))
+            for f in set(entry['files'].keys()) - set(files):
+                del entry['files'][f]
+            for f in files:
+                entry['files'].setdefault(f, None)
+            changed = True
+        # session level files (summaries, events stores) are not versioned
+        changed |= self.refresh_files(sessionDir, entry['files'], False)
+        for (d, dirEntry) in entry['dirs'].iteritems():
+            changed |= self.refresh_dir('/'.join((sessionDir, d)), dirEntry)
+        return changed
+
+    def refresh_dir(self, directory, entry):
+        st = os.stat(directory)
+        changed = False
+        if entry['mtime'] != st.st_mtime:
+            entry['mtime'] = st.st_mtime
+            files = [f for f in os.listdir(directory) if \
+                    is_h5_file(directory, f)]
+            for f in set(entry['files'].keys()) - set(files):
+                del entry['files'][f]
+            for f in files:
+                entry['files'].setdefault(f, None)
+            changed = True
+        changed |= self.refresh_files(directory, entry['files'], True)
+        return changed
+
+    def refresh_files(self, directory, files, readVersion):
+        changed = False
+        for (f, info) in files.items():
+            filename = '/'.join((directory, f))
+            st = os.stat(filename)
+            if (info is None) or (info['mtime'] != st.st_mtime) or \
+                    (info['size'] != st.st_size):
+                logging.debug("Cataloging %s" % filename)
+                files[f] = read_file_info(filename, st, readVersion)
+                changed = True
+        return changed
+
+    def get_sessions(self):
+        """
+        Returns
+        -------
+        sessions : list
+            Sorted session names
+        """
+        return sorted([str(s) for s in self.sessions.keys()])
+
+    def get_epochs(self, session):
+        """
+        Returns
+        -------
+        epochs : list
+            Epoch directory names sorted by start time (see session.get_epochs)
+        """
+        if not (session in self.sessions):
+            return []
+        return sorted([str(d) for d in self.sessions[session]['dirs'].keys() \
+                if re.match(EPOCH_REGEX, d)], key=lambda s: int(s.split('_')[0]))
+
+    def get_epoch_files(self, session):
+        """
+        Returns
+        -------
+        files : dict
+            Info (see read_file_info) of each hdf5 file in the session
+            subdirectories, keyed by full path
+        """
+        if not (session in self.sessions):
+            return {}
+        sessionDir = '/'.join((self.resultsDir, session))
+        files = {}
+        for (d, dirEntry) in self.sessions[session]['dirs'].iteritems():
+            for (f, info) in dirEntry['files'].iteritems():
+                files['/'.join((sessionDir, d, f))] = info
+        return files
+
+    def get_session_files(self, session):
+        """
+        Returns
+        -------
+        files : dict
+            Info (see read_file_info) of each hdf5 file in the session
+            directory, keyed by full path
+        """
+        if not (session in self.sessions):
+            return {}
+        sessionDir = '/'.join((self.resultsDir, session))
+        return dict([('/'.join((sessionDir, f)), info) for (f, info) in \
+                self.sessions[session]['files'].iteritems()])
@@ -10,6 +10,7 @@ datarepo: /data/raw
 tmp: /scratch/tmp
 scratch: /scratch
 resultsrepo: /data/results
+catalog: 
 cleanup: True
 atlas: /atlas
 
@@ -28,15 +29,26 @@ screenh: 64.54842055808264
 sepratio: 0.2
 minmatch: 10
 maxerr: 0
+blocksize: 0
+njobs: 1
 regex: pixel_clock([0-9])#[0-9]+\.wav
+cache: True
+interpolate: False
+scratch: 
 
 [audio]
 samprate: 44100
 regex: input_([0-9])#[0-9]+\.wav
 
+[combine]
+complevel: 0
+complib: zlib
+
 [mworks]
 ext: .h5
 file: 
+shareevents: False
+eventsstore: 
 
 [epochs]
 timeunit: mworks
@@ -76,6 +88,16 @@ class Config(ConfigParser.SafeConfigParser):
         # read in defaults
         self.readfp(io.BytesIO(CFGDEFAULTS))
     
+    def copy(self):
+        """
+        Copy of this config (with uninterpolated values)
+        """
+        config = Config()
+        for section in self.sections():
+            for (option, value) in self.items(section, raw = True):
+                config.set(section, option, value)
+        return config
+    
     def read_user_config(self, homeDir=os.getenv('HOME')):
         filename = '/'.join((homeDir,'.physio'))
         if os.path.exists(filename):
@@ -107,8 +129,11 @@ class Config(ConfigParser.SafeConfigParser):
         if self.get('mworks','file').strip() == '':
             self.set('mworks','file','/'.join((self.get('session','dir'),session + self.get('mworks','ext'))))
         
-        # if self.get('pixel clock','scratch').strip() == '':
-        #     self.set('pixel clock','scratch','/'.join((self.get('session','scratch'),'pixel_clock')))
+        if self.get('mworks','eventsstore').strip() == '':
+            self.set('mworks','eventsstore','/'.join((self.get('session','outputprefix'),session + '_events.h5')))
+        
+        if self.get('pixel clock','scratch').strip() == '':
+            self.set('pixel clock','scratch','/'.join((self.get('session','scratch'),'pixel_clock')))
     
     def set_epoch(self, audioTimerange):
         epochDir = "%s/%i_%i" % (self.get('session','outputprefix'), int(audioTimerange[0]), int(audioTimerange[1]))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
+import online
 import pixelclock
 import timebase
 
-__all__ = ['pixelclock', 'timebase']
\ No newline at end of file
+__all__ = ['online', 'pixelclock', 'timebase']
\ No newline at end of file
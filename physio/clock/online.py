@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+import collections, logging
+
+import numpy as np
+
+from .. import dsp
+import pixelclock
+
+class OnlineDecoder(object):
+    """
+    Incremental pixel clock decoder used to match audio and mworks times during acquisition
+    
+    Audio blocks (one per pixel clock channel) and mworks pixel clock codes are added
+    as they arrive. Transitions are found with dsp.peaks.BlockCrossingFinder (the block
+    version of pixelclock.find_transitions), reconstructed into codes as in
+    pixelclock.events_to_codes and matched as in pixelclock.match_codes (with maxErr = 0).
+    New matches are returned as soon as minMatch consecutive codes agree.
+    
+    Only the most recent historySize audio and mworks codes are kept so memory
+    use is bounded and no previous data is reprocessed.
+    """
+    def __init__(self, nchannels = 4, threshold = 0.03, refractory = 44, minCodeTime = 441,
+                    pcY = -28, pcHeight = 8.5, screenHeight = 64.54842055808264, sepRatio = 0.2,
+                    minMatch = 10, historySize = 10000, maxInitialEvents = 1000):
+        """
+        Parameters
+        ----------
+        nchannels : int
+            Number of pixel clock channels
+        threshold : float
+            Threshold at which to find events (test: abs(signal) > threshold)
+        refractory : int
+            Number of sub-threshold points that must be encountered before resetting the trigger
+        minCodeTime : int
+            Minimum time (in samples) for a given code change
+        pcY : float
+            Vertical position of pixel clock on screen in degrees
+        pcHeight : float
+            Vertical size of pixel clock in degrees. This may be XScale if pixel clock is rotated
+        screenHeight : float
+            Vertical size of screen in degrees
+        sepRatio : float
+            Seperation ratio of pixel clock patches (see MWorks for more information)
+        minMatch : int
+            Minimum match length
+        historySize : int
+            Number of audio and mworks codes to keep for matching
+        maxInitialEvents : int
+            Maximum number of events to wait for a transition on every channel
+            (to find the initial state) before raising a ValueError
+        """
+        self.nchannels = nchannels
+        self.minCodeTime = minCodeTime
+        self.minMatch = max(minMatch, 1)
+        self.historySize = historySize
+        self.maxInitialEvents = maxInitialEvents
+        self.finders = [dsp.peaks.BlockCrossingFinder(threshold, refractory) \
+                for i in xrange(nchannels)]
+        self.positions = np.array(pixelclock.get_marker_positions(nchannels, pcY, pcHeight, \
+                screenHeight, sepRatio))
+        self.delta = pixelclock.get_marker_delta(nchannels, pcY, pcHeight, screenHeight, sepRatio)
+        
+        # transitions that may still be preceded by transitions in future blocks
+        self.pending = [[] for i in xrange(nchannels)]
+        # code reconstruction state (see pixelclock.events_to_codes)
+        self.initialEvents = [] # events seen before the initial state is known
+        self.state = None
+        self.trigTime = None
+        self.trigChannel = None
+        self.trigDirection = None
+        # sum and number of channel-to-channel speeds (samples per degree)
+        self.speedSum = 0.
+        self.speedCount = 0
+        
+        # audio codes: times are in samples and are offset for the trigger channel
+        self.auCodes = collections.deque(maxlen = historySize)
+        self.auWindow = collections.deque(maxlen = self.minMatch) # most recent codes
+        self.auTimes = collections.deque(maxlen = historySize)
+        self.auCount = 0
+        self.auIndex = {} # window -> deque of audio positions
+        self.auIndexed = collections.deque() # (position, window) in order
+        self.lastAu = -1
+        # mworks codes: times are in seconds
+        self.mwCodes = collections.deque(maxlen = historySize)
+        self.mwWindow = collections.deque(maxlen = self.minMatch) # most recent codes
+        self.mwTimes = collections.deque(maxlen = historySize)
+        self.mwCount = 0
+        self.mwUnmatched = {} # window -> deque of unmatched mworks positions
+        self.mwIndexed = collections.deque() # (position, window) in order
+        self.lastMw = -1
+    
+    def get_avg_speed(self):
+        """
+        Returns
+        -------
+        avgSpeed : float
+            Current estimate of the average speed of screen refresh in degrees per sample
+            (0 if no latencies have been measured)
+        """
+        if (self.speedCount == 0) or (self.speedSum == 0):
+            return 0.
+        return self.speedCount / self.speedSum
+    
+    def get_offsets(self):
+        """
+        Returns
+        -------
+        offsets : 1d array
+            Current estimate of the channel offsets in samples (see pixelclock.offset_codes)
+        """
+        if self.speedCount == 0:
+            return np.zeros(self.nchannels, dtype=int)
+        return np.round(self.positions * (self.speedSum / self.speedCount)).astype(int)
+    
+    def add_audio(self, blocks):
+        """
+        Process the next block of pixel clock audio
+        
+        Parameters
+        ----------
+        blocks : list of 1d arrays or 2d array
+            Next consecutive block of samples for each channel (ordered LSB first),
+            either one array per channel or an array of shape (nsamples, nchannels)
+        
+        Returns
+        -------
+        matches : list
+            New (audio time in samples, mworks time in seconds) matches
+        """
+        if isinstance(blocks, np.ndarray) and blocks.ndim == 2:
+            blocks = [blocks[:,i] for i in xrange(blocks.shape[1])]
+        assert len(blocks) == self.nchannels, \
+                "Number of blocks[%i] must equal nchannels[%i]" % (len(blocks), self.nchannels)
+        for (ch, block) in enumerate(blocks):
+            t, v = self.finders[ch].process(np.asarray(block))
+            self.pending[ch] += zip(t, np.sign(v).astype(int))
+        
+        # future transitions are refined back at most to the last sample that
+        # did not continue a rising or falling interval
+        horizon = min([min([b[0] for b in f.lastBreak.values() if b is not None] + [f.nsamples]) \
+                for f in self.finders])
+        events = []
+        for ch in xrange(self.nchannels):
+            n = 0
+            while (n < len(self.pending[ch])) and (self.pending[ch][n][0] < horizon):
+                n += 1
+            events += [(t, ch, d) for (t, d) in self.pending[ch][:n]]
+            self.pending[ch] = self.pending[ch][n:]
+        events.sort()
+        
+        matches = []
+        for (t, ch, d) in events:
+            matches += self.add_event(t, ch, d)
+        # close the current code if no more events can be part of it
+        if (self.trigTime is not None) and ((horizon - self.trigTime) > self.minCodeTime):
+            matches += self.close_code()
+        return matches
+    
+    def add_event(self, t, ch, d):
+        """
+        Add a pixel clock event (single channel transition) at time t (in samples)
+        on channel ch in direction d (see pixelclock.events_to_codes). Events must
+        be added in time order.
+        
+        Returns
+        -------
+        matches : list
+            New (audio time in samples, mworks time in seconds) matches
+        """
+        matches = []
+        if self.state is None:
+            # wait for the first transition on every channel to get the initial state
+            self.initialEvents.append((t, ch, d))
+            if len(set([e[1] for e in self.initialEvents])) < self.nchannels:
+                if len(self.initialEvents) >= self.maxInitialEvents:
+                    missing = sorted(set(xrange(self.nchannels)) - \
+                            set([e[1] for e in self.initialEvents]))
+                    raise ValueError("No transitions found on channels %s after %i events" % \
+                            (missing, len(self.initialEvents)))
+                return matches
+            self.state = [None] * self.nchannels
+            for (et, ech, ed) in self.initialEvents:
+                if self.state[ech] is None:
+                    self.state[ech] = 0 if ed == 1 else 1
+            initialEvents = self.initialEvents
+            self.initialEvents = []
+            for (et, ech, ed) in initialEvents:
+                matches += self.add_event(et, ech, ed)
+            return matches
+        
+        if self.trigTime is None:
+            self.trigTime, self.trigChannel, self.trigDirection = t, ch, d
+        elif abs(t - self.trigTime) > self.minCodeTime:
+            matches += self.close_code()
+            self.trigTime, self.trigChannel, self.trigDirection = t, ch, d
+        
+        # update state
+        self.state[ch] += d
+        if not (self.state[ch] in [0,1]):
+            logging.debug("Invalid state found[%s] at %i, truncating" % (str(self.state), t))
+            self.state[ch] = max(0, min(1, self.state[ch]))
+        elif (self.trigDirection == 1) and (d == 1) and (abs(self.trigChannel - ch) >= 2):
+            # only use latencies for non-adjacent patches (see pixelclock.offset_codes)
+            self.speedSum += (t - self.trigTime) / (abs(self.trigChannel - ch) * self.delta)
+            self.speedCount += 1
+        return matches
+    
+    def close_code(self):
+        """
+        Finish the current code and add it to the audio codes
+        
+        Returns
+        -------
+        matches : list
+            New (audio time in samples, mworks time in seconds) matches
+        """
+        code = pixelclock.state_to_code(self.state)
+        time = self.trigTime - self.get_offsets()[self.trigChannel]
+        self.trigTime = None
+        return self.add_audio_code(time, code)
+    
+    def add_audio_code(self, time, code):
+        """
+        Add a reconstructed audio code and match it to the mworks codes
+        
+        Parameters
+        ----------
+        time : int
+            Time (in samples) of the code
+        code : int
+            Pixel clock code
+        
+        Returns
+        -------
+        matches : list
+            New (audio time in samples, mworks time in seconds) matches
+        """
+        self.auCodes.append(code)
+        self.auWindow.append(code)
+        self.auTimes.append(time)
+        self.auCount += 1
+        if len(self.auWindow) < self.minMatch:
+            return []
+        position = self.auCount - self.minMatch
+        window = tuple(self.auWindow)
+        self.auIndex.setdefault(window, collections.deque()).append(position)
+        self.auIndexed.append((position, window))
+        self.prune(self.auIndexed, self.auIndex, self.auCount)
+        
+        # match to the first unmatched mworks window after the last match
+        unmatched = self.mwUnmatched.get(window, None)
+        if unmatched is None:
+            return []
+        while len(unmatched) and (unmatched[0] <= self.lastMw):
+            unmatched.popleft()
+        if len(unmatched) == 0:
+            return []
+        return self.match(position, unmatched.popleft())
+    
+    def add_mworks_event(self, time, value):
+        """
+        Add a mworks #stimDisplayUpdate event
+        
+        Parameters
+        ----------
+        time : float
+            Event time (in seconds)
+        value : list
+            Event value (list of stimulus dicts, see pixelclock.get_events)
+        
+        Returns
+        -------
+        matches : list
+            New (audio time in samples, mworks time in seconds) matches
+        """
+        if value is None:
+            logging.warning("Found #stimDisplayUpdate with value = None at %f" % time)
+            return []
+        times = []
+        codes = []
+        for i in value:
+            if 'bit_code' in i.keys():
+                times.append(time)
+                codes.append(int(i['bit_code']))
+        return self.add_mworks_codes(times, codes)
+    
+    def add_mworks_codes(self, times, codes):
+        """
+        Add mworks pixel clock codes and match them to the audio codes
+        
+        Parameters
+        ----------
+        times : list
+            Times (in seconds) of the codes
+        codes : list
+            Pixel clock codes
+        
+        Returns
+        -------
+        matches : list
+            New (audio time in samples, mworks time in seconds) matches
+        """
+        matches = []
+        for (time, code) in zip(times, codes):
+            self.mwCodes.append(code)
+            self.mwWindow.append(code)
+            self.mwTimes.append(time)
+            self.mwCount += 1
+            if len(self.mwWindow) < self.minMatch:
+                continue
+            position = self.mwCount - self.minMatch
+            window = tuple(self.mwWindow)
+            
+            # match to the first audio window after the last match
+            positions = self.auIndex.get(window, None)
+            if positions is not None:
+                while len(positions) and (positions[0] <= self.lastAu):
+                    positions.popleft()
+                if len(positions):
+                    matches += self.match(positions.popleft(), position)
+                    continue
+            # wait for the audio
+            self.mwUnmatched.setdefault(window, collections.deque()).append(position)
+            self.mwIndexed.append((position, window))
+            self.prune(self.mwIndexed, self.mwUnmatched, self.mwCount)
+        return matches
+    
+    def prune(self, indexed, index, count):
+        """
+        Remove windows that are older than historySize from an index
+        """
+        while len(indexed) and (indexed[0][0] < (count - self.historySize)):
+            position, window = indexed.popleft()
+            positions = index.get(window, None)
+            if positions is None:
+                continue
+            while len(positions) and (positions[0] <= position):
+                positions.popleft()
+            if len(positions) == 0:
+                del index[window]
+    
+    def match(self, auPosition, mwPosition):
+        """
+        Record a match between audio and mworks code positions
+        
+        Returns
+        -------
+        matches : list
+            List containing the (audio time in samples, mworks time in seconds) match
+            or an empty list if either code is no longer in the history
+        """
+        self.lastAu = auPosition
+        self.lastMw = mwPosition
+        auI = auPosition - (self.auCount - len(self.auTimes))
+        mwI = mwPosition - (self.mwCount - len(self.mwTimes))
+        if (auI < 0) or (mwI < 0):
+            return []
+        return [(self.auTimes[auI], self.mwTimes[mwI])]
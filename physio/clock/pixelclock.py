@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import ast, copy, logging, warnings
+import ast, copy, hashlib, heapq, logging, multiprocessing, os, pickle, warnings
 
 import numpy as np
 with warnings.catch_warnings():
@@ -53,6 +53,62 @@ def find_transitions(signal, threshold = 0.03, refractory = 44):
     # return crossings
     return dsp.peaks.refine_crossings(signal, crossings)
 
+def read_transitions(audioFile, threshold = 0.03, refractory = 44, blockSize = None):
+    """
+    Read a pixel clock audio file and find transitions
+    
+    Parameters
+    ----------
+    audioFile : string
+        Pixel clock audio file
+    threshold : float
+        Threshold at which to find events (test: abs(signal) > threshold)
+    refractory : int
+        Number of sub-threshold points that must be encountered before resetting the trigger
+    blockSize : int
+        Number of samples to read at a time. If None (or <= 0) read the whole file at once.
+        Transitions are identical to those found when reading the whole file.
+    
+    Returns
+    -------
+    transitions : 1d array
+        Indicies of pixel clock transitions (see find_transitions)
+    directions : 1d array
+        Direction of each transition (sign of the signal at the transition)
+    """
+    logging.debug("Opening %s" % audioFile)
+    f = al.Sndfile(audioFile,'r')
+    if (blockSize is None) or (blockSize <= 0):
+        logging.debug("Reading %s" % audioFile)
+        s = f.read_frames(f.nframes)
+        logging.debug("Processing %s" % audioFile)
+        t = find_transitions(s, threshold, refractory)
+        d = np.sign(s[t])
+        f.close()
+        return t, d
+    
+    logging.debug("Reading and processing %s in blocks of %i" % (audioFile, blockSize))
+    finder = dsp.peaks.BlockCrossingFinder(threshold, refractory)
+    ts = []
+    ds = []
+    nread = 0
+    while nread < f.nframes:
+        s = f.read_frames(min(blockSize, f.nframes - nread))
+        nread += len(s)
+        t, v = finder.process(s)
+        ts.append(t)
+        ds.append(np.sign(v))
+    f.close()
+    if len(ts) == 0:
+        return np.array([], dtype=int), np.array([])
+    return np.hstack(ts), np.hstack(ds)
+
+def read_transitions_from_args(args):
+    """
+    Call read_transitions with a tuple of arguments (for use with multiprocessing.Pool.map)
+    """
+    return read_transitions(*args)
+
 def state_to_code(state):
     """
     Convert a pixel clock state list to a code
@@ -72,6 +128,107 @@ def state_to_code(state):
 
 def events_to_codes(events, nchannels, minCodeTime):
     """
+    Parameters
+    ----------
+    events : 2d array
+        Array of pixel clock events (single channel transitions) where:
+            events[:,0] = times
+            events[:,1] = channels
+            events[:,2] = directions
+    nchannels : int
+        Number of pixel clock channels
+    minCodeTime : int
+        Minimum time (in samples) for a given code change
+    
+    Return
+    ------
+    codes : 2d array
+        Array of reconstructed pixel clock codes where:
+            codes[:,0] = time
+            codes[:,1] = code
+            codes[:,2] = trigger channel
+        These codes are NOT offset for latencies of the triggered channel
+    latencies : nchannels x nchannels list of 1d arrays
+        Channel-to-channel latencies measured from events.
+        Should be used with offset_codes to correct code times for the triggered channel
+    
+    Notes
+    -----
+    A code is started by a trigger event and contains all following events that
+    occur within minCodeTime of the trigger. Transitions that would move a
+    channel outside of [0, 1] (e.g. two + transitions in a row) are ignored.
+    """
+    assert len(events) > 0, "Events cannot be 0 length"
+    assert len(events[0]) == 3, "Each event should be of length 3 not %i" % len(events[0])
+    evts = np.asarray(events)
+    evts = evts[evts[:,0].argsort(),:] # sort events
+    times = evts[:,0]
+    channels = np.abs(evts[:,1]).astype(int)
+    directions = evts[:,2].astype(int)
+    nevents = len(evts)
+    
+    # group events into codes: a new code starts when an event is more than
+    # minCodeTime after the trigger (first event) of the current code
+    starts = np.hstack((0, np.where(np.diff(times) > minCodeTime)[0] + 1))
+    ends = np.hstack((starts[1:], nevents))
+    spread = np.where((times[ends - 1] - times[starts]) > minCodeTime)[0]
+    if len(spread):
+        # closely spaced events spanning more than minCodeTime, split these from each trigger
+        splits = []
+        for (s, e) in zip(starts[spread], ends[spread]):
+            s = np.searchsorted(times[s:e], times[s] + minCodeTime, side='right') + s
+            while s < e:
+                splits.append(s)
+                s = np.searchsorted(times[s:e], times[s] + minCodeTime, side='right') + s
+        starts = np.union1d(starts, splits)
+    # state of each channel: only the last non-zero transition matters, + sets
+    # the channel to 1 and - sets it to 0. Valid transitions change the code by
+    # +-(1 << channel) so the code after each event is a cumulative sum
+    initialCode = 0
+    steps = np.zeros(nevents, dtype=int)
+    valid = np.ones(nevents, dtype=bool)
+    for ch in xrange(nchannels):
+        ci = np.where(channels == ch)[0]
+        cd = directions[ci]
+        # get initial state by looking at first transitions
+        initial = 0 if cd[0] == 1 else 1
+        initialCode += initial << ch
+        last = np.maximum.accumulate(np.where(cd != 0, np.arange(len(ci)), -1))
+        state = np.where(last >= 0, cd[last] > 0, initial).astype(int)
+        # a + transition is only valid from 0 and a - transition only from 1
+        previous = np.hstack((initial, state[:-1]))
+        chValid = (cd == 0) | (cd == (1 - 2 * previous))
+        valid[ci] = chValid
+        steps[ci] = np.where(chValid, cd, 0) * (1 << ch)
+    # the code of each trigger is read from the state just before the next
+    # trigger, the final state is read at the last event
+    code = (initialCode + np.cumsum(steps))[np.hstack((starts[1:] - 1, nevents - 1))]
+    if not np.all(valid):
+        logging.debug("Found %i transitions to invalid states, truncating" % np.sum(~valid))
+    
+    codes = np.column_stack((times[starts[:-1]], code[:-1], channels[starts[:-1]]))
+    # assume last code was complete
+    if (len(codes) == 0) or (code[-1] != codes[-1,1]):
+        codes = np.vstack((codes, (times[starts[-1]], code[-1], channels[starts[-1]])))
+    
+    # latencies of valid + transitions following + triggers
+    measured = np.where(valid & (directions == 1))[0]
+    triggers = starts[np.searchsorted(starts, measured, side='right') - 1]
+    measured = measured[directions[triggers] == 1]
+    triggers = triggers[directions[triggers] == 1]
+    pairs = channels[triggers] * nchannels + channels[measured]
+    order = np.argsort(pairs)
+    delays = (times[measured] - times[triggers])[order]
+    bounds = np.hstack((0, np.cumsum(np.bincount(pairs, minlength = nchannels * nchannels))))
+    latencies = [[delays[bounds[x * nchannels + y]:bounds[x * nchannels + y + 1]] \
+            for y in xrange(nchannels)] for x in xrange(nchannels)]
+    
+    return codes, latencies
+
+def slow_events_to_codes(events, nchannels, minCodeTime):
+    """
+    Loop based version of events_to_codes (used to test and benchmark events_to_codes)
+    
     Parameters
     ----------
     events : 2d array
@@ -339,10 +496,183 @@ def match_test(au, mw, minMatch, maxErr):
                 return False
     return False
 
+# multiplier for the rolling hash of code windows (arithmetic is mod 2**64)
+HASH_BASE = np.uint64(1000003)
+
+def hash_windows(codes, k):
+    """
+    Compute a rolling hash of every length k window of a code sequence
+    
+    Parameters
+    ----------
+    codes : 1d array
+        Sequence of (integer) codes
+    k : int
+        Window length
+    
+    Returns
+    -------
+    keys : 1d array of uint64
+        Hash of codes[i:i+k] for i in [0, len(codes) - k]
+    """
+    codes = np.asarray(codes).astype(np.int64).view(np.uint64)
+    n = len(codes) - k + 1
+    keys = np.zeros(max(n, 0), dtype=np.uint64)
+    if n <= 0:
+        return keys
+    for i in xrange(k):
+        keys = keys * HASH_BASE + codes[i:i+n]
+    return keys
+
+class WindowIndex(object):
+    """
+    Index of the starting positions of every length k window of a code sequence
+    """
+    def __init__(self, codes, k):
+        """
+        Parameters
+        ----------
+        codes : 1d array
+            Sequence of (integer) codes to index
+        k : int
+            Window length
+        """
+        self.k = k
+        keys = hash_windows(codes, k)
+        # positions grouped by key and sorted within each group
+        self.positions = np.argsort(keys, kind='mergesort')
+        self.keys, starts = np.unique(keys[self.positions], return_index=True)
+        self.bounds = np.hstack((starts, len(keys))).astype(int)
+    
+    def find(self, keys):
+        """
+        Parameters
+        ----------
+        keys : 1d array of uint64
+            Window hashes (see hash_windows) to look up
+        
+        Returns
+        -------
+        groups : 1d array
+            Group of each key (-1 for missing keys). Positions of the windows in
+            group g are positions[bounds[g]:bounds[g+1]]
+        """
+        if len(self.keys) == 0:
+            return -np.ones(len(keys), dtype=int)
+        groups = np.searchsorted(self.keys, keys)
+        groups[groups == len(self.keys)] = 0
+        groups[self.keys[groups] != keys] = -1
+        return groups
+
+def shifted(positions, shift):
+    """
+    Lazily yield positions - shift
+    """
+    for p in positions:
+        yield p - shift
+
 def match_codes(auTimes, auCodes, mwTimes, mwCodes, minMatch = 10, maxErr = 0):
     """
     Find times of matching periods in two code sequences
     
+    Parameters
+    ----------
+    audioTimes : list
+        Times of audio codes
+    audioCodes : list
+        List of audio codes to match
+    mwTimes : list
+        Times of mworks codes
+    mwCodes : list
+        List of mworks codes
+    minMatch : int
+        Minimum match length (starting at the first index)
+    maxErr : int
+        Maximum number of matching errors
+    
+    Returns
+    -------
+    matches : 2d list
+        List of matching times where:
+            matches[:,0] = audioTimes
+            matches[:,1] = mwTimes
+    Notes
+    -----
+    Repeats in the code sequence will result in offset errors
+    Setting maxErr > 0 will result in offset errors
+    
+    Matches are identical to lookup_match_codes: each mworks code is matched to the
+    first following audio code that passes match_test. Audio code windows are
+    indexed by a rolling hash so for maxErr = 0 each mworks code is matched in
+    amortized constant time. For maxErr > 0 the mworks codes are split into
+    maxErr + 1 blocks, at least one of which must appear unchanged in the audio
+    codes, and only audio codes near those blocks are tested.
+    """
+    auTimes = np.array(auTimes)
+    auCodes = np.array(auCodes)
+    mwTimes = np.array(mwTimes)
+    mwCodes = np.array(mwCodes)
+    k = max(minMatch, 1)
+    maxErr = max(maxErr, 0)
+    q = k // (maxErr + 1) # block length
+    if q == 0:
+        return lookup_match_codes(auTimes, auCodes, mwTimes, mwCodes, minMatch, maxErr)
+    
+    index = WindowIndex(auCodes, q)
+    groups = index.find(hash_windows(mwCodes, q))
+    positions = index.positions
+    bounds = index.bounds
+    
+    auI = -1
+    matches = []
+    if maxErr == 0:
+        # first position of each window that is after the last match
+        cursors = bounds[:-1].copy()
+        for mwI in xrange(len(mwCodes) - k + 1):
+            g = groups[mwI]
+            if g == -1: continue
+            c = cursors[g]
+            while (c < bounds[g+1]) and (positions[c] <= auI):
+                c += 1
+            cursors[g] = c
+            # check for hash collisions
+            while c < bounds[g+1]:
+                aui = positions[c]
+                if np.all(auCodes[aui:aui+k] == mwCodes[mwI:mwI+k]):
+                    matches.append((auTimes[aui], mwTimes[mwI]))
+                    auI = aui
+                    break
+                c += 1
+        return matches
+    
+    for mwI in xrange(len(mwCodes) - k + 1):
+        # candidates are audio codes that put an unchanged block at the correct
+        # position allowing for up to maxErr skipped audio codes
+        candidates = []
+        for b in xrange(maxErr + 1):
+            g = groups[mwI + b * q]
+            if g == -1: continue
+            ps = positions[bounds[g]:bounds[g+1]]
+            for skipped in xrange(maxErr + 1):
+                shift = b * q + skipped
+                ps0 = np.searchsorted(ps, auI + 1 + shift)
+                candidates.append(shifted(ps[ps0:], shift))
+        last = -1
+        for aui in heapq.merge(*candidates):
+            if aui == last: continue
+            last = aui
+            if (auCodes[aui] == mwCodes[mwI]) and \
+                    match_test(auCodes[aui:], mwCodes[mwI:], minMatch, maxErr):
+                matches.append((auTimes[aui], mwTimes[mwI]))
+                auI = aui
+                break
+    return matches
+
+def lookup_match_codes(auTimes, auCodes, mwTimes, mwCodes, minMatch = 10, maxErr = 0):
+    """
+    Find times of matching periods in two code sequences by testing every
+    audio code that matches each mworks code (see match_codes)
+    
     Parameters
     ----------
     audioTimes : list
@@ -500,7 +830,8 @@ def test_matches():
     return matches
 
 def parse(audioFiles, threshold = 0.03, refractory = 44, minCodeTime = 441,
-                    pcY = -28, pcHeight = 8.5, screenHeight = 64.54842055808264, sepRatio = 0.2):
+                    pcY = -28, pcHeight = 8.5, screenHeight = 64.54842055808264, sepRatio = 0.2,
+                    blockSize = None, njobs = 1):
     """
     Parse pixel clock from audio files
     
@@ -522,6 +853,12 @@ def parse(audioFiles, threshold = 0.03, refractory = 44, minCodeTime = 441,
         Vertical size of screen in degrees (may need to calculate based on width, see MWorks core)
     sepRatio : float
         Seperation ratio of pixel clock patches (see MWorks for more information)
+    blockSize : int
+        Number of samples to read at a time from each audio file (see read_transitions).
+        If None (or <= 0) each file is read all at once.
+    njobs : int
+        Number of processes used to find transitions. Each audio file is processed
+        by one process so at most len(audioFiles) processes are used.
     
     Returns
     -------
@@ -537,35 +874,30 @@ def parse(audioFiles, threshold = 0.03, refractory = 44, minCodeTime = 441,
     avgSpeed : float
         Average speed of screen refresh in degrees per sample
     """
-    # transitions = []
-    # channels = []
-    # directions = []
-    # samplerate = None
     nchannels = len(audioFiles)
-    events = np.transpose(np.atleast_2d([[],[],[]]))
-    for (i, af) in enumerate(audioFiles):
-        logging.debug("Opening %s" % af)
-        f = al.Sndfile(af,'r')
-        # samplerate = f.samplerate
-        logging.debug("Reading %s" % af)
-        s = f.read_frames(f.nframes)
-        logging.debug("Processing %s" % af)
-        t = find_transitions(s, threshold, refractory)
-        # c = np.sign(s[t]) * i# get state of transitions: - == down
-        logging.debug("Getting sign: %i %i" % (t.max(), t.argmax()))
-        d = np.sign(s[t])
-        logging.debug("Getting ones")
-        c = np.ones(len(d)) * i
-        logging.debug("Found %i transitions on channel %i" % (len(t), i))
-        ap = np.transpose(np.vstack((t,c,d)))
-        events = np.vstack((events,ap)).astype(int)
-        # t = refine_crossing(s, t)
-        # transitions.append(t)
-        # channels.append(c)
-        # directions.append(d)
-        # cleanup
-        f.close()
-        del s, t
+    args = [(af, threshold, refractory, blockSize) for af in audioFiles]
+    if (njobs > 1) and (nchannels > 1):
+        logging.debug("Finding transitions with %i processes" % min(njobs, nchannels))
+        pool = multiprocessing.Pool(min(njobs, nchannels))
+        try:
+            transitions = pool.map(read_transitions_from_args, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        transitions = [read_transitions_from_args(a) for a in args]
+    
+    # merge channel transitions into one events array
+    nevents = sum([len(t) for (t, d) in transitions])
+    events = np.empty((nevents, 3), dtype=int)
+    i = 0
+    for (ch, (t, d)) in enumerate(transitions):
+        logging.debug("Found %i transitions on channel %i" % (len(t), ch))
+        events[i:i+len(t),0] = t
+        events[i:i+len(t),1] = ch
+        events[i:i+len(t),2] = d
+        i += len(t)
+    del transitions
     
     logging.debug("Reconstructing codes")
     codes, offsets, speed = reconstruct_codes(events, nchannels, minCodeTime, pcY, pcHeight, screenHeight, sepRatio)
@@ -646,7 +978,7 @@ def test_get_events():
 
 def process(audioFiles, mwTimes, mwCodes, threshold = 0.03, refractory = 44, minCodeTime = 441,
                     pcY = -28, pcHeight = 8.5, screenHeight = 64.54842055808264, sepRatio = 0.2,
-                    minMatch = 10, maxErr = 0):
+                    minMatch = 10, maxErr = 0, blockSize = None, njobs = 1):
     """
     Process pixel clock audio files and match codes to given MWorks codes
     
@@ -672,6 +1004,10 @@ def process(audioFiles, mwTimes, mwCodes, threshold = 0.03, refractory = 44, min
         Vertical size of screen in degrees (may need to calculate based on width, see MWorks core)
     sepRatio : float
         Seperation ratio of pixel clock patches (see MWorks for more information)
+    blockSize : int
+        Number of samples to read at a time from each audio file (see read_transitions)
+    njobs : int
+        Number of processes used to find transitions (see parse)
     
     Returns
     -------
@@ -682,7 +1018,7 @@ def process(audioFiles, mwTimes, mwCodes, threshold = 0.03, refractory = 44, min
     avgSpeed : float
         Average speed of screen refresh in degrees per sample
     """
-    codes, offsets, speed = parse(audioFiles, threshold, refractory, minCodeTime, pcY, pcHeight, screenHeight, sepRatio)
+    codes, offsets, speed = parse(audioFiles, threshold, refractory, minCodeTime, pcY, pcHeight, screenHeight, sepRatio, blockSize, njobs)
     auTimes = codes[:,0]
     auCodes = codes[:,1]
     matches = match_codes(auTimes, auCodes, mwTimes, mwCodes, minMatch, maxErr)
@@ -743,6 +1079,60 @@ def test_process():
     # 
     # return codes[:,0], codes[:,1], mwT, mwC, matches, oldmatches, newmatches
 
+def make_cache_key(filenames, parameters):
+    """
+    Make a key for cached pixel clock results
+    
+    Parameters
+    ----------
+    filenames : list
+        Input files (fingerprinted with utils.file_fingerprint)
+    parameters : tuple
+        Parameters that change the results (hashed with repr)
+    
+    Returns
+    -------
+    key : string
+        Hex digest of the file fingerprints and parameters
+    """
+    h = hashlib.md5()
+    for f in filenames:
+        h.update(utils.file_fingerprint(f))
+    h.update(repr(tuple(parameters)))
+    return h.hexdigest()
+
+def read_cache(cacheDir, name, key):
+    """
+    Read cached pixel clock results (see write_cache)
+    
+    Returns
+    -------
+    results : dict or None
+        Cached results or None if nothing (readable) was cached for this key
+    """
+    filename = '%s/%s_%s.p' % (cacheDir, name, key)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        logging.warning("Failed to read pixel clock cache %s: %s" % (filename, e))
+        return None
+
+def write_cache(cacheDir, name, key, results):
+    """
+    Cache pixel clock results to cacheDir/<name>_<key>.p
+    """
+    if not os.path.exists(cacheDir): os.makedirs(cacheDir)
+    filename = '%s/%s_%s.p' % (cacheDir, name, key)
+    logging.debug("Caching pixel clock %s to %s" % (name, filename))
+    # write to a temporary file first so a partial file is never read
+    tmpFilename = '%s.%i' % (filename, os.getpid())
+    with open(tmpFilename, 'wb') as f:
+        pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpFilename, filename)
+
 def process_from_config(config):
     """
     Parameters
@@ -757,6 +1147,11 @@ def process_from_config(config):
             matches[:,1] = mworks times
     avgSpeed : float
         Average speed of screen refresh in degrees per sample
+    
+    Notes
+    -----
+    If [pixel clock] cache is True the decoded codes and the matches are cached in
+    [pixel clock] scratch keyed by the input files and the pixel clock parameters
     """
     # get audio files
     audioDir = config.get('session','dir') + '/Audio Files'
@@ -765,9 +1160,7 @@ def process_from_config(config):
     # sort to make sure they are ordered channel 0 -> higher
     pcFiles = np.array(pcFiles)[np.argsort(pcChannels)]
     
-    # read mworks stuff
     eventsFilename = config.get('session','dir') + '/' + config.get('session','name') + '.h5'
-    mwT, mwC = get_events(eventsFilename)
     
     threshold = config.getfloat('pixel clock', 'threshold')
     refractory = config.getint('pixel clock', 'refractory')
@@ -778,9 +1171,40 @@ def process_from_config(config):
     sepRatio = config.getfloat('pixel clock', 'sepratio')
     minMatch = config.getint('pixel clock', 'minmatch')
     maxErr = config.getint('pixel clock', 'maxerr')
+    blockSize = config.getint('pixel clock', 'blocksize')
+    njobs = config.getint('pixel clock', 'njobs')
+    
+    useCache = config.getboolean('pixel clock', 'cache')
+    cacheDir = config.get('pixel clock', 'scratch')
+    cached = None
+    if useCache:
+        # blockSize and njobs do not change the results
+        codesKey = make_cache_key(pcFiles, (threshold, refractory, minCodeTime, \
+                pcY, pcHeight, screenHeight, sepRatio))
+        matchesKey = make_cache_key([eventsFilename], (codesKey, minMatch, maxErr))
+        cached = read_cache(cacheDir, 'matches', matchesKey)
+        if cached is not None:
+            logging.debug("Using cached pixel clock matches")
+            return cached['matches'], cached['avgSpeed']
+        cached = read_cache(cacheDir, 'codes', codesKey)
+    
+    if cached is None:
+        codes, offsets, speed = parse(pcFiles, threshold, refractory, minCodeTime, \
+                pcY, pcHeight, screenHeight, sepRatio, blockSize, njobs)
+        if useCache:
+            write_cache(cacheDir, 'codes', codesKey, \
+                    {'codes' : codes, 'offsets' : offsets, 'avgSpeed' : speed})
+    else:
+        logging.debug("Using cached pixel clock codes")
+        codes, speed = cached['codes'], cached['avgSpeed']
     
-    return process(pcFiles, mwT, mwC, threshold, refractory, minCodeTime,\
-                pcY, pcHeight, screenHeight, sepRatio, minMatch, maxErr)
+    # read mworks stuff
+    mwT, mwC = get_events(eventsFilename)
+    
+    matches = match_codes(codes[:,0], codes[:,1], mwT, mwC, minMatch, maxErr)
+    if useCache:
+        write_cache(cacheDir, 'matches', matchesKey, {'matches' : matches, 'avgSpeed' : speed})
+    return matches, speed
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+from .. import online
+from .. import pixelclock
+
+def make_signals(ncodes, codeTime = 1500, offsets = (0, 10, 20, 30)):
+    codes = []
+    last = 0
+    for i in xrange(ncodes):
+        c = np.random.randint(0, 16)
+        while c == last:
+            c = np.random.randint(0, 16)
+        codes.append(c)
+        last = c
+    nchannels = len(offsets)
+    signals = np.zeros((ncodes * codeTime + 5000, nchannels))
+    pulse = np.exp(-np.arange(200) / 30.) * (1 - np.exp(-np.arange(200) / 3.)) * 0.5
+    prev = 0
+    for (i, c) in enumerate(codes):
+        for ch in xrange(nchannels):
+            b = (c >> ch) & 1
+            if b != ((prev >> ch) & 1):
+                t = 2000 + i * codeTime + offsets[ch]
+                signals[t:t+200, ch] += pulse if b else -pulse
+        prev = c
+    signals += np.random.randn(*signals.shape) * 0.002
+    return signals
+
+def batch_codes(signals, minCodeTime = 441):
+    nchannels = signals.shape[1]
+    events = []
+    for ch in xrange(nchannels):
+        t = pixelclock.find_transitions(signals[:,ch])
+        events += [(i, ch, d) for (i, d) in zip(t, np.sign(signals[t,ch]))]
+    codes, latencies = pixelclock.events_to_codes(np.array(events), nchannels, minCodeTime)
+    return codes
+
+def test_online_decoder():
+    np.random.seed(0)
+    signals = make_signals(300)
+    codes = batch_codes(signals)
+    mwCodes = codes[:,1]
+    mwTimes = np.arange(len(mwCodes)) / 10.
+    
+    decoder = online.OnlineDecoder(signals.shape[1], minMatch = 10)
+    matches = []
+    mwI = 0
+    for start in xrange(0, len(signals), 1000):
+        matches += decoder.add_audio(signals[start:start+1000])
+        # mworks codes arrive in small irregular chunks
+        n = np.random.randint(0, 4)
+        matches += decoder.add_mworks_codes(mwTimes[mwI:mwI+n], mwCodes[mwI:mwI+n])
+        mwI += n
+    matches += decoder.add_mworks_codes(mwTimes[mwI:], mwCodes[mwI:])
+    
+    # codes are identical to the batch codes (the last batch code is only
+    # kept if it differs from the previous code)
+    assert len(decoder.auCodes) >= (len(codes) - 1)
+    n = min(len(decoder.auCodes), len(codes))
+    assert list(decoder.auCodes)[:n] == list(mwCodes[:n])
+    # code times are offset for the trigger channel
+    assert np.all(np.array(decoder.auTimes)[:n] <= codes[:n,0])
+    offsets = decoder.get_offsets()
+    assert np.all(np.diff(offsets) <= 0)
+    
+    # every mworks code that is followed by minMatch - 1 codes is matched
+    assert len(matches) == (len(mwCodes) - 10 + 1)
+    for (i, (auTime, mwTime)) in enumerate(matches):
+        assert mwTime == mwTimes[i]
+        assert auTime == decoder.auTimes[i]
+
+def test_online_decoder_history():
+    np.random.seed(1)
+    signals = make_signals(200)
+    mwCodes = batch_codes(signals)[:,1]
+    mwTimes = np.arange(len(mwCodes)) / 10.
+    decoder = online.OnlineDecoder(signals.shape[1], minMatch = 10, historySize = 50)
+    # all mworks codes arrive before the audio
+    matches = decoder.add_mworks_codes(mwTimes, mwCodes)
+    assert len(matches) == 0
+    for start in xrange(0, len(signals), 5000):
+        matches += decoder.add_audio(signals[start:start+5000])
+    assert len(decoder.auCodes) <= 50
+    assert len(decoder.mwCodes) <= 50
+    assert len(decoder.mwUnmatched) <= 50
+    assert len(decoder.auIndex) <= 50
+    # only codes still in the mworks history can be matched
+    assert len(matches) > 0
+    assert all([mwTime >= mwTimes[-50] for (auTime, mwTime) in matches])
+
+def test_online_decoder_initial_events():
+    np.random.seed(2)
+    signals = make_signals(100)
+    # one channel never transitions
+    signals[:,3] = np.random.randn(len(signals)) * 0.002
+    decoder = online.OnlineDecoder(signals.shape[1], maxInitialEvents = 20)
+    try:
+        for start in xrange(0, len(signals), 1000):
+            decoder.add_audio(signals[start:start+1000])
+        raise AssertionError("OnlineDecoder did not fail without transitions on every channel")
+    except ValueError:
+        pass
+    assert len(decoder.initialEvents) <= 20
+    assert len(decoder.auWindow) == 0
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
-import logging, sys
+import logging, os, shutil, sys, tempfile
 
 import numpy as np
+import tables
 
+from ... import cfg
+from ...h5.tests.test_events import Codec, Event
 from .. import pixelclock
 
 def test_find_transitions():
@@ -131,4 +134,270 @@ def test_events_to_codes():
     # using - transitions = offsetCodes = sooner (995)
     # this was fixed by using only latencies from patches far non-adjacent patches
     
-    assert np.sum((t - np.array(times))) < (len(times)*2.), "%s" % offsetCodes
\ No newline at end of file
+    assert np.sum((t - np.array(times))) < (len(times)*2.), "%s" % offsetCodes
+
+def make_events(ncodes, nchannels = 4, jitter = 3, noise = 0.):
+    """
+    Make random (time sorted) pixel clock events for ncodes codes with
+    jitter in the channel latencies and a fraction (noise) of spurious events
+    """
+    events = []
+    lastCode = 0
+    t = 1000
+    for i in xrange(ncodes):
+        c = np.random.randint(0, 2 ** nchannels)
+        for ch in xrange(nchannels):
+            last = (lastCode >> ch) & 1
+            new = (c >> ch) & 1
+            if last != new:
+                events.append((t + ch * 10 + np.random.randint(-jitter, jitter + 1), \
+                        ch, 1 if new > last else -1))
+        lastCode = c
+        t += np.random.randint(700, 1500)
+    events = np.array(events)
+    nnoise = int(len(events) * noise)
+    if nnoise:
+        events = np.vstack((events, np.transpose(np.vstack((np.random.randint(0, t, nnoise), \
+                np.random.randint(0, nchannels, nnoise), np.random.randint(-1, 2, nnoise))))))
+    # make times unique so the sort order is well defined
+    events[:,0] = events[:,0] * 10 + np.random.permutation(len(events)) % 10
+    return events[events[:,0].argsort()]
+
+def test_events_to_codes_slow():
+    np.random.seed(0)
+    for (jitter, noise) in [(0, 0.), (5, 0.1), (50, 0.3), (3, 2.)]:
+        events = make_events(300, jitter = jitter, noise = noise)
+        codes, latencies = pixelclock.events_to_codes(events, 4, 4410)
+        slowCodes, slowLatencies = pixelclock.slow_events_to_codes(events, 4, 4410)
+        slowCodes = np.array(slowCodes)
+        assert codes.shape == slowCodes.shape, "%s != %s" % (codes.shape, slowCodes.shape)
+        assert np.all(codes == slowCodes)
+        for x in xrange(4):
+            for y in xrange(4):
+                assert all(np.sort(latencies[x][y]) == np.sort(slowLatencies[x][y]))
+
+def make_codes(ncodes, ncodevalues = 16, repeats = False):
+    codes = []
+    lastCode = -1
+    for i in xrange(ncodes):
+        r = np.random.randint(0, ncodevalues)
+        while (not repeats) and (r == lastCode):
+            r = np.random.randint(0, ncodevalues)
+        codes.append(r)
+        lastCode = r
+    return codes
+
+def test_match_codes_lookup():
+    np.random.seed(0)
+    for i in xrange(50):
+        mwCodes = make_codes(np.random.randint(20, 200), np.random.choice([3, 16]), \
+                np.random.rand() < 0.3)
+        auCodes = list(mwCodes)
+        # introduce insertions and deletions
+        for e in xrange(np.random.randint(0, 10)):
+            errI = np.random.randint(0, len(auCodes))
+            if np.random.rand() < 0.5:
+                auCodes.insert(errI, np.random.randint(0, 17))
+            else:
+                auCodes.pop(errI)
+        # unmatched codes at the start of either sequence
+        if np.random.rand() < 0.3: auCodes = make_codes(20) + auCodes
+        if np.random.rand() < 0.3: mwCodes = make_codes(20) + mwCodes
+        auTimes = np.arange(len(auCodes)) * 1000 + 1000
+        mwTimes = np.arange(len(mwCodes)) * 1000
+        for minMatch in [1, 3, 10]:
+            for maxErr in [0, 1, 2]:
+                matches = pixelclock.match_codes(auTimes, auCodes, mwTimes, mwCodes, minMatch, maxErr)
+                lookupMatches = pixelclock.lookup_match_codes(auTimes, auCodes, mwTimes, mwCodes, \
+                        minMatch, maxErr)
+                assert matches == lookupMatches, "minMatch %i, maxErr %i: %i != %i" % \
+                        (minMatch, maxErr, len(matches), len(lookupMatches))
+
+def make_transitions(codes, nchannels = 4, samplerate = 44100):
+    """
+    Make synthetic pixel clock transitions (as returned by read_transitions)
+    for each channel from a sequence of codes
+    
+    Returns
+    -------
+    transitions : list
+        (transitions, directions) for each channel
+    times : 1d array
+        Sample time of each code
+    """
+    positions = np.array(pixelclock.get_marker_positions(nchannels, -28, 8.5, \
+            64.54842055808264, 0.2))
+    offsets = np.round((positions / (64.54842055808264 / 0.004)) * samplerate).astype(int)
+    times = np.cumsum(np.random.randint(1000, 1500, len(codes))) + 1000
+    transitions = [([], []) for ch in xrange(nchannels)]
+    lastCode = 0
+    for (c, t) in zip(codes, times):
+        for ch in xrange(nchannels):
+            last = (lastCode >> ch) & 1
+            new = (c >> ch) & 1
+            if last != new:
+                transitions[ch][0].append(t + offsets[ch])
+                transitions[ch][1].append(1 if new > last else -1)
+        lastCode = c
+    return [(np.array(t, dtype=int), np.array(d)) for (t, d) in transitions], times
+
+def make_pixel_clock_session(directory, ncodes = 300, nchannels = 4):
+    """
+    Make a synthetic session directory with (empty) pixel clock audio files
+    and an mworks events file containing the pixel clock codes
+    
+    Returns
+    -------
+    config : cfg.Config
+        Config for the session with the pixel clock cache in directory/cache
+    transitions : dict
+        (transitions, directions) for each audio file (see stub_read_transitions)
+    """
+    codes = [c for c in make_codes(ncodes) if c != 0]
+    channelTransitions, times = make_transitions(codes, nchannels)
+    audioDir = os.path.join(directory, 'Audio Files')
+    os.makedirs(audioDir)
+    transitions = {}
+    for ch in xrange(nchannels):
+        filename = '/'.join((audioDir, 'pixel_clock%i#01.wav' % ch))
+        with open(filename, 'wb') as f:
+            f.write('audio %i' % ch)
+        transitions[filename] = channelTransitions[ch]
+    
+    f = tables.openFile(os.path.join(directory, 'S1.h5'), 'w')
+    g = f.createGroup('/', 'S1_1', '')
+    codec = f.createTable(g, 'codec', Codec)
+    codec.append([(0, '#stimDisplayUpdate')])
+    evs = f.createTable(g, 'events', Event)
+    mwTimes = (times / 44100. + 10.) * 1E6
+    evs.append(zip(np.zeros(len(codes), dtype=int), mwTimes.astype(np.uint64), np.arange(len(codes))))
+    values = f.createVLArray(g, 'values', tables.VLStringAtom())
+    for c in codes:
+        values.append(str([{'name': 'pixel clock', 'bit_code': c}]))
+    f.close()
+    
+    config = cfg.Config()
+    config.set('session', 'dir', directory)
+    config.set('session', 'name', 'S1')
+    config.set('pixel clock', 'scratch', os.path.join(directory, 'cache'))
+    return config, transitions
+
+class stub_read_transitions(object):
+    """
+    Replace pixelclock.read_transitions with a lookup of synthetic transitions
+    (counting the number of files read)
+    """
+    def __init__(self, transitions):
+        self.transitions = transitions
+        self.nread = 0
+    
+    def __call__(self, audioFile, threshold = 0.03, refractory = 44, blockSize = None):
+        self.nread += 1
+        return self.transitions[audioFile]
+    
+    def __enter__(self):
+        self.read_transitions = pixelclock.read_transitions
+        pixelclock.read_transitions = self
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        pixelclock.read_transitions = self.read_transitions
+        return False
+
+def test_cache_key():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        config, transitions = make_pixel_clock_session(tmp)
+        filenames = sorted(transitions.keys())
+        params = (0.03, 44, 441)
+        key = pixelclock.make_cache_key(filenames, params)
+        assert key == pixelclock.make_cache_key(filenames, params)
+        
+        # changed parameters
+        assert key != pixelclock.make_cache_key(filenames, (0.03, 44, 442))
+        assert key != pixelclock.make_cache_key(filenames[:-1], params)
+        
+        # changed input file
+        with open(filenames[1], 'wb') as f:
+            f.write('changed audio')
+        assert key != pixelclock.make_cache_key(filenames, params)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_process_from_config_cache():
+    np.random.seed(1)
+    tmp = tempfile.mkdtemp()
+    try:
+        config, transitions = make_pixel_clock_session(tmp)
+        cacheDir = config.get('pixel clock', 'scratch')
+        with stub_read_transitions(transitions) as reader:
+            matches, speed = pixelclock.process_from_config(config)
+            assert reader.nread == 4
+            assert len(matches) > 250
+            cacheFiles = sorted(os.listdir(cacheDir))
+            assert [f.split('_')[0] for f in cacheFiles] == ['codes', 'matches']
+            
+            # a second call uses the cached matches without re-parsing
+            cachedMatches, cachedSpeed = pixelclock.process_from_config(config)
+            assert reader.nread == 4
+            assert np.all(np.array(cachedMatches) == np.array(matches))
+            assert cachedSpeed == speed
+            
+            # the cached codes are used if the matching parameters change
+            config.set('pixel clock', 'minmatch', '5')
+            codesMatches, codesSpeed = pixelclock.process_from_config(config)
+            assert reader.nread == 4
+            assert len(os.listdir(cacheDir)) == 3
+            assert codesSpeed == speed
+            config.set('pixel clock', 'minmatch', '10')
+            
+            # the cached codes are those of parse
+            codes, offsets, parsedSpeed = pixelclock.parse(sorted(transitions.keys()))
+            assert reader.nread == 8
+            codesFile = [f for f in os.listdir(cacheDir) if f.startswith('codes_')][0]
+            cached = pixelclock.read_cache(cacheDir, 'codes', codesFile[6:-2])
+            assert np.all(cached['codes'] == codes)
+            assert cached['avgSpeed'] == parsedSpeed
+            
+            # corrupt caches are recomputed
+            for f in os.listdir(cacheDir):
+                with open(os.path.join(cacheDir, f), 'wb') as cf:
+                    cf.write('corrupt')
+            recomputed, recomputedSpeed = pixelclock.process_from_config(config)
+            assert reader.nread == 12
+            assert np.all(np.array(recomputed) == np.array(matches))
+            assert recomputedSpeed == speed
+            
+            # stale caches (of changed input files) are not used
+            audioFile = sorted(transitions.keys())[0]
+            with open(audioFile, 'wb') as f:
+                f.write('changed audio')
+            pixelclock.process_from_config(config)
+            assert reader.nread == 16
+            
+            # without caching the files are always parsed
+            config.set('pixel clock', 'cache', 'False')
+            uncached, uncachedSpeed = pixelclock.process_from_config(config)
+            assert reader.nread == 20
+            assert np.all(np.array(uncached) == np.array(matches))
+    finally:
+        shutil.rmtree(tmp)
+
+def test_parse_njobs():
+    np.random.seed(2)
+    tmp = tempfile.mkdtemp()
+    try:
+        config, transitions = make_pixel_clock_session(tmp)
+        audioFiles = sorted(transitions.keys())
+        with stub_read_transitions(transitions):
+            codes, offsets, speed = pixelclock.parse(audioFiles, njobs = 1)
+            assert len(codes) > 250
+            for njobs in [2, 4, 8]:
+                jobCodes, jobOffsets, jobSpeed = pixelclock.parse(audioFiles, njobs = njobs)
+                assert codes.shape == jobCodes.shape
+                assert np.all(codes == jobCodes)
+                assert np.all(np.array(offsets) == np.array(jobOffsets))
+                assert speed == jobSpeed
+    finally:
+        shutil.rmtree(tmp)
@@ -11,7 +11,7 @@ class TimeBase(object):
     """
     Timebase object used to convert times from mworks to audio and back
     """
-    def __init__(self, matches, cull = True, fitline = False):
+    def __init__(self, matches, cull = True, fitline = False, interpolate = False, segments = None):
         """
         Parameters
         ----------
@@ -21,6 +21,14 @@ class TimeBase(object):
             matches[:,1] are mw times
         cull : bool
             Cull offsets (remove large changes in offset)
+        fitline : bool
+            Use a regression line fit to the offsets (see fit_line)
+        interpolate : bool
+            Linearly interpolate offsets between matches (see build_segments)
+            rather than using the offset of the next match
+        segments : 2d array
+            Precomputed segment table (see build_segments) for the given matches.
+            If provided, offsets are interpolated using this table.
         """
         self.matches = np.array(copy.deepcopy(matches))
         self.matches = self.matches[self.matches[:,0].argsort(),:] # sort array by first column
@@ -33,6 +41,14 @@ class TimeBase(object):
         if cull: self.cull_offsets()
 
         if fitline: self.fit_line()
+        
+        self.update_index()
+        
+        self.segments = None
+        if not (segments is None):
+            self.segments = np.array(segments, dtype=float)
+        elif interpolate:
+            self.build_segments()
     
     def cull_offsets(self, thresh = 0.03):
         """
@@ -48,6 +64,7 @@ class TimeBase(object):
         goodIndices = np.where(abs(deltaOffsets) < thresh)[0]+1
         self.offsets = self.offsets[goodIndices]
         self.matches = self.matches[goodIndices]
+        self.update_index()
     
     def fit_line(self):
         """
@@ -58,8 +75,146 @@ class TimeBase(object):
         slope, offset, _, _, _ = linregress(x, y)
         self.offsets = x * slope + offset
     
+    def update_index(self):
+        """
+        Update the search indices used by audio_to_mworks and mworks_to_audio
+        
+        The running maximum of each column is sorted so np.searchsorted finds the
+        first match >= a given time even if the match times are not monotonic
+        """
+        self.audioIndex = np.maximum.accumulate(self.matches[:,0])
+        self.mworksIndex = np.maximum.accumulate(self.matches[:,1])
+    
+    def build_segments(self):
+        """
+        Build the segment table used to linearly interpolate offsets between matches
+        
+        Offsets are interpolated between each pair of consecutive matches and held
+        constant before the first and after the last match. The table can be saved
+        (e.g. next to /TimeMatches) and passed back in as segments to avoid
+        rebuilding it.
+        
+        Returns
+        -------
+        segments : 2d array
+            Segment table (n matches + 1 rows) where:
+                segments[:,0] = audio time at the start of the segment
+                segments[:,1] = offset slope (per audio second)
+                segments[:,2] = offset intercept (at audio time 0)
+                segments[:,3] = mworks time at the start of the segment
+                segments[:,4] = offset slope (per mworks second)
+                segments[:,5] = offset intercept (at mworks time 0)
+            The first row starts at -inf
+        """
+        segments = np.empty((len(self.offsets) + 1, 6))
+        for (i, t) in enumerate((self.matches[:,0], self.matches[:,1])):
+            dt = np.diff(t)
+            do = np.diff(self.offsets)
+            slopes = np.zeros(len(dt))
+            valid = dt != 0 # duplicate times hold the offset constant
+            slopes[valid] = do[valid] / dt[valid]
+            segments[:,i*3] = np.hstack((-np.inf, t))
+            segments[:,i*3+1] = np.hstack((0., slopes, 0.))
+            segments[:,i*3+2] = np.hstack((self.offsets[0], self.offsets[:-1] - slopes * t[:-1], \
+                    self.offsets[-1]))
+        self.segments = segments
+        return segments
+    
+    def interpolate_offsets(self, times, column):
+        """
+        Interpolate offsets using the segment table (see build_segments)
+        
+        Parameters
+        ----------
+        times : float or array
+            Times to look up
+        column : int
+            First segment table column for the time units (0 = audio, 3 = mworks)
+        
+        Returns
+        -------
+        times : ndarray
+            Times (same shape as times)
+        offsets : ndarray
+            Offsets (same shape as times)
+        """
+        times = np.asarray(times, dtype=float)
+        si = np.searchsorted(self.segments[1:,column], times, side='right')
+        return times, self.segments[si,column+1] * times + self.segments[si,column+2]
+    
+    def lookup_offsets(self, index, times, name):
+        """
+        Find the offsets of the first matches >= times
+        
+        Parameters
+        ----------
+        index : 1d array
+            Sorted search index (see update_index)
+        times : float or array
+            Times to look up
+        name : string
+            Name of the conversion (for logging)
+        
+        Returns
+        -------
+        times : ndarray
+            Times (same shape as times)
+        offsets : ndarray
+            Offsets (same shape as times)
+        """
+        times = np.asarray(times, dtype=float)
+        closest = np.searchsorted(index, times, side='left')
+        late = closest >= len(index)
+        nlate = np.sum(late)
+        if nlate:
+            logging.warning("%s matched %i of %i times to last offset" % (name, nlate, times.size))
+            closest = np.where(late, len(index) - 1, closest)
+        return times, self.offsets[closest]
+    
     def audio_to_mworks(self, audio):
         """
+        Convert audio times (in seconds) to mworks times (in seconds)
+        
+        Parameters
+        ----------
+        audio : float or array
+            Audio time(s) (in seconds)
+        
+        Returns
+        -------
+        mw : ndarray
+            MWorks time(s) (in seconds), same shape as audio
+        """
+        if not (self.segments is None):
+            audio, offsets = self.interpolate_offsets(audio, 0)
+        else:
+            audio, offsets = self.lookup_offsets(self.audioIndex, audio, "audio_time_to_mw")
+        return audio - offsets
+    
+    def mworks_to_audio(self, mw):
+        """
+        Convert mworks times (in seconds) to audio times (in seconds)
+        
+        Parameters
+        ----------
+        mw : float or array
+            MWorks time(s) (in seconds)
+        
+        Returns
+        -------
+        audio : ndarray
+            Audio time(s) (in seconds), same shape as mw
+        """
+        if not (self.segments is None):
+            mw, offsets = self.interpolate_offsets(mw, 3)
+        else:
+            mw, offsets = self.lookup_offsets(self.mworksIndex, mw, "mw_time_to_audio")
+        return mw + offsets
+    
+    def slow_audio_to_mworks(self, audio):
+        """
+        Loop based version of audio_to_mworks (used to test and benchmark audio_to_mworks)
+        
         Convert an audio time (in seconds) to mworks time (in seconds)
         
         Parameters
@@ -74,8 +229,10 @@ class TimeBase(object):
             return audio - self.offsets[-1]
         return audio - self.offsets[closest[0]]
     
-    def mworks_to_audio(self, mw):
+    def slow_mworks_to_audio(self, mw):
         """
+        Loop based version of mworks_to_audio (used to test and benchmark mworks_to_audio)
+        
         Convert a mworks time (in seconds) to audio time (in seconds)
         
         Parameters
@@ -176,9 +333,64 @@ def test_timebase_batch():
     unbatch_at = [tb.mworks_to_audio(m) for m in matches[:,1]]
     unbatch_time = time.time()-tic
     
-    print("Batch time = %f, unbatch time = %f" % (batch_time, unbatch_time))
+    tic = time.time()
+    slow_at = tb.slow_mworks_to_audio(matches[:,1])
+    slow_time = time.time()-tic
+    
+    print("MW->Audio: batch time = %f, unbatch time = %f, slow time = %f" % \
+            (batch_time, unbatch_time, slow_time))
     
     assert(np.allclose(np.array(batch_at), np.array(unbatch_at)))
+    assert(np.allclose(np.array(batch_at), np.array(slow_at)))
+    
+    tic = time.time()
+    batch_mw = tb.audio_to_mworks(matches[:,0])
+    batch_time = time.time()-tic
+    
+    tic = time.time()
+    slow_mw = [tb.slow_audio_to_mworks(a) for a in matches[:,0]]
+    slow_time = time.time()-tic
+    
+    print("Audio->MW: batch time = %f, slow time = %f" % (batch_time, slow_time))
+    
+    assert(np.allclose(batch_mw, np.array(slow_mw)))
+    
+    # arbitrary shapes and times past the last match
+    times = np.random.uniform(-10., 110., (50, 20))
+    mws = tb.audio_to_mworks(times)
+    assert mws.shape == times.shape
+    assert(np.allclose(mws.ravel(), [tb.slow_audio_to_mworks(t) for t in times.ravel()]))
+    auds = tb.mworks_to_audio(mws)
+    assert auds.shape == times.shape
+    assert(np.allclose(auds.ravel(), [tb.slow_mworks_to_audio(m) for m in mws.ravel()]))
+
+def test_timebase_interpolate():
+    # mworks clock drifts relative to the audio clock
+    audio = np.linspace(0., 100., 101)
+    mw = audio * 1.0001 + 1000.
+    matches = np.transpose(np.vstack((audio, mw)))
+    
+    tb = TimeBase(matches, interpolate = True)
+    assert tb.segments.shape == (len(tb.matches) + 1, 6)
+    
+    # times between matches are interpolated
+    a = np.linspace(1.5, 99.5, 500) # the first match is culled
+    m = a * 1.0001 + 1000.
+    assert np.allclose(tb.audio_to_mworks(a), m, atol = 1E-9)
+    assert np.allclose(tb.mworks_to_audio(m), a, atol = 1E-9)
+    assert np.allclose(tb.mworks_to_audio(tb.audio_to_mworks(a)), a, atol = 1E-9)
+    
+    # the step function is off by up to the drift between matches
+    step = TimeBase(matches)
+    assert np.max(np.abs(step.audio_to_mworks(a) - m)) > 1E-5
+    
+    # offsets are held constant outside of the matches
+    assert np.allclose(tb.audio_to_mworks([-10., 110.]), [-10. - tb.offsets[0], 110. - tb.offsets[-1]])
+    
+    # precomputed segments give identical results
+    loaded = TimeBase(matches, segments = tb.segments)
+    assert np.all(loaded.audio_to_mworks(a) == tb.audio_to_mworks(a))
+    assert np.all(loaded.mworks_to_audio(m) == tb.mworks_to_audio(m))
 
 if __name__ == "__main__":
     test_timebase_batch()
@@ -121,6 +121,39 @@ def refine_crossings(signal, crossings):
     at the valleys between bumps.
     """
     logging.debug("Refining threshold crossings")
+    crossings = np.asarray(crossings)
+    refined = np.array(crossings, copy=True)
+    if len(crossings) == 0:
+        return refined
+    # direction of each sample-to-sample change, nothing precedes the first sample
+    deltas = np.empty(len(signal))
+    deltas[0] = np.nan
+    deltas[1:] = np.sign(np.diff(signal))
+    # starts of runs of samples that moved the signal in the same direction
+    runStarts = np.hstack((0, np.where(deltas[1:] != deltas[:-1])[0] + 1))
+    starts = runStarts[np.searchsorted(runStarts, crossings, side='right') - 1]
+    # crossings that moved in their own direction refine to the sample before the
+    # start of their run, all others are already at the start of an interval
+    moving = deltas[crossings] == np.sign(signal[crossings])
+    refined[moving] = starts[moving] - 1
+    return refined
+
+def slow_refine_crossings(signal, crossings):
+    """
+    Loop based version of refine_crossings (used to test and benchmark refine_crossings)
+    
+    Parameters
+    ----------
+    signal : 1d array
+        Signal in which to find threshold crossings
+    crossings : 1d array
+        Indicies where the signal crosses the threshold
+    
+    Returns
+    -------
+    refined : 1d array
+        Indicies where the signal began its rise/fall to a threshold crossing
+    """
     refined = np.empty_like(crossings)
     for i in xrange(len(crossings)):
         transition = crossings[i]
@@ -139,3 +172,95 @@ def refine_crossings(signal, crossings):
         #    print i, refined[i], transition
     #logging.debug("Done refining transitions")
     return refined
+
+class BlockCrossingFinder(object):
+    """
+    Find refined threshold crossings (see find_both_threshold_crossings and
+    refine_crossings) in a signal that is read in consecutive blocks.
+    
+    The refractory and refinement state is carried across block edges so the
+    results are identical to processing the whole signal at once.
+    """
+    def __init__(self, threshold, refractory):
+        """
+        Parameters
+        ----------
+        threshold : float
+            Threshold at which to find crossings (test: abs(signal) > threshold)
+        refractory : int
+            Number of sub-threshold points that must be encountered before resetting the trigger
+        """
+        assert threshold >= 0, "Threshold [%f] should be positive" % threshold
+        assert refractory >= 0, "Refractory[%i] must >= 0" % refractory
+        self.threshold = threshold
+        self.refractory = refractory
+        self.nsamples = 0 # number of samples processed so far
+        self.lastSample = None # value of the last sample of the previous block
+        self.lastSupra = None # index of the last supra-threshold sample
+        # index and value of the last sample that did NOT continue a rising (1)
+        # or falling (-1) interval, this is where refinement stops
+        self.lastBreak = {1 : None, -1 : None}
+    
+    def process(self, block):
+        """
+        Process the next block of the signal
+        
+        Parameters
+        ----------
+        block : 1d array
+            Next consecutive block of the signal
+        
+        Returns
+        -------
+        refined : 1d array
+            Indicies (relative to the start of the signal) where the signal began
+            its rise/fall to a threshold crossing
+        values : 1d array
+            Signal values at the refined indices
+        """
+        assert type(block) == np.ndarray, "Block must be a ndarray not %s" % type(block)
+        assert block.ndim == 1, "Block must be 1d not %i" % block.ndim
+        n = len(block)
+        if n == 0:
+            return np.array([], dtype=int), np.array([], dtype=block.dtype)
+        start = self.nsamples
+        
+        # threshold crossings, continuing the refractory period from the previous block
+        st = np.where(np.abs(block) > self.threshold)[0]
+        if len(st):
+            if self.lastSupra is None:
+                gaps = np.hstack((self.refractory + 1, np.diff(st)))
+            else:
+                gaps = np.diff(np.hstack((self.lastSupra - start, st)))
+            crossings = st[gaps > self.refractory]
+            self.lastSupra = st[-1] + start
+        else:
+            crossings = st
+        
+        # direction of each sample-to-sample change, the first sample of the
+        # signal (delta = 0) always stops refinement
+        if self.lastSample is None:
+            deltas = np.hstack((0, np.sign(np.diff(block))))
+        else:
+            deltas = np.sign(np.diff(np.hstack((self.lastSample, block))))
+        
+        refined = np.empty(len(crossings), dtype=int)
+        values = np.empty(len(crossings), dtype=block.dtype)
+        signs = np.sign(block[crossings])
+        for direction in (1, -1):
+            breaks = np.where(deltas != direction)[0]
+            toRefine = np.where(signs == direction)[0]
+            if len(toRefine):
+                bi = np.searchsorted(breaks, crossings[toRefine], side='right') - 1
+                inBlock = bi >= 0
+                refined[toRefine[inBlock]] = breaks[bi[inBlock]] + start
+                values[toRefine[inBlock]] = block[breaks[bi[inBlock]]]
+                if not all(inBlock): # interval started in a previous block
+                    refined[toRefine[~inBlock]] = self.lastBreak[direction][0]
+                    values[toRefine[~inBlock]] = self.lastBreak[direction][1]
+            if len(breaks):
+                self.lastBreak[direction] = (breaks[-1] + start, block[breaks[-1]])
+        
+        self.lastSample = block[-1]
+        self.nsamples += n
+        return refined, values
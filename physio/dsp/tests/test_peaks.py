@@ -34,3 +34,43 @@ def test_threshold_crossings():
     rt = peaks.refine_crossings(i, gi)
     assert all(rt == [ 0, 10, 20, 30, 40, 50, 60, 70, 80, 90])
     return True
+
+def test_block_crossing_finder():
+    np.random.seed(0)
+    t = np.linspace(0., 100., 10001)
+    x = np.sin(t * 0.5 * 2 * np.pi) + np.random.randn(len(t)) * 0.05
+    x[5000:5200] = 0. # flat region
+    
+    gi = peaks.find_both_threshold_crossings(x, 0.3, 10)
+    rt = peaks.refine_crossings(x, gi)
+    
+    for blockSize in [1, 7, 100, 333, 5000, len(x), len(x) * 2]:
+        finder = peaks.BlockCrossingFinder(0.3, 10)
+        bts = []
+        bvs = []
+        for i in xrange(0, len(x), blockSize):
+            bt, bv = finder.process(x[i:i+blockSize])
+            bts.append(bt)
+            bvs.append(bv)
+        bt = np.hstack(bts)
+        bv = np.hstack(bvs)
+        assert len(bt) == len(rt), "blockSize %i: %i != %i" % (blockSize, len(bt), len(rt))
+        assert all(bt == rt), "blockSize %i" % blockSize
+        assert all(bv == x[rt]), "blockSize %i" % blockSize
+
+def test_refine_crossings():
+    np.random.seed(0)
+    t = np.linspace(0., 100., 10001)
+    x = np.sin(t * 0.5 * 2 * np.pi) + np.random.randn(len(t)) * 0.05
+    x[5000:5200] = 0. # flat region
+    
+    gi = peaks.find_both_threshold_crossings(x, 0.3, 10)
+    assert all(peaks.refine_crossings(x, gi) == peaks.slow_refine_crossings(x, gi))
+    
+    # arbitrary (unsorted, sub-threshold and edge) crossings
+    gi = np.random.randint(0, len(x), 1000)
+    gi[:3] = [0, 1, len(x) - 1]
+    gi[3:6] = [5000, 5001, 5199]
+    assert all(peaks.refine_crossings(x, gi) == peaks.slow_refine_crossings(x, gi))
+    
+    assert len(peaks.refine_crossings(x, np.array([], dtype=int))) == 0
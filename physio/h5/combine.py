@@ -33,8 +33,169 @@ def find_channel(filepath, regex):
     except:
         raise ValueError("Invalid (non-int) channel found for %s : %s" % (filepath, g[0]))
 
-def combine(inputFiles, outputFilename, channelRegex = r'[a-z,A-Z]+_([0-9]+)\#*'):
+def write_cluster_index(h5file, spikeTable, channel):
     """
+    Write a per-cluster sorted spike index for a channel spike table to /ClusterIndex/ch<channel>
+    
+    The index contains:
+        clusters : sorted unique clusters
+        bounds : start and end (bounds[i], bounds[i+1]) of the spikes for clusters[i]
+        times : spike times sorted by cluster and time (so each cluster is contiguous)
+        rows : spike table row for each time
+        counts : number of spikes in each cluster (0 to max cluster)
+    
+    The number of clusters (max cluster + 1) is stored in the NCLUSTERS
+    attribute of spikeTable
+    
+    Parameters
+    ----------
+    h5file : h5file
+        Open (writable) hdf5 file containing spikeTable
+    spikeTable : Table
+        Spike table (with clu and time columns)
+    channel : int
+        Channel of the spike table
+    """
+    if not ('/ClusterIndex' in h5file):
+        h5file.createGroup('/', 'ClusterIndex', 'Per-cluster sorted spike times')
+    if ('/ClusterIndex/ch%i' % channel) in h5file:
+        h5file.removeNode('/ClusterIndex', 'ch%i' % channel, recursive = True)
+    clus = spikeTable.col('clu')
+    times = spikeTable.col('time')
+    order = np.lexsort((times, clus))
+    clusters, starts = np.unique(clus[order], return_index = True)
+    index = h5file.createGroup('/ClusterIndex', 'ch%i' % channel, 'Channel %i cluster index' % channel)
+    h5file.createArray(index, 'clusters', clusters.astype(np.int64), 'Clusters')
+    h5file.createArray(index, 'bounds', np.hstack((starts, len(order))).astype(np.int64), 'Cluster bounds')
+    h5file.createArray(index, 'times', times[order].astype(np.int64), 'Spike times')
+    h5file.createArray(index, 'rows', order.astype(np.int64), 'Spike table rows')
+    counts = np.bincount(clus[clus >= 0]) if np.any(clus >= 0) else np.zeros(0, dtype=int)
+    h5file.createArray(index, 'counts', counts.astype(np.int64), 'Cluster spike counts')
+    spikeTable.attrs.NCLUSTERS = len(counts)
+    h5file.flush()
+
+def get_cluster_rows(h5file, channel, cluster, sampleRange = None):
+    """
+    Find spikes using the per-cluster sorted spike index (see write_cluster_index)
+    
+    Parameters
+    ----------
+    h5file : h5file
+        Open hdf5 file containing /ClusterIndex
+    channel : int
+        Channel
+    cluster : int
+        Cluster
+    sampleRange : 2 tuple of ints
+        Range (in samples) over which to find spikes: (start, end)
+    
+    Returns
+    -------
+    times : 1d array
+        Spike times (in samples)
+    rows : 1d array
+        Spike table rows of the spikes
+    
+    Raises
+    ------
+    LookupError
+        If the file does not contain an index for this channel
+    """
+    name = '/ClusterIndex/ch%i' % channel
+    if not (name in h5file):
+        raise LookupError("No cluster index found for channel %i" % channel)
+    index = h5file.getNode(name)
+    clusters = index.clusters.read()
+    ci = np.searchsorted(clusters, cluster)
+    if (ci == len(clusters)) or (clusters[ci] != cluster):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    start, end = index.bounds[ci:ci+2]
+    times = index.times[start:end]
+    if sampleRange is None:
+        lo, hi = 0, len(times)
+    else:
+        lo = np.searchsorted(times, sampleRange[0], side = 'right')
+        hi = np.searchsorted(times, sampleRange[1], side = 'left')
+        hi = max(lo, hi)
+    return times[lo:hi], index.rows[start+lo:start+hi]
+
+def combine(inputFiles, outputFilename, channelRegex = r'[a-z,A-Z]+_([0-9]+)\#*', \
+        complevel = 0, complib = 'zlib', blockSize = 100000):
+    """
+    Parameters
+    ----------
+    inputFiles : list of strings
+    outputFilename :
+    channelRegex :
+    complevel : int
+        Compression level (0 = no compression) of the spike tables
+    complib : string
+        Compression library (see tables.Filters)
+    blockSize : int
+        Number of spikes to copy at a time
+    """
+    assert np.iterable(inputFiles), "inputFiles[%s] must be iterable" % str(inputFiles)
+    
+    # get channels
+    channels = [find_channel(f, channelRegex) for f in inputFiles]
+    
+    filters = None
+    if complevel > 0:
+        filters = tables.Filters(complevel = complevel, complib = complib)
+    
+    # make outputfile
+    outputFile = tables.openFile(outputFilename, 'w')
+    
+    # setup output file
+    logging.debug("creating output file groups")
+    channelsgroup = outputFile.createGroup('/', 'Channels', 'Channel data')
+    clusteringgroup = outputFile.createGroup('/', 'Clustering', 'Clustering info')
+    outputFile.flush()
+    
+    # add each input file
+    logging.debug("processing input files")
+    for (ch, f) in zip(channels, inputFiles):
+        logging.debug("opening: %s" % f)
+        infile = tables.openFile(f,'r')
+        
+        logging.debug("copying spike table")
+        # SpikeTable/<wave/time/clu>
+        spiketable = utils.copy_table(outputFile, infile.root.SpikeTable, channelsgroup, \
+                'ch%i' % ch, filters, blockSize)
+        outputFile.flush()
+        
+        logging.debug("indexing clusters")
+        write_cluster_index(outputFile, spiketable, ch)
+        
+        logging.debug("copying clustering results")
+        if '/Clustering' in infile:
+            cig = outputFile.createGroup(clusteringgroup, 'ch%i' % ch, 'Channel %i clustering info' % ch)
+            for array_node in infile.root.Clustering:
+                outputFile.createArray(cig, array_node.name, np.array(array_node))
+        # SPC/<cdata/ctree>
+        #spcg = outputFile.createGroup(spcgroup, 'ch%i' % ch, 'Channel %i SPC results' % ch)
+        #if '/SPC/cdata' in infile and '/SPC/ctree' in infile:
+        #    infile.createArray(spcg, 'cdata', np.array(infile.root.SPC.cdata))
+        #    infile.createArray(spcg, 'ctree', np.array(infile.root.SPC.ctree))
+        outputFile.flush()
+        
+        # meta data
+        logging.debug("adding metadata")
+        # original file
+        spiketable.attrs.ORIGFILE = f
+        
+        logging.debug("closing: %s" % f)
+        infile.close()
+    
+    # close output file
+    logging.debug("closing: %s" % outputFilename)
+    outputFile.flush()
+    outputFile.close()
+
+def slow_combine(inputFiles, outputFilename, channelRegex = r'[a-z,A-Z]+_([0-9]+)\#*'):
+    """
+    Row by row version of combine (used to test and benchmark combine)
+    
     Parameters
     ----------
     inputFiles : list of strings
@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 
-import ast, logging, re
+import ast, json, logging, os, re
 from optparse import OptionParser
 
 import numpy as np
 import tables
 
 from .. import utils
+from .utils import copy_table
+
+# mistimed events and the events group attribute containing their time offset (in microseconds)
+TIME_OFFSET_EVENTS = {'CNC_OFFSET': ['path_origin_x', 'path_origin_y', 'path_origin_z', \
+                            'path_slope_x', 'path_slope_y', 'path_slope_z', 'path_depth'], \
+                    'EYETRACKER_OFFSET': ['cobra_timestamp', 'pupil_radius', 'gaze_h', 'gaze_v']}
+
+# numeric events that are decoded and stored as arrays (see write_decoded_values)
+DECODED_EVENTS = ['path_origin_x', 'path_origin_y', 'path_origin_z', \
+        'path_slope_x', 'path_slope_y', 'path_slope_z', 'path_depth', \
+        'cobra_timestamp', 'pupil_radius', 'gaze_h', 'gaze_v']
 
 def find_events_group(eventsFile):#, regex = r'[a-z,A-Z]+[0-9]_[0-9]+'):
     """
@@ -21,18 +32,189 @@ def find_events_group(eventsFile):#, regex = r'[a-z,A-Z]+[0-9]_[0-9]+'):
     Returns
     -------
     eventsgroup : hdf5 node
-        Group within eventsFile that contains session events
+        Group within eventsFile (or an externally linked file) that contains session events
     """
     # for k in eventsFile.root._v_children.keys():
     #     if re.match(regex, k):
     #         return eventsFile.getNode('/%s' % k)
     for node in eventsFile:
+        if isinstance(node, tables.link.ExternalLink):
+            # events shared between files (see link_events_file)
+            node = open_external_link(eventsFile, node)
         if type(node) != tables.group.Group: continue
         if not ('codec' in node): continue
         if not ('values' in node): continue
         if not ('events' in node): continue
         return node
 
+EVENTS_STORES = {}
+
+def open_external_link(h5file, link):
+    """
+    Open the target of an external link (read only)
+    
+    Linked files are kept open (in EVENTS_STORES) while h5file is open and
+    closed when h5file is closed or released (see release_events), when
+    they are modified or when closed with close_events_store.
+    
+    Parameters
+    ----------
+    h5file : h5file
+        File containing the link
+    link : ExternalLink
+        Link to a node in another file, relative filenames are relative
+        to the directory of h5file
+    
+    Returns
+    -------
+    node : hdf5 node
+        Node in the linked file
+    """
+    filename, path = link.target.split(':', 1)
+    if not os.path.isabs(filename):
+        filename = os.path.join(os.path.dirname(os.path.abspath(h5file.filename)), filename)
+    filename = os.path.abspath(filename)
+    mtime = os.path.getmtime(filename)
+    entry = EVENTS_STORES.get(id(h5file), None)
+    if (entry is None) or (entry[0] is not h5file):
+        # close the stores of closed files
+        for (k, e) in EVENTS_STORES.items():
+            if not e[0].isopen: close_linked_stores(e[0])
+        entry = (h5file, {})
+        EVENTS_STORES[id(h5file)] = entry
+    stores = entry[1]
+    if not ((filename in stores) and stores[filename][0].isopen and \
+            (stores[filename][1] == mtime)):
+        if filename in stores:
+            release_events(stores[filename][0])
+            if stores[filename][0].isopen: stores[filename][0].close()
+        stores[filename] = (tables.openFile(filename, 'r'), mtime)
+    return stores[filename][0].getNode(path)
+
+def close_linked_stores(h5file):
+    """
+    Close the events stores opened through links in h5file (see open_external_link)
+    """
+    entry = EVENTS_STORES.get(id(h5file), None)
+    if (entry is None) or (entry[0] is not h5file): return
+    for (store, mtime) in entry[1].values():
+        release_events(store)
+        if store.isopen: store.close()
+    del EVENTS_STORES[id(h5file)]
+
+def close_events_store(filename):
+    """
+    Close any open (linked) handles to an events store (see open_external_link)
+    """
+    filename = os.path.abspath(filename)
+    for (h5file, stores) in EVENTS_STORES.values():
+        if not (filename in stores): continue
+        store = stores.pop(filename)[0]
+        clear_events_handle(h5file) # the handle refers to the closed store
+        release_events(store)
+        if store.isopen: store.close()
+
+def link_events_file(storeFilename, dataFilename):
+    """
+    Link the events in one hdf5 file (events store) from another (data file)
+    rather than copying them (see add_events_file)
+    
+    Parameters
+    ----------
+    storeFilename : string
+        Filename of file containing session events. This can be the mworks
+        events file or a file written with add_events_file
+    dataFilename : string
+        Filename of file containing other session data (spike events, etc...).
+        /Events in this file will be an external link to the session events
+        using a path relative to this file.
+    """
+    with utils.H5Maker(storeFilename, 'r') as storeFile:
+        path = find_events_group(storeFile)._v_pathname
+    target = os.path.relpath(os.path.abspath(storeFilename), \
+            os.path.dirname(os.path.abspath(dataFilename)))
+    with utils.H5Maker(dataFilename, 'a') as dataFile:
+        release_events(dataFile)
+        if 'Events' in dataFile.root._v_children.keys():
+            logging.debug("File contains /Events, removing...")
+            dataFile.removeNode('/Events', recursive = True)
+        logging.debug("Linking /Events to %s:%s" % (target, path))
+        dataFile.createExternalLink('/', 'Events', '%s:%s' % (target, path))
+
+class EventsHandle(object):
+    """
+    Events group and codec of an open hdf5 file (see get_events_handle)
+    """
+    def __init__(self, h5file):
+        """
+        Parameters
+        ----------
+        h5file : h5file
+            Open hdf5 file containing (or linking to) session events
+        """
+        self.file = h5file
+        self.group = find_events_group(h5file)
+        if self.group is None: utils.error('No events found in %s' % h5file.filename)
+        self.codec = dict(self.group.codec.read())
+        # names -> codes, names that occur more than once use the first code (as codec.values().index)
+        self.reverseCodec = {}
+        for (code, name) in self.codec.iteritems():
+            self.reverseCodec.setdefault(name, code)
+    
+    def lookup(self, code):
+        """
+        Parameters
+        ----------
+        code : string or int
+            Event code or name
+        
+        Returns
+        -------
+        code : int
+            Event code
+        name : string
+            Event name
+        """
+        if type(code) != int:
+            if not (code in self.reverseCodec):
+                utils.error('code[%s] not found in codec: %s' % (code, str(self.codec)))
+            return self.reverseCodec[code], code
+        return code, self.codec[code]
+
+EVENTS_HANDLES = {}
+
+def get_events_handle(h5file):
+    """
+    Get the events handle (see EventsHandle) for an open hdf5 file so the events
+    group is only found (and the codec read) once per file
+    
+    Parameters
+    ----------
+    h5file : h5file
+        Open hdf5 file containing (or linking to) session events
+    
+    Returns
+    -------
+    handle : EventsHandle
+        Events handle for h5file
+    """
+    handle = EVENTS_HANDLES.get(id(h5file), None)
+    if (handle is None) or (handle.file is not h5file) or (not h5file.isopen):
+        # remove handles of closed files
+        for (k, h) in EVENTS_HANDLES.items():
+            if not h.file.isopen: del EVENTS_HANDLES[k]
+        handle = EventsHandle(h5file)
+        EVENTS_HANDLES[id(h5file)] = handle
+    return handle
+
+def clear_events_handle(h5file):
+    """
+    Remove the events handle of a file (if the events in the file are changed)
+    """
+    handle = EVENTS_HANDLES.get(id(h5file), None)
+    if (handle is not None) and (handle.file is h5file):
+        del EVENTS_HANDLES[id(h5file)]
+
 def get_codec(eventsFile):
     """
     Get the session events codec from an hdf5 results or events file
@@ -47,9 +229,8 @@ def get_codec(eventsFile):
     codec : dict
         Session events codec
     """
-    with utils.H5Maker(eventsFile,'r') as f:
-        g = find_events_group(f)
-        codec = dict(g.codec.read())
+    with EventsFileMaker(eventsFile,'r') as f:
+        codec = dict(get_events_handle(f).codec)
     return codec
 
 def parse_value(value):
@@ -61,30 +242,247 @@ def parse_value(value):
         return np.nan
     return ast.literal_eval(value)
 
+def to_str(value):
+    """
+    Convert unicode strings (as returned by json) in a decoded value to str
+    """
+    if type(value) is unicode:
+        return str(value)
+    if type(value) is list:
+        return [to_str(v) for v in value]
+    if type(value) is dict:
+        return dict([(str(k), to_str(v)) for (k, v) in value.iteritems()])
+    return value
+
+def fast_parse_value(value):
+    """
+    Parse an event value using the (C accelerated) json parser for the common
+    dict/list/number values, falling back to parse_value for other values
+    (e.g. values with single quoted strings or python literals)
+    """
+    if (value == '[null]') or ("'" in value):
+        return parse_value(value)
+    try:
+        return to_str(json.loads(value))
+    except ValueError:
+        return parse_value(value)
+
+class ValueCache(object):
+    """
+    Decoded event values for one events file
+
+    Each distinct value string is parsed only once and decoded values are
+    cached by their index in the values VLArray. Decoded values are shared
+    between calls so should not be modified.
+    """
+    def __init__(self, parser = fast_parse_value):
+        """
+        Parameters
+        ----------
+        parser : function
+            Function used to parse value strings (see parse_value and fast_parse_value)
+        """
+        self.parser = parser
+        self.byIndex = {}
+        self.byString = {}
+    
+    def decode(self, values, indices):
+        """
+        Parameters
+        ----------
+        values : VLArray
+            Event values (as strings)
+        indices : list
+            Indices of the values to decode
+        
+        Returns
+        -------
+        decoded : list
+            Decoded values
+        """
+        byIndex = self.byIndex
+        missing = sorted(set([i for i in indices if not (i in byIndex)]))
+        if len(missing) == 0:
+            return [byIndex[i] for i in indices]
+        if (len(missing) * 4) >= (missing[-1] - missing[0]):
+            # read a block of values rather than one value at a time
+            strings = values.read(missing[0], missing[-1] + 1)
+            strings = [strings[i - missing[0]] for i in missing]
+        else:
+            strings = [values[i] for i in missing]
+        for (i, s) in zip(missing, strings):
+            if not (s in self.byString):
+                self.byString[s] = self.parser(s)
+            byIndex[i] = self.byString[s]
+        return [byIndex[i] for i in indices]
+
+VALUE_CACHES = {}
+
+def get_value_cache(h5file):
+    """
+    Get the value cache (see ValueCache) for an open hdf5 file
+    
+    Caches are kept per open file (like events handles, see get_events_handle)
+    and dropped when the file is closed or released (see release_events)
+    """
+    entry = VALUE_CACHES.get(id(h5file), None)
+    if (entry is None) or (entry[0] is not h5file) or (not h5file.isopen):
+        # remove caches of closed files
+        for (k, e) in VALUE_CACHES.items():
+            if not e[0].isopen: del VALUE_CACHES[k]
+        entry = (h5file, ValueCache())
+        VALUE_CACHES[id(h5file)] = entry
+    return entry[1]
+
+class EventsFileMaker(utils.H5Maker):
+    """
+    utils.H5Maker that releases the events handle and value cache
+    (see release_events) of files it opened when they are closed
+    """
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self._wasFile:
+            release_events(self._file)
+        return utils.H5Maker.__exit__(self, exc_type, exc_value, traceback)
+
+def release_events(h5file):
+    """
+    Drop the events handle and value cache of a file and close the events
+    stores it links to (if the file is being closed or the events in the
+    file are changed)
+    """
+    close_linked_stores(h5file)
+    clear_events_handle(h5file)
+    entry = VALUE_CACHES.get(id(h5file), None)
+    if (entry is not None) and (entry[0] is h5file):
+        del VALUE_CACHES[id(h5file)]
+
+def get_time_offsets(eventsGroup):
+    """
+    Get the time offsets of mistimed events (see TIME_OFFSET_EVENTS)
+    
+    Parameters
+    ----------
+    eventsGroup : hdf5 node
+        Group containing session events
+    
+    Returns
+    -------
+    offsets : dict
+        Time offsets (in microseconds) keyed by event name
+    """
+    offsets = {}
+    attrs = eventsGroup._v_attrs
+    for (attr, names) in TIME_OFFSET_EVENTS.iteritems():
+        if attr in attrs._v_attrnames:
+            for name in names:
+                offsets[name] = attrs[attr]
+    return offsets
+
 def are_event_times_bad(h5file, event_name):
     """ Check if this hdf5 suffers from mistimed events """
-    if (event_name in ['path_origin_x', 'path_origin_y', 'path_origin_z',\
-            'path_slope_x', 'path_slope_y', 'path_slope_z', 'path_depth']) and \
-            ('CNC_OFFSET' in h5file.root.Events._v_attrs._v_attrnames):
-        return True
-    elif (event_name in ['cobra_timestamp', 'pupil_radius', 'gaze_h', 'gaze_v']) and \
-            ('EYETRACKER_OFFSET' in h5file.root.Events._v_attrs._v_attrnames):
-        return True
-    else:
-        return False
+    return event_name in get_time_offsets(get_events_handle(h5file).group)
 
 def get_event_time_offset(h5file, event_name):
-    if (event_name in ['path_origin_x', 'path_origin_y', 'path_origin_z',\
-            'path_slope_x', 'path_slope_y', 'path_slope_z', 'path_depth']) and \
-            ('CNC_OFFSET' in h5file.root.Events._v_attrs._v_attrnames):
-        return h5file.root.Events._v_attrs['CNC_OFFSET']
-    elif (event_name in ['cobra_timestamp', 'pupil_radius', 'gaze_h', 'gaze_v']) and \
-            ('EYETRACKER_OFFSET' in h5file.root.Events._v_attrs._v_attrnames):
-        return h5file.root.Events._v_attrs['EYETRACKER_OFFSET']
+    offsets = get_time_offsets(get_events_handle(h5file).group)
+    if event_name in offsets:
+        return offsets[event_name]
     else:
         logging.warning("Attempted to get offset for event(%s) none was found" % event_name)
         return 0
 
+def write_events_index(h5file, eventsGroup):
+    """
+    Write a per-code sorted time index for the session events to eventsGroup/index
+    
+    The index contains (in eventsGroup/index):
+        codes : sorted unique event codes
+        bounds : start and end (bounds[i], bounds[i+1]) of the events for codes[i]
+        times : event times sorted by code and time (so each code is contiguous)
+        indices : value indices for each time
+    
+    Times of mistimed events (see get_time_offsets) are corrected and the
+    applied offsets are stored (keyed by code) in the TIME_OFFSETS attribute
+    
+    Parameters
+    ----------
+    h5file : h5file
+        Open (writable) hdf5 file containing eventsGroup
+    eventsGroup : hdf5 node
+        Group containing session events (see find_events_group)
+    """
+    if 'index' in eventsGroup:
+        h5file.removeNode(eventsGroup, 'index', recursive = True)
+    events = eventsGroup.events.read()
+    if len(events) == 0:
+        logging.debug("No events found, not writing events index")
+        return
+    times = events['time'].astype(np.int64)
+    
+    # correct mistimed events
+    codec = dict(eventsGroup.codec.read())
+    appliedOffsets = {}
+    for (name, offset) in get_time_offsets(eventsGroup).iteritems():
+        for code in [c for (c, n) in codec.iteritems() if n == name]:
+            offset = int(np.round(offset))
+            times[events['code'] == code] -= offset
+            appliedOffsets[int(code)] = offset
+    
+    order = np.lexsort((times, events['code']))
+    codes, starts = np.unique(events['code'][order], return_index = True)
+    index = h5file.createGroup(eventsGroup, 'index', 'Per-code sorted event times')
+    h5file.createArray(index, 'codes', codes, 'Event codes')
+    h5file.createArray(index, 'bounds', np.hstack((starts, len(order))), 'Code bounds')
+    h5file.createArray(index, 'times', times[order], 'Event times')
+    h5file.createArray(index, 'indices', events['index'][order], 'Value indices')
+    index._v_attrs.TIME_OFFSETS = appliedOffsets
+    h5file.flush()
+
+def get_indexed_events(eventsGroup, code, timeRange = None, offset = 0):
+    """
+    Find events using the per-code sorted time index (see write_events_index)
+    
+    Parameters
+    ----------
+    eventsGroup : hdf5 node
+        Group containing session events and index
+    code : int
+        Event code
+    timeRange : 2 tuple of ints
+        Range (in mworks time in microseconds) over which to find events: (start, end]
+    offset : int
+        Time offset (in microseconds) to subtract from the event times (see get_event_time_offset).
+        Offsets already applied to the index (see write_events_index) are not subtracted again.
+    
+    Returns
+    -------
+    times : 1d array
+        Event times (in mworks time in microseconds)
+    indices : 1d array
+        Value indices of the events
+    decoded : 1d array or None
+        Decoded event values (see write_decoded_values) or None if the
+        values for this code were not decoded
+    """
+    index = eventsGroup.index
+    codes = index.codes.read()
+    ci = np.searchsorted(codes, code)
+    if (ci == len(codes)) or (codes[ci] != code):
+        return np.array([], dtype=np.int64), np.array([], dtype=int), None
+    start, end = index.bounds[ci:ci+2]
+    times = index.times[start:end].astype(np.int64)
+    if 'TIME_OFFSETS' in index._v_attrs._v_attrnames:
+        offset -= index._v_attrs.TIME_OFFSETS.get(int(code), 0)
+    if offset != 0:
+        times = times - offset
+    if timeRange is None:
+        lo, hi = 0, len(times)
+    else:
+        lo, hi = np.searchsorted(times, timeRange, side = 'right')
+    decoded = None
+    if ('decoded' in eventsGroup) and (('c%i' % code) in eventsGroup.decoded):
+        decoded = getattr(eventsGroup.decoded, 'c%i' % code)[lo:hi]
+    return times[lo:hi], index.indices[start+lo:start+hi], decoded
+
 def get_events(eventsFile, code, timeRange = None):
     """
     Parameters
@@ -101,26 +499,41 @@ def get_events(eventsFile, code, timeRange = None):
     times : list
         List of event times (in mworks times in second)
     values : list
-        List of event values (processed with parse_value)
+        List of event values (processed with fast_parse_value and cached, see ValueCache).
+        Values are shared with later calls on the same open file so should
+        not be modified (copy them first).
+    
+    Notes
+    -----
+    Events are found using the per-code time index (see write_events_index)
+    and if the file has no index, by searching the events table.
     """
     # f = tables.openFile(eventsFilename,'r')
-    with utils.H5Maker(eventsFile,'r') as f:
-        g = find_events_group(f)
+    with EventsFileMaker(eventsFile,'r') as f:
+        handle = get_events_handle(f)
+        g = handle.group
         
         # lookup code if it is not an int
-        if type(code) != int:
-            event_name = code
-            codec = dict(g.codec.read())
-            if not (code in codec.values()): utils.error('code[%s] not found in codec: %s' % (code, str(codec)))
-            code = codec.keys()[codec.values().index(code)]
-        else:
-            codec = dict(g.codec.read())
-            event_name = codec[code]
+        code, event_name = handle.lookup(code)
         
-        if are_event_times_bad(f, event_name):
+        if 'index' in g:
+            offset = 0
+            if are_event_times_bad(f, event_name):
+                offset = get_event_time_offset(f, event_name)
+            if not (timeRange is None):
+                timeRange = [int(timeRange[0] * 1E6), int(timeRange[1] * 1E6)]
+            times, indices, decoded = get_indexed_events(g, code, timeRange, offset)
+            if len(times) == 0: return np.array([]), []
+            times = times.astype(float) / float(1E6)
+            if decoded is None:
+                values = get_value_cache(g._v_file).decode(g.values, indices)
+            else:
+                values = decoded.tolist()
+            return times, values
+        elif are_event_times_bad(f, event_name):
             # because some conduit events were mistimed I can't just filter by time
             # instead, I need to get all the times, potentially fix them and then throw out bad times
-            evs = [(int(r['time']),g.values[r['index']]) for r in g.events.where('code == %i' % code)]
+            evs = [(int(r['time']),r['index']) for r in g.events.where('code == %i' % code)]
             if len(evs) != 0:
                 offset = get_event_time_offset(f, event_name)
                 if offset != 0:
@@ -132,7 +545,7 @@ def get_events(eventsFile, code, timeRange = None):
                     evs = [ev for ev in evs if ((ev[0] > timeRange[0]) and (ev[0] <= timeRange[1]))]
         else:
             if timeRange is None:
-                evs = [(int(r['time']),g.values[r['index']]) for r in g.events.where('code == %i' % code)]
+                evs = [(int(r['time']),r['index']) for r in g.events.where('code == %i' % code)]
             else:
                 # convert timeRange to microseconds
                 timeRange = list(timeRange)
@@ -142,24 +555,162 @@ def get_events(eventsFile, code, timeRange = None):
                 assert np.iterable(timeRange), "timeRange[%s] must be iterable" % str(timeRange)
                 assert len(timeRange) == 2, "timeRange length[%i] must be 2" % len(timeRange)
                 assert type(timeRange[0]) == int, "timeRange[0] type[%s] must be int" % type(timeRange[0])
-                evs = [(int(r['time']),g.values[r['index']]) for r in g.events.where('code == %i' % code) if \
+                evs = [(int(r['time']),r['index']) for r in g.events.where('code == %i' % code) if \
                             int(r['time']) > timeRange[0] and int(r['time']) <= timeRange[1]]
+        
+        if len(evs) == 0: return np.array([]), []
+        # vs = evs[:,1]
+        # f.close()
+        
+        #times = np.array(evs[:,0],dtype=float) / float(1E6)
+        # times = evs[:,0].astype(float) / float(1E6)
+        times = np.array([int(ev[0]) for ev in evs], dtype = float) / float(1E6)
+        values = get_value_cache(g._v_file).decode(g.values, [ev[1] for ev in evs])
     
-    if len(evs) == 0: return np.array([]), []
-    # vs = evs[:,1]
-    # f.close()
+    return times, values
+
+def write_decoded_values(h5file, eventsGroup, names = DECODED_EVENTS):
+    """
+    Write decoded values of numeric events as arrays (one per code) to eventsGroup/decoded
     
-    #times = np.array(evs[:,0],dtype=float) / float(1E6)
-    # times = evs[:,0].astype(float) / float(1E6)
-    times = np.array([int(ev[0]) for ev in evs], dtype = float) / float(1E6)
-    values = [parse_value(ev[1]) for ev in evs]
+    Each array (eventsGroup/decoded/c<code>) is aligned with the events of that code in
+    the events index (see write_events_index). Events with any non-numeric value are
+    not written.
     
-    return times, values
+    Parameters
+    ----------
+    h5file : h5file
+        Open (writable) hdf5 file containing eventsGroup
+    eventsGroup : hdf5 node
+        Group containing session events and index
+    names : list
+        Names of events to decode
+    """
+    if 'decoded' in eventsGroup:
+        h5file.removeNode(eventsGroup, 'decoded', recursive = True)
+    if not ('index' in eventsGroup):
+        logging.debug("No events index found, not writing decoded values")
+        return
+    codec = dict(eventsGroup.codec.read())
+    codes = eventsGroup.index.codes.read()
+    bounds = eventsGroup.index.bounds.read()
+    cache = ValueCache()
+    decoded = None
+    for (code, name) in codec.iteritems():
+        if not (name in names): continue
+        ci = np.searchsorted(codes, code)
+        if (ci == len(codes)) or (codes[ci] != code): continue
+        indices = eventsGroup.index.indices[bounds[ci]:bounds[ci+1]]
+        values = cache.decode(eventsGroup.values, indices)
+        types = set([type(v) for v in values])
+        if not types.issubset(set([int, long, float, bool])):
+            logging.debug("Not writing decoded values for non-numeric event %s" % name)
+            continue
+        if decoded is None:
+            decoded = h5file.createGroup(eventsGroup, 'decoded', 'Decoded event values')
+        dtype = float if (float in types) else int
+        h5file.createArray(decoded, 'c%i' % code, np.array(values, dtype=dtype), name)
+    h5file.flush()
 
-def add_events_file(eventsFilename, dataFilename):
+def copy_values(h5file, values, group, name, filters = None, blockSize = 100000):
+    """
+    Copy a VLArray of strings to another file reading blocks of values
+    
+    Parameters
+    ----------
+    h5file : h5file
+        Open (writable) hdf5 file to copy the values to
+    values : VLArray
+        Values to copy
+    group : hdf5 node
+        Group (in h5file) to copy the values to
+    name : string
+        Name of the new VLArray
+    filters : tables.Filters
+        Filters (compression) for the new VLArray
+    blockSize : int
+        Number of values to read at a time
+    
+    Returns
+    -------
+    valuesOut : VLArray
+        New VLArray
+    """
+    # estimate the size from the first block so the chunk size is appropriate
+    nvalues = values.nrows
+    sample = values.read(0, min(blockSize, nvalues))
+    meanSize = np.mean([len(v) for v in sample]) if len(sample) else 1.
+    expectedSize = max(nvalues * meanSize / 1048576., 0.0001)
+    valuesOut = h5file.createVLArray(group, name, tables.VLStringAtom(), values.title, \
+            filters = filters, expectedsizeinMB = expectedSize)
+    for start in xrange(0, nvalues, blockSize):
+        if start != 0:
+            sample = values.read(start, min(start + blockSize, nvalues))
+        for v in sample:
+            valuesOut.append(v)
+    return valuesOut
+
+def add_events_file(eventsFilename, dataFilename, complevel = 0, complib = 'zlib', blockSize = 100000):
     """
     Copy events from one hdf5 file (events file) to another (data file)
     
+    Parameters
+    ----------
+    eventFilename : string or h5file
+         Filename or file (used with utils.H5Maker) containing session events
+    dataFilename : string
+         Filename or file (used with utils.H5Maker) containing other session data (spike events, etc...)
+    complevel : int
+        Compression level (0 = no compression) of the copied events
+    complib : string
+        Compression library (see tables.Filters)
+    blockSize : int
+        Number of events to copy at a time
+    """
+    filters = None
+    if complevel > 0:
+        filters = tables.Filters(complevel = complevel, complib = complib)
+    if type(dataFilename) is str:
+        close_events_store(dataFilename) # this file may be a (read only) linked store
+    with utils.H5Maker(eventsFilename, 'r') as eventsFile:
+        with utils.H5Maker(dataFilename, 'a') as dataFile:
+            release_events(dataFile)
+            eventsGroup = find_events_group(eventsFile)
+            
+            # check if events group exists, if so, delete it
+            if 'Events' in dataFile.root._v_children.keys():
+                logging.debug("File contains /Events table, removing table...")
+                dataFile.removeNode('/Events', recursive = True)
+            
+            outGroup = dataFile.createGroup('/', 'Events', '')
+            # copy attributes (including time offsets of mistimed events)
+            eventsGroup._v_attrs._f_copy(outGroup)
+            
+            logging.debug("Copying codec")
+            copy_table(dataFile, eventsGroup.codec, outGroup, 'codec', filters, blockSize)
+            dataFile.flush()
+            
+            logging.debug("Copying events")
+            copy_table(dataFile, eventsGroup.events, outGroup, 'events', filters, blockSize)
+            dataFile.flush()
+            
+            logging.debug("Copying values")
+            copy_values(dataFile, eventsGroup.values, outGroup, 'values', filters, blockSize)
+            dataFile.flush()
+            
+            logging.debug("Writing events index")
+            write_events_index(dataFile, outGroup)
+            
+            logging.debug("Writing decoded values")
+            write_decoded_values(dataFile, outGroup)
+    return
+
+def slow_add_events_file(eventsFilename, dataFilename):
+    """
+    Row by row version of add_events_file (used to test and benchmark add_events_file)
+    
+    Copy events from one hdf5 file (events file) to another (data file)
+    
     Parameters
     ----------
     eventFilename : string or h5file
@@ -209,6 +760,12 @@ def add_events_file(eventsFilename, dataFilename):
             for v in eventsGroup.values:
                 valuesOut.append(v)
             dataFile.flush()
+            
+            logging.debug("Writing events index")
+            write_events_index(dataFile, outGroup)
+            
+            logging.debug("Writing decoded values")
+            write_decoded_values(dataFile, outGroup)
     
     # logging.debug("Cleaning up")
     # dataFile.close()
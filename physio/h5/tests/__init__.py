@@ -0,0 +1 @@
+#!/usr/bin/env python
\ No newline at end of file
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile
+
+import numpy as np
+import tables
+
+from .. import combine
+
+class Spike(tables.IsDescription):
+    time = tables.Int64Col(pos = 0)
+    clu = tables.Int32Col(dflt = -1, pos = 1)
+    wave = tables.Float64Col(shape = (40,), pos = 2)
+
+def make_channel_file(filename, nspikes = 1000, nclusters = 4):
+    """
+    Make a synthetic channel (clustering output) file
+    """
+    f = tables.openFile(filename, 'w')
+    st = f.createTable('/', 'SpikeTable', Spike, 'Spike table')
+    times = np.cumsum(np.random.randint(1, 1000, nspikes))
+    clus = np.random.randint(0, nclusters, nspikes)
+    waves = np.random.randn(nspikes, 40)
+    st.append(zip(times, clus, waves))
+    g = f.createGroup('/', 'Clustering', '')
+    f.createArray(g, 'clusters', np.arange(nclusters))
+    f.createArray(g, 'temperature', np.random.rand(nclusters))
+    f.close()
+
+def make_channel_files(directory, nchannels = 4, nspikes = 1000):
+    filenames = []
+    for ch in xrange(1, nchannels + 1):
+        filename = os.path.join(directory, 'input_%i#01.h5' % ch)
+        make_channel_file(filename, nspikes)
+        filenames.append(filename)
+    return filenames
+
+def assert_combined_equal(aFilename, bFilename):
+    a = tables.openFile(aFilename, 'r')
+    b = tables.openFile(bFilename, 'r')
+    try:
+        aChannels = sorted([n.name for n in a.root.Channels])
+        assert aChannels == sorted([n.name for n in b.root.Channels])
+        for name in aChannels:
+            at = a.getNode('/Channels/%s' % name)
+            bt = b.getNode('/Channels/%s' % name)
+            assert at.attrs.ORIGFILE == bt.attrs.ORIGFILE
+            for col in ['time', 'clu', 'wave']:
+                assert np.all(at.col(col) == bt.col(col))
+            for node in a.getNode('/Clustering/%s' % name):
+                assert np.all(np.array(node) == \
+                        np.array(b.getNode('/Clustering/%s/%s' % (name, node.name))))
+    finally:
+        a.close()
+        b.close()
+
+def assert_description_equal(combinedFilename, filenames, channels):
+    """
+    Check that combined spike tables keep the description and title of the inputs
+    """
+    f = tables.openFile(combinedFilename, 'r')
+    try:
+        for (filename, ch) in zip(filenames, channels):
+            inFile = tables.openFile(filename, 'r')
+            at = inFile.root.SpikeTable
+            bt = f.getNode('/Channels/ch%i' % ch)
+            assert at.title == bt.title, "%s != %s" % (at.title, bt.title)
+            assert repr(at.description) == repr(bt.description)
+            inFile.close()
+    finally:
+        f.close()
+
+def test_combine():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filenames = make_channel_files(tmp)
+        slowFilename = os.path.join(tmp, 'slow.h5')
+        combine.slow_combine(filenames, slowFilename)
+        for (i, kwargs) in enumerate([{}, {'blockSize': 300}, {'complevel': 5}, \
+                {'complevel': 1, 'complib': 'zlib', 'blockSize': 7}]):
+            outFilename = os.path.join(tmp, 'combined_%i.h5' % i)
+            combine.combine(filenames, outFilename, **kwargs)
+            assert_combined_equal(slowFilename, outFilename)
+            assert_description_equal(outFilename, filenames, range(1, len(filenames) + 1))
+    finally:
+        shutil.rmtree(tmp)
+
+def test_cluster_index():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filenames = make_channel_files(tmp, 2)
+        outFilename = os.path.join(tmp, 'combined.h5')
+        combine.combine(filenames, outFilename)
+        f = tables.openFile(outFilename, 'r')
+        for ch in [1, 2]:
+            table = f.getNode('/Channels/ch%i' % ch)
+            for clu in [0, 1, 3, 4]:
+                for sampleRange in [None, (1000, 200000), (0, 0)]:
+                    times, rows = combine.get_cluster_rows(f, ch, clu, sampleRange)
+                    if sampleRange is None:
+                        condition = 'clu == %i' % clu
+                    else:
+                        condition = '(clu == %i) & (time > %i) & (time < %i)' % \
+                                ((clu,) + sampleRange)
+                    assert np.all(times == [r['time'] for r in table.where(condition)])
+                    assert np.all(rows == table.getWhereList(condition))
+        try:
+            combine.get_cluster_rows(f, 3, 0)
+            raise AssertionError("get_cluster_rows did not fail for a missing channel")
+        except LookupError:
+            pass
+        f.close()
+    finally:
+        shutil.rmtree(tmp)
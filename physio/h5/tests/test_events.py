@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile
+
+import numpy as np
+import tables
+
+from .. import events
+
+class Codec(tables.IsDescription):
+    code = tables.UInt32Col(pos = 0)
+    name = tables.StringCol(64, pos = 1)
+
+class Event(tables.IsDescription):
+    code = tables.UInt32Col(pos = 0)
+    time = tables.UInt64Col(pos = 1)
+    index = tables.UInt32Col(pos = 2)
+
+def make_events_file(filename, nevents = 1000, names = ('a', 'b', 'gaze_h', '#stimDisplayUpdate')):
+    """
+    Make a synthetic session events file with events evenly spread between codes
+    """
+    f = tables.openFile(filename, 'w')
+    g = f.createGroup('/', 'S1_1', '')
+    codec = f.createTable(g, 'codec', Codec)
+    codec.append([(i, n) for (i, n) in enumerate(names)])
+    codes = np.random.randint(0, len(names), nevents)
+    times = np.cumsum(np.random.randint(1, 10000, nevents)).astype(np.uint64)
+    evs = f.createTable(g, 'events', Event)
+    evs.append(zip(codes, times, np.arange(nevents)))
+    values = f.createVLArray(g, 'values', tables.VLStringAtom())
+    for (i, c) in enumerate(codes):
+        if names[c] == '#stimDisplayUpdate':
+            values.append(str([{'name': 'pixel clock', 'bit_code': i % 16}, {'name': 's%i' % i}]))
+        else:
+            values.append(str(i * 0.5))
+    f.close()
+    return codes, times
+
+def test_events_index():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        dataFilename = os.path.join(tmp, 'data.h5')
+        noIndexFilename = os.path.join(tmp, 'noindex.h5')
+        codes, times = make_events_file(eventsFilename)
+        events.add_events_file(eventsFilename, dataFilename)
+        
+        # files without an index fall back to searching the events table
+        shutil.copy(dataFilename, noIndexFilename)
+        f = tables.openFile(noIndexFilename, 'a')
+        f.removeNode('/Events/index', recursive = True)
+        f.close()
+        
+        f = tables.openFile(dataFilename, 'r')
+        assert 'index' in f.root.Events
+        timeRanges = [None, (times[100] / 1E6, times[800] / 1E6), (0., times[-1] / 1E6), (1E9, 2E9)]
+        for name in ['a', 'b', 'gaze_h', '#stimDisplayUpdate', 3]:
+            for timeRange in timeRanges:
+                t, v = events.get_events(f, name, timeRange)
+                et, ev = events.get_events(noIndexFilename, name, timeRange)
+                assert np.all(t == et)
+                assert v == ev
+        f.close()
+        
+        # times are (start, end] and sorted
+        code = 1
+        t, v = events.get_events(dataFilename, code, (times[10] / 1E6, times[-10] / 1E6))
+        expected = times[11:-9][codes[11:-9] == code] / 1E6
+        assert np.all(t == expected)
+        assert np.all(np.diff(t) > 0)
+        
+        # mistimed eyetracker events are offset before the time range is applied
+        for filename in (dataFilename, noIndexFilename):
+            f = tables.openFile(filename, 'a')
+            f.root.Events._v_attrs.EYETRACKER_OFFSET = 50000
+            f.close()
+        for timeRange in timeRanges:
+            t, v = events.get_events(dataFilename, 'gaze_h', timeRange)
+            et, ev = events.get_events(noIndexFilename, 'gaze_h', timeRange)
+            assert np.all(t == et)
+            assert v == ev
+    finally:
+        shutil.rmtree(tmp)
+
+def test_decoded_values():
+    np.random.seed(1)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        dataFilename = os.path.join(tmp, 'data.h5')
+        codes, times = make_events_file(eventsFilename)
+        events.add_events_file(eventsFilename, dataFilename)
+        f = tables.openFile(dataFilename, 'r')
+        # only numeric events in DECODED_EVENTS are stored
+        assert f.root.Events.decoded._v_children.keys() == ['c2']
+        t, v = events.get_events(f, 'gaze_h')
+        assert v == [i * 0.5 for i in np.where(codes == 2)[0]]
+        # values are parsed once and shared between calls
+        t, v = events.get_events(f, '#stimDisplayUpdate')
+        t2, v2 = events.get_events(f, '#stimDisplayUpdate')
+        assert all([a is b for (a, b) in zip(v, v2)])
+        assert v == [events.parse_value(f.root.Events.values[i]) for i in np.where(codes == 3)[0]]
+        f.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_fast_parse_value():
+    values = ['[null]', 'NaN', 'Infinity', '1', '-2.5', '1e-3', '[]', '{}', \
+            '[{"name": "pixel clock", "bit_code": 5, "pos_x": -1.5}]', \
+            "[{'name': 'pixel clock', 'bit_code': 5, 'pos_x': -1.5}]", \
+            '{"a": [1, 2, {"b": "c\\"d"}], "e": true}', "{'a': True, 'b': None}"]
+    for value in values:
+        expected = events.parse_value(value.replace('true', 'True'))
+        parsed = events.fast_parse_value(value)
+        if (type(expected) is float) and np.isnan(expected):
+            assert np.isnan(parsed)
+        else:
+            assert parsed == expected, "%s != %s" % (parsed, expected)
+            assert repr(parsed) == repr(expected)
+
+def test_add_events_file():
+    np.random.seed(2)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        codes, times = make_events_file(eventsFilename, 2500)
+        dataFilenames = []
+        for (i, kwargs) in enumerate([{'blockSize': 1000}, {'complevel': 5}]):
+            dataFilenames.append(os.path.join(tmp, 'data%i.h5' % i))
+            events.add_events_file(eventsFilename, dataFilenames[-1], **kwargs)
+        dataFilenames.append(os.path.join(tmp, 'slow.h5'))
+        events.slow_add_events_file(eventsFilename, dataFilenames[-1])
+        
+        f = tables.openFile(eventsFilename, 'r')
+        for dataFilename in dataFilenames:
+            d = tables.openFile(dataFilename, 'r')
+            assert np.all(d.root.Events.codec.read() == f.root.S1_1.codec.read())
+            assert np.all(d.root.Events.events.read() == f.root.S1_1.events.read())
+            assert d.root.Events.values.read() == f.root.S1_1.values.read()
+            d.close()
+        f.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_link_events_file():
+    np.random.seed(4)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        storeFilename = os.path.join(tmp, 'store.h5')
+        copyFilename = os.path.join(tmp, 'copy.h5')
+        codes, times = make_events_file(eventsFilename)
+        events.add_events_file(eventsFilename, storeFilename)
+        events.add_events_file(eventsFilename, copyFilename)
+        
+        # link epochs to the store and to the original events file
+        os.mkdir(os.path.join(tmp, 'epoch'))
+        linkedFilenames = [os.path.join(tmp, 'epoch', 'data.h5'), os.path.join(tmp, 'original.h5')]
+        events.link_events_file(storeFilename, linkedFilenames[0])
+        events.link_events_file(eventsFilename, linkedFilenames[1])
+        events.link_events_file(storeFilename, linkedFilenames[1]) # replace link
+        for linkedFilename in linkedFilenames:
+            assert os.path.getsize(linkedFilename) < (os.path.getsize(copyFilename) / 10)
+            f = tables.openFile(linkedFilename, 'r')
+            assert events.get_codec(f) == events.get_codec(copyFilename)
+            for name in ['a', 'gaze_h', '#stimDisplayUpdate']:
+                t, v = events.get_events(f, name, (times[50] / 1E6, times[500] / 1E6))
+                et, ev = events.get_events(copyFilename, name, (times[50] / 1E6, times[500] / 1E6))
+                assert np.all(t == et)
+                assert v == ev
+            f.close()
+        
+        # the store can be rewritten after it has been read through a link
+        events.add_events_file(eventsFilename, storeFilename, complevel = 5)
+        t, v = events.get_events(linkedFilenames[0], 'a')
+        assert len(t) == np.sum(codes == 0)
+    finally:
+        events.close_events_store(storeFilename)
+        shutil.rmtree(tmp)
+
+def test_linked_stores():
+    np.random.seed(7)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        storeFilename = os.path.join(tmp, 'store.h5')
+        dataFilename = os.path.join(tmp, 'data.h5')
+        codes, times = make_events_file(eventsFilename)
+        events.add_events_file(eventsFilename, storeFilename)
+        events.link_events_file(storeFilename, dataFilename)
+        
+        # stores opened by get_events are closed with the linking file
+        t, v = events.get_events(dataFilename, 'b')
+        assert len(t) == np.sum(codes == 1)
+        assert all([e[0].isopen for e in events.EVENTS_STORES.values()])
+        
+        # stores are kept open while the linking file is open
+        f = tables.openFile(dataFilename, 'r')
+        events.get_events(f, 'b')
+        stores = events.EVENTS_STORES[id(f)][1].values()
+        assert len(stores) == 1
+        store = stores[0][0]
+        assert store.isopen
+        events.get_events(f, 'a')
+        assert events.EVENTS_STORES[id(f)][1].values()[0][0] is store
+        events.release_events(f)
+        assert not store.isopen
+        assert not (id(f) in events.EVENTS_STORES)
+        
+        # and closed (on the next lookup) if the linking file was closed
+        events.get_events(f, 'b')
+        store = events.EVENTS_STORES[id(f)][1].values()[0][0]
+        f.close()
+        g = tables.openFile(dataFilename, 'r')
+        events.get_events(g, 'b')
+        assert not store.isopen
+        events.release_events(g)
+        g.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_events_handle():
+    np.random.seed(5)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        dataFilename = os.path.join(tmp, 'data.h5')
+        codes, times = make_events_file(eventsFilename, names = ('a', 'b', 'a', 'gaze_h'))
+        events.add_events_file(eventsFilename, dataFilename)
+        
+        # the events group is only found once per open file
+        calls = []
+        find_events_group = events.find_events_group
+        def counted_find_events_group(eventsFile):
+            calls.append(eventsFile)
+            return find_events_group(eventsFile)
+        events.find_events_group = counted_find_events_group
+        try:
+            f = tables.openFile(dataFilename, 'r')
+            for i in xrange(3):
+                events.get_codec(f)
+                events.get_events(f, 'gaze_h')
+                events.get_events(f, 'b', (0., times[-1] / 1E6))
+            assert len(calls) == 1
+            handle = events.get_events_handle(f)
+            assert handle is events.get_events_handle(f)
+            f.close()
+            
+            # closed files get a new handle
+            f = tables.openFile(dataFilename, 'r')
+            assert not (events.get_events_handle(f) is handle)
+            assert len(calls) == 2
+        finally:
+            events.find_events_group = find_events_group
+        
+        # duplicate names use the first code
+        assert handle.lookup('a') == (0, 'a')
+        assert handle.lookup(2) == (2, 'a')
+        assert handle.lookup('gaze_h') == (3, 'gaze_h')
+        t, v = events.get_events(f, 'a')
+        assert len(t) == np.sum(codes == 0)
+        f.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_value_cache():
+    np.random.seed(6)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        dataFilename = os.path.join(tmp, 'data.h5')
+        codes, times = make_events_file(eventsFilename)
+        events.add_events_file(eventsFilename, dataFilename)
+        
+        # files opened by get_events do not leave caches behind
+        t, v = events.get_events(dataFilename, 'b')
+        assert all([e[0].isopen for e in events.VALUE_CACHES.values()])
+        
+        # caches are reused for an open file and dropped when released
+        f = tables.openFile(dataFilename, 'r')
+        t, fv = events.get_events(f, 'b')
+        assert fv == v
+        cache = events.get_value_cache(f)
+        assert len(cache.byIndex) == len(v)
+        t, fv = events.get_events(f, 'b')
+        assert cache is events.get_value_cache(f)
+        events.release_events(f)
+        assert not (id(f) in events.VALUE_CACHES)
+        
+        # caches of closed files are removed
+        events.get_events(f, 'b')
+        f.close()
+        g = tables.openFile(dataFilename, 'r')
+        events.get_events(g, 'b')
+        assert not any([e[0] is f for e in events.VALUE_CACHES.values()])
+        events.release_events(g)
+        g.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_time_offsets_at_ingest():
+    np.random.seed(6)
+    tmp = tempfile.mkdtemp()
+    try:
+        eventsFilename = os.path.join(tmp, 'events.h5')
+        dataFilename = os.path.join(tmp, 'data.h5')
+        noIndexFilename = os.path.join(tmp, 'noindex.h5')
+        codes, times = make_events_file(eventsFilename)
+        f = tables.openFile(eventsFilename, 'a')
+        f.root.S1_1._v_attrs.EYETRACKER_OFFSET = 30000
+        f.close()
+        events.add_events_file(eventsFilename, dataFilename)
+        shutil.copy(dataFilename, noIndexFilename)
+        f = tables.openFile(noIndexFilename, 'a')
+        f.removeNode('/Events/index', recursive = True)
+        f.close()
+        
+        # gaze times are corrected in the index
+        f = tables.openFile(dataFilename, 'r')
+        assert f.root.Events._v_attrs.EYETRACKER_OFFSET == 30000
+        assert f.root.Events.index._v_attrs.TIME_OFFSETS == {2: 30000}
+        gaze = np.where(codes == 2)[0]
+        t, v = events.get_events(f, 'gaze_h')
+        assert np.all(t == (times[gaze].astype(np.int64) - 30000) / 1E6)
+        f.close()
+        
+        timeRanges = [None, (times[100] / 1E6, times[800] / 1E6)]
+        for offset in (None, 20000):
+            if offset is not None:
+                # offsets changed after ingest are corrected by the difference
+                for filename in (dataFilename, noIndexFilename):
+                    f = tables.openFile(filename, 'a')
+                    f.root.Events._v_attrs.EYETRACKER_OFFSET = offset
+                    f.close()
+            for timeRange in timeRanges:
+                for name in ('gaze_h', 'a'):
+                    t, v = events.get_events(dataFilename, name, timeRange)
+                    et, ev = events.get_events(noIndexFilename, name, timeRange)
+                    assert np.all(t == et)
+                    assert v == ev
+    finally:
+        shutil.rmtree(tmp)
@@ -24,6 +24,36 @@ def group_to_dictionary(group, keyArray='keys', valArray='values'):
 # TODO make utility for writing that uses with to make sure things get cleaned up and
 #  to handle string or tables.file objects as first argument to write functions
 
+def copy_table(h5file, table, group, name, filters = None, blockSize = 100000):
+    """
+    Copy a table to another file in blocks of rows
+    
+    Parameters
+    ----------
+    h5file : h5file
+        Open (writable) hdf5 file to copy the table to
+    table : Table
+        Table to copy
+    group : hdf5 node
+        Group (in h5file) to copy the table to
+    name : string
+        Name of the new table
+    filters : tables.Filters
+        Filters (compression) for the new table
+    blockSize : int
+        Number of rows to copy at a time
+    
+    Returns
+    -------
+    tableOut : Table
+        New table
+    """
+    tableOut = h5file.createTable(group, name, table.description, table.title, \
+            filters = filters, expectedrows = max(table.nrows, 1))
+    for start in xrange(0, table.nrows, blockSize):
+        tableOut.append(table.read(start, min(start + blockSize, table.nrows)))
+    return tableOut
+
 def write_array(filename, data, name, title):
     """
     TODO document
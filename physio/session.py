@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # import itertools, glob, sys
+import collections
 import glob
 import logging
 import os
@@ -11,10 +12,12 @@ import tables
 
 # import pywaveclus
 
+import catalog
 import cfg
 import clock
 import events
 import h5
+import timeseries
 import utils
 #from utils import memoize
 
@@ -22,6 +25,10 @@ import physio
 
 
 def get_sessions(config=None):
+    return catalog.get_catalog(config).get_sessions()
+
+
+def slow_get_sessions(config=None):
     if config is None:
         config = physio.cfg.Config()
         config.read_user_config()
@@ -31,7 +38,11 @@ def get_sessions(config=None):
     return sessions
 
 
-def check_session_validity(config, sessionName):
+def check_session_validity(config, sessionName, sessionCatalog=None):
+    """
+    Check (using the catalog) that a session is not blacklisted and that
+    all its epoch files were written with this version of physio
+    """
     # check if animal is blacklisted #TODO make this less hacky
     blacklist = ['fake0', 'K2']
     animal = sessionName.split('_')[0]
@@ -39,22 +50,20 @@ def check_session_validity(config, sessionName):
         logging.debug("Session %s from blacklisted animal %s" % \
                 (sessionName, animal))
         return False
+    if sessionCatalog is None:
+        sessionCatalog = catalog.get_catalog(config)
     # check if session has 1 .h5 file
-    sessionDir = config.get('filesystem', 'resultsrepo') + '/' + sessionName
-    h5files = glob.glob(sessionDir + '/*/*.h5')
+    h5files = sessionCatalog.get_epoch_files(sessionName)
     if len(h5files) == 0:
         logging.debug("Session %s contained no h5 files" % sessionName)
         return False
-    for h5file in h5files:
+    for (h5file, info) in sorted(h5files.items()):
         # check if physio version used to generate file matches this one
-        f = tables.openFile(h5file, 'r')
-        if not ('PHYSIO_VERSION' in f.root._v_attrs):
+        version = info['version']
+        if version is None:
             logging.debug("Session %s file %s has no physio version string" % \
                 (sessionName, h5file))
-            f.close()
             return False
-        version = f.root._v_attrs.PHYSIO_VERSION
-        f.close()
         if version != physio.__version__:
             logging.debug("Session %s file %s version %s out of " \
                 "date [newest: %s]" % \
@@ -64,27 +73,94 @@ def check_session_validity(config, sessionName):
 
 
 def get_valid_sessions(config=None):
-    if config is None:
-        config = physio.cfg.Config()
-        config.read_user_config()
-    sessions = get_sessions(config)
-    return [s for s in sessions if check_session_validity(config, s)]
+    sessionCatalog = catalog.get_catalog(config)
+    return [s for s in sessionCatalog.get_sessions() if \
+            check_session_validity(config, s, sessionCatalog)]
 
 
 def get_invalid_sessions(config=None):
+    sessionCatalog = catalog.get_catalog(config)
+    return [s for s in sessionCatalog.get_sessions() if \
+            (not check_session_validity(config, s, sessionCatalog))]
+
+
+def get_n_epochs(session, config=None):
+    """
+    Number of epochs of a session (see get_epochs)
+
+    Parameters
+    ----------
+    session : string
+        Session name
+    config : cfg.Config
+        Configuration (default = cfg.load(session)). If config is for
+        another session a copy with the [session] options reset and
+        set up for session (see cfg.Config.set_session) is used
+    """
     if config is None:
-        config = physio.cfg.Config()
-        config.read_user_config()
-    sessions = get_sessions(config)
-    return [s for s in sessions if (not check_session_validity(config, s))]
+        config = cfg.load(session)
+    elif config.get('session', 'name') != session:
+        config = config.copy()
+        for option in config.options('session'):
+            config.set('session', option, '')
+        config.set_session(session)
+    return len(get_epochs(config))
 
 
-def get_n_epochs(session):
+def slow_get_n_epochs(session):
     config = cfg.load(session)
     return len(get_epochs(config))
 
 
+def slow_check_session_validity(config, sessionName):
+    # check if animal is blacklisted #TODO make this less hacky
+    blacklist = ['fake0', 'K2']
+    animal = sessionName.split('_')[0]
+    if animal in blacklist:
+        logging.debug("Session %s from blacklisted animal %s" % \
+                (sessionName, animal))
+        return False
+    # check if session has 1 .h5 file
+    sessionDir = config.get('filesystem', 'resultsrepo') + '/' + sessionName
+    h5files = glob.glob(sessionDir + '/*/*.h5')
+    if len(h5files) == 0:
+        logging.debug("Session %s contained no h5 files" % sessionName)
+        return False
+    for h5file in h5files:
+        # check if physio version used to generate file matches this one
+        f = tables.openFile(h5file, 'r')
+        if not ('PHYSIO_VERSION' in f.root._v_attrs):
+            logging.debug("Session %s file %s has no physio version string" % \
+                (sessionName, h5file))
+            f.close()
+            return False
+        version = f.root._v_attrs.PHYSIO_VERSION
+        f.close()
+        if version != physio.__version__:
+            logging.debug("Session %s file %s version %s out of " \
+                "date [newest: %s]" % \
+                (sessionName, h5file, version, physio.__version__))
+            return False
+    return True
+
+
 def get_epochs(config):
+    """
+    Epoch directory names (in [session] outputprefix) sorted by start time
+
+    Epochs are read from the catalog (see catalog.Catalog) if outputprefix
+    is the session directory of the results repository and otherwise
+    found by listing outputprefix
+    """
+    name = config.get('session', 'name').strip()
+    mainDir = config.get('session', 'outputprefix')
+    sessionDir = '/'.join((config.get('filesystem', 'resultsrepo'), name))
+    if (name != '') and (os.path.abspath(mainDir) == os.path.abspath(sessionDir)):
+        return catalog.get_catalog(config).get_epochs(name)
+    return slow_get_epochs(config)
+
+
+def slow_get_epochs(config):
     mainDir = config.get('session', 'outputprefix')
     epochs = sorted([os.path.basename(ed) for ed in \
             utils.regex_glob(mainDir, r'^\d+_\d+/?$')[0]],\
@@ -110,7 +186,75 @@ def load(session, epochNumber=0, config=None):
         utils.error('More than one .h5 file found in output " \
                 "directory: %s' % str(h5files))
     return Session(h5files[0], config.getint('audio', 'samprate'),
-                   cache_dir=config.get('filesystem', 'tmp', '/tmp'))
+                   cache_dir=config.get('filesystem', 'tmp', '/tmp'),
+                   interpolate=config.getboolean('pixel clock', 'interpolate'))
+
+
+TRIAL_DTYPE = [('time', np.float64), ('stim', np.int64),
+                ('duration', np.float64), ('failed', bool)]
+
+
+class ChannelSpikes(object):
+    """
+    All spikes of one channel grouped by cluster
+
+    Spikes are sorted by cluster and time so the spikes of cluster k are
+    spikes[offsets[k]:offsets[k+1]] (offsets is indexed by cluster number).
+    The get_* methods return views (no copies) of the channel arrays.
+    """
+    def __init__(self, times, waves, clus, samplingrate=44100):
+        """
+        Parameters
+        ----------
+        times : 1d array
+            Spike times in samples
+        waves : 2d array
+            Spike waveforms (one row per spike)
+        clus : 1d array
+            Spike clusters
+        samplingrate : int
+            Samples per second of times
+        """
+        order = np.lexsort((times, clus))
+        self.times = np.ascontiguousarray(times[order], dtype=np.int64)
+        self.waves = np.ascontiguousarray(waves[order])
+        self.clus = np.ascontiguousarray(clus[order])
+        nclusters = (self.clus[-1] + 1) if len(self.clus) else 0
+        self.offsets = np.searchsorted(self.clus, np.arange(nclusters + 1))
+        self.samplingrate = samplingrate
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.waves.nbytes + self.clus.nbytes + \
+                self.offsets.nbytes
+
+    def get_n_clusters(self):
+        return len(self.offsets) - 1
+
+    def get_bounds(self, cluster, timeRange=None):
+        if (cluster < 0) or (cluster >= self.get_n_clusters()):
+            return 0, 0
+        start, end = self.offsets[cluster], self.offsets[cluster + 1]
+        if timeRange is None:
+            return start, end
+        samplerange = (int(timeRange[0] * self.samplingrate),
+                        int(timeRange[1] * self.samplingrate))
+        times = self.times[start:end]
+        lo = np.searchsorted(times, samplerange[0], side='right')
+        hi = max(lo, np.searchsorted(times, samplerange[1], side='left'))
+        return start + lo, start + hi
+
+    def get_spike_samples(self, cluster, timeRange=None):
+        start, end = self.get_bounds(cluster, timeRange)
+        return self.times[start:end]
+
+    def get_spike_times(self, cluster, timeRange=None):
+        return self.get_spike_samples(cluster, timeRange) / \
+                float(self.samplingrate)
+
+    def get_spike_waveforms(self, cluster, timeRange=None):
+        start, end = self.get_bounds(cluster, timeRange)
+        return self.waves[start:end]
 
 
 class Session(object):
@@ -118,17 +262,38 @@ class Session(object):
     Times are always provided in seconds since beginning of
     epoch in audio units
     """
-    def __init__(self, h5filename, samplingrate=44100, cache_dir=None):
+    def __init__(self, h5filename, samplingrate=44100, cache_dir=None,
+                    channel_cache_bytes=512 * 1024 ** 2, interpolate=False):
+        """
+        interpolate : bool
+            Linearly interpolate audio/mworks offsets between time matches
+            (see clock.timebase.TimeBase) instead of using the offset of
+            the next match
+        """
         self._file = tables.openFile(h5filename, 'r')
         self._filename = h5filename
 
         self._samplingrate = samplingrate
+        self._interpolate = interpolate
         self.read_timebase()
 
+        # most recently used channel spikes (see get_channel_spikes)
+        self._channel_cache = collections.OrderedDict()
+        self._channel_cache_bytes = channel_cache_bytes
+
     def read_timebase(self):
         matchesNode = self._file.getNode('/TimeMatches')
-        self._timebase = clock.timebase.TimeBase(np.array(matchesNode), \
-                fitline=False)  # fitline=True)
+        if self._interpolate and ('/TimeSegments' in self._file):
+            # interpolate using the precomputed segment table
+            segmentsNode = self._file.getNode('/TimeSegments')
+            self._timebase = clock.timebase.TimeBase(np.array(matchesNode), \
+                    segments=np.array(segmentsNode))
+        elif self._interpolate:
+            self._timebase = clock.timebase.TimeBase(np.array(matchesNode), \
+                    fitline=False, interpolate=True)
+        else:
+            self._timebase = clock.timebase.TimeBase(np.array(matchesNode), \
+                    fitline=False)  # fitline=True)
 
     def get_epoch_time_range(self, unit):
         """
@@ -165,9 +330,25 @@ class Session(object):
             utils.error("Unknown time unit[%s]" % unit)
 
     def close(self):
+        h5.events.release_events(self._file)
         self._file.close()
 
+    def get_cache_stats(self):
+        """
+        Returns
+        -------
+        stats : dict
+            Hit/miss/size counters of each memoized method (see utils.get_cache_stats)
+        """
+        return utils.get_cache_stats(self)
+
     def get_n_clusters(self, channel):
+        n = self._file.getNode('/Channels/ch%i' % channel)
+        if 'NCLUSTERS' in n.attrs._v_attrnames:
+            return int(n.attrs.NCLUSTERS)
+        return self.slow_get_n_clusters(channel)
+
+    def slow_get_n_clusters(self, channel):
         n = self._file.getNode('/Channels/ch%i' % channel)
         clus = np.array([r['clu'] for r in n])
         if len(clus) == 0:
@@ -175,6 +356,21 @@ class Session(object):
         maxI = clus.max()
         return maxI + 1
 
+    def get_cluster_spike_counts(self, channel):
+        """
+        Returns
+        -------
+        counts : 1d array
+            Number of spikes in each cluster (indexed by cluster)
+        """
+        name = '/ClusterIndex/ch%i/counts' % channel
+        if name in self._file:
+            return self._file.getNode(name).read()
+        clus = self._file.getNode('/Channels/ch%i' % channel).col('clu')
+        if not np.any(clus >= 0):
+            return np.zeros(0, dtype=np.int64)
+        return np.bincount(clus[clus >= 0]).astype(np.int64)
+
     def get_n_cells(self):
         raise Exception("The Cells table is incorrect")
         return self._file.root.Cells.nrows
@@ -192,7 +388,92 @@ class Session(object):
         ch, cl = self.get_cell(i)
         return self.get_spike_waveforms(ch, cl, timeRange)
 
-    def get_spike_waveforms(self, channel, cluster, timeRange=None):
+    def get_channel_spikes(self, channel):
+        """
+        Read all spikes of a channel in one pass (see ChannelSpikes)
+
+        Channels are cached (least recently used first out) while the
+        total size of the cached channels is <= channel_cache_bytes
+        """
+        if channel in self._channel_cache:
+            spikes = self._channel_cache.pop(channel)
+            self._channel_cache[channel] = spikes
+            return spikes
+        data = self._file.getNode('/Channels/ch%i' % channel).read()
+        spikes = ChannelSpikes(data['time'], data['wave'], data['clu'],
+                self._samplingrate)
+        del data
+        cached = sum([c.nbytes for c in self._channel_cache.values()])
+        while len(self._channel_cache) and \
+                ((cached + spikes.nbytes) > self._channel_cache_bytes):
+            cached -= self._channel_cache.popitem(last=False)[1].nbytes
+        if spikes.nbytes <= self._channel_cache_bytes:
+            self._channel_cache[channel] = spikes
+        return spikes
+
+    def get_sample_range(self, timeRange):
+        assert len(timeRange) == 2, "timeRange must be length 2: %s" % \
+                len(timeRange)
+        return (int(timeRange[0] * self._samplingrate),
+                int(timeRange[1] * self._samplingrate))
+
+    def has_cluster_index(self, channel):
+        return ('/ClusterIndex/ch%i' % channel) in self._file
+
+    def get_spike_rows(self, channel, cluster, timeRange=None):
+        """
+        Find the spike table rows of the spikes of a cluster
+        using the cluster index (or a table query for older files)
+        """
+        samplerange = None if timeRange is None else \
+                self.get_sample_range(timeRange)
+        if self.has_cluster_index(channel):
+            return h5.combine.get_cluster_rows(self._file, channel,
+                    cluster, samplerange)[1]
+        if samplerange is None:
+            condition = 'clu == %i' % cluster
+        else:
+            condition = '(clu == %i) & (time > %i) & (time < %i)' % \
+                    (cluster, samplerange[0], samplerange[1])
+        return self._file.getNode('/Channels/ch%i' % channel).\
+                getWhereList(condition)
+
+    def iter_spike_waveforms(self, channel, cluster, timeRange=None,
+                                blockSize=10000, dtype=np.float32):
+        """
+        Iterate over the waveforms of a cluster in blocks of at most
+        blockSize spikes (see spikes.stats.waveforms_stats)
+
+        Returns
+        -------
+        blocks : generator
+            2d arrays of waveforms (one row per spike)
+        """
+        n = self._file.getNode('/Channels/ch%i' % channel)
+        rows = self.get_spike_rows(channel, cluster, timeRange)
+        for start in xrange(0, len(rows), blockSize):
+            yield n.readCoordinates(rows[start:start + blockSize],
+                    field='wave').astype(dtype)
+
+    def get_spike_waveforms(self, channel, cluster, timeRange=None,
+                                blockSize=10000, dtype=np.float32):
+        """
+        Returns
+        -------
+        waves : 2d array
+            Waveforms (one row per spike) read in blocks of blockSize
+            spikes into a preallocated array of type dtype
+        """
+        n = self._file.getNode('/Channels/ch%i' % channel)
+        rows = self.get_spike_rows(channel, cluster, timeRange)
+        waves = np.empty((len(rows),) + tuple(n.coldtypes['wave'].shape),
+                dtype=dtype)
+        for start in xrange(0, len(rows), blockSize):
+            waves[start:start + blockSize] = n.readCoordinates(
+                    rows[start:start + blockSize], field='wave')
+        return waves
+
+    def slow_get_spike_waveforms(self, channel, cluster, timeRange=None):
         #n = self._file.getNode('/Channels/ch%i' % channel)
         if timeRange is None:
             waves = [i['wave'] for i in \
@@ -209,8 +490,17 @@ class Session(object):
                     (cluster, samplerange[0], samplerange[1]))]
         return np.array(waves)
 
-    @utils.memoize
+    @utils.lru_memoize(maxEntries=1024, maxBytes=256 * 1024 ** 2)
     def get_spike_times(self, channel, cluster, timeRange=None):
+        if self.has_cluster_index(channel):
+            samplerange = None if timeRange is None else \
+                    self.get_sample_range(timeRange)
+            times, rows = h5.combine.get_cluster_rows(self._file, channel,
+                    cluster, samplerange)
+            return times / float(self._samplingrate)
+        return self.slow_get_spike_times(channel, cluster, timeRange)
+
+    def slow_get_spike_times(self, channel, cluster, timeRange=None):
         #n = self._file.getNode('/Channels/ch%i' % channel)
         if timeRange is None:
             times = [i['time'] for i in \
@@ -243,7 +533,7 @@ class Session(object):
     def get_codec(self):
         return h5.events.get_codec(self._file)
 
-    @utils.memoize
+    @utils.lru_memoize(maxEntries=64, maxBytes=256 * 1024 ** 2)
     def get_stimuli(self, matchDict=None, timeRange=None, stimType='image'):
         """
         get all trials that match matchDict and are of type stimType
@@ -266,7 +556,78 @@ class Session(object):
         autimes = self._timebase.mworks_to_audio(times)
         return autimes, stims
 
+    @utils.lru_memoize(maxEntries=16)
+    def get_trial_table(self, timeRange=None):
+        """
+        Classify all image trials over time range timeRange
+
+        Returns
+        --
+            trials : structured array (see TRIAL_DTYPE) with fields
+                time : trial start time (in audio units)
+                stim : index of the trial stimulus in stims
+                duration : distractor presentation time (in seconds)
+                failed : True if a failure occurred during the presentation
+            stims : list of stimuli
+        """
+        times, stims = self.get_stimuli(None, timeRange)
+        times = np.asarray(times, dtype=np.float64)
+        tr = self.get_epoch_time_range('mworks')
+        tr[0] = 0
+        codec = self.get_codec()
+        if 'Distractor_Time' in codec.values():
+            dtts, dtvs = self.get_events('Distractor_Time', timeRange=tr)
+        elif 'DistractorPresentation_Time' in codec.values():
+            dtts, dtvs = self.get_events('DistractorPresentation_Time', \
+                    timeRange=tr)
+        else:
+            raise ValueError("No distractor time in: %s" % str(codec))
+        dtts = np.asarray(dtts, dtype=np.float64)
+        dtvs = np.asarray(dtvs, dtype=np.float64)
+        order = np.argsort(dtts, kind='mergesort')
+        dtts, dtvs = dtts[order], dtvs[order]
+
+        ftimes, _ = self.get_events('failure')
+        ftimes = np.sort(np.asarray(ftimes, dtype=np.float64))
+
+        trials = np.zeros(len(times), dtype=TRIAL_DTYPE)
+        trials['time'] = times
+        trials['stim'] = np.arange(len(times))
+        # index of the last distractor time before each trial
+        di = np.searchsorted(dtts, times, side='left') - 1
+        if np.any(di < 0):
+            raise ValueError("No distractor time found before trial at %f" % \
+                    times[di < 0][0])
+        trials['duration'] = dtvs[di] / 1000.  # convert to seconds
+        # a trial failed if the first failure after it is during the presentation
+        fi = np.searchsorted(ftimes, times, side='right')
+        ft = np.hstack((ftimes, np.inf))[fi]
+        trials['failed'] = (ft - times) < trials['duration']
+        return trials, stims
+
     def get_trials(self, matchDict=None, timeRange=None):
+        """
+        Get a list of non-failed trials that match matchDict over
+        time range timeRange (see get_trial_table)
+
+        Returns
+        --
+            goodTimes : list of non-failed trial START times (in audio units)
+            goodStims : list of corresponding stimuli
+            badTimes  : list of failed trial start times
+            badStims  : list of corresponding stimuli
+        """
+        trials, stims = self.get_trial_table(timeRange)
+        if not (matchDict is None):
+            matched = [all([(matchDict[k] == stims[i][k]) \
+                    for k in matchDict.keys()]) for i in trials['stim']]
+            trials = trials[np.array(matched, dtype=bool)]
+        good = trials[~trials['failed']]
+        bad = trials[trials['failed']]
+        return list(good['time']), [stims[i] for i in good['stim']], \
+                list(bad['time']), [stims[i] for i in bad['stim']]
+
+    def slow_get_trials(self, matchDict=None, timeRange=None):
         """
         Get a list of non-failed trials that match matchDict over
         time range timeRange
@@ -320,7 +681,7 @@ class Session(object):
         time = (tr[1] - tr[0]) / 2. + tr[0]  # middle of epoch
         return events.cnc.get_channel_locations(cncDict, offset, time)
 
-    @utils.memoize
+    @utils.lru_memoize(maxEntries=8, maxBytes=512 * 1024 ** 2)
     def get_gaze(self, timeRange=None):
         """
         Parameters
@@ -358,6 +719,17 @@ class Session(object):
         # process filters
         return trials, stims
 
+    @utils.lru_memoize(maxEntries=8)
+    def get_gaze_stats(self, timeRange=None):
+        """
+        Returns
+        -------
+            stats : timeseries.windows.WindowStats
+                Windowed statistics of the horizontal gaze (see get_gaze)
+        """
+        ts_gaze, _, h_gaze, _, _ = self.get_gaze(timeRange)
+        return timeseries.windows.WindowStats(ts_gaze, h_gaze)
+
     def get_gaze_filtered_trials(self, matchDict=None, timeRange=None,
                                  intra_trial_std_threshold=None,
                                  default_gaze_deviation_threshold=None,
@@ -365,6 +737,30 @@ class Session(object):
 
         trials, stims, bt, bs = self.get_trials(matchDict, timeRange)
 
+        gaze_stats = self.get_gaze_stats()
+
+        # try to estimate the "default" gaze
+        # (this is kind of a hack)
+        median_gaze = np.median(gaze_stats.values)
+
+        times = np.asarray(trials, dtype=np.float64)
+        keep = gaze_stats.cull(times - pre_time, times + post_time,
+                intra_trial_std_threshold, default_gaze_deviation_threshold,
+                median_gaze)
+
+        culled_trials = [t for (t, k) in zip(trials, keep) if k]
+        culled_stims = [s for (s, k) in zip(stims, keep) if k]
+        culled_bad_trials = bt + [t for (t, k) in zip(trials, keep) if not k]
+        culled_bad_stims = bs + [s for (s, k) in zip(stims, keep) if not k]
+        return culled_trials, culled_stims, culled_bad_trials, culled_bad_stims
+
+    def slow_get_gaze_filtered_trials(self, matchDict=None, timeRange=None,
+                                      intra_trial_std_threshold=None,
+                                      default_gaze_deviation_threshold=None,
+                                      pre_time=0.1, post_time=0.5):
+
+        trials, stims, bt, bs = self.get_trials(matchDict, timeRange)
+
         ts_gaze, _, h_gaze, _, _ = self.get_gaze()
 
         # try to estimate the "default" gaze
@@ -412,4 +808,4 @@ class Session(object):
         pass
 
     def get_md5sum(self):
-        return os.popen('md5sum %s' % self._filename).read().split()[0]
+        return utils.file_digest(self._filename)
@@ -42,6 +42,39 @@ def waveforms_snr_ptp(waveforms, pre=20):
     return ptp / noise
 
 
+def waveforms_stats(blocks, pre=20):
+    """
+    Measure the mean, standard deviation and snr (see waveforms_snr_ptp)
+    of waveforms one block at a time (see session.Session.iter_spike_waveforms)
+
+    Returns
+    -------
+    mean : 1d array
+    std : 1d array
+    snrs : 1d array
+        waveforms_snr_ptp of each waveform
+    """
+    n = 0
+    total = 0.
+    squares = 0.
+    noise = 0.
+    ptps = []
+    for block in blocks:
+        if len(block) == 0:
+            continue
+        block = np.asarray(block, dtype=np.float64)
+        n += len(block)
+        total = total + np.sum(block, 0)
+        squares = squares + np.sum(block ** 2, 0)
+        noise += np.sum(block[:, :pre] ** 2)
+        ptps.append(np.max(block, 1) - np.min(block, 1))
+    if n == 0:
+        return np.array([]), np.array([]), np.array([])
+    mean = total / n
+    std = np.sqrt(np.maximum(squares / n - mean ** 2, 0.))
+    return mean, std, np.hstack(ptps) / np.sqrt(noise / n)
+
+
 def xcorr(a, b, margin=44):
     if len(a) == 0 or len(b) == 0:
         return 0.
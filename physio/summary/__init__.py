@@ -8,9 +8,11 @@ import os
 import numpy
 import tables
 
+from .. import catalog
 from .. import cfg
 from .. import session
 from .. import spikes
+from .. import utils
 
 
 def make_summary_filename(config, session_name, epoch_index):
@@ -22,17 +24,18 @@ def get_summary_filenames(config=None):
     if config is None:
         config = cfg.Config()
         config.read_user_config()
-    session_names = session.get_sessions(config)
+    session_catalog = catalog.get_catalog(config)
     summary_filenames = []
-    for session_name in session_names:
-        n_epochs = get_n_epochs(session_name)
+    for session_name in session_catalog.get_sessions():
+        n_epochs = len(session_catalog.get_epochs(session_name))
         if n_epochs == 0:
             continue
+        session_files = session_catalog.get_session_files(session_name)
         for epoch_index in xrange(n_epochs):
             summary_filename = make_summary_filename(config, session_name, \
                     epoch_index)
             # check that summary exists
-            if os.path.exists(summary_filename):
+            if summary_filename in session_files:
                 summary_filenames.append(summary_filename)
     return summary_filenames
 
@@ -204,7 +207,7 @@ class Summary(object):
         return self._file.root._v_attrs['src_md5']
 
     def get_md5sum(self):
-        return os.popen('md5sum %s' % self._filename).read().split()[0]
+        return utils.file_digest(self._filename)
 
     def get_significant_bins(self, ch, cl, binw=0.05, bin_alpha=0.001, \
             trials=None, attr="name", blacklist="BlueSquare", \
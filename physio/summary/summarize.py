@@ -150,11 +150,12 @@ def summarize_session_object(session, output_filename):
     for ch in xrange(1, 33):  # tdt numbering
         #nclusters[ch] = session.get_n_clusters(ch)
         #for cl in xrange(nclusters[ch]):
-        for cl in xrange(session.get_n_clusters(ch)):
-            spike_times = session.get_spike_times(ch, cl)
+        channel_spikes = session.get_channel_spikes(ch)
+        for cl in xrange(channel_spikes.get_n_clusters()):
+            spike_times = channel_spikes.get_spike_times(cl)
             if len(spike_times):
                 snrs = spikes.stats.waveforms_snr_ptp( \
-                        session.get_spike_waveforms(ch, cl))
+                        channel_spikes.get_spike_waveforms(cl))
             else:
                 snrs = []
             for (snr, spike_time) in zip(snrs, spike_times):
@@ -181,8 +182,9 @@ def summarize_session_object(session, output_filename):
 
     # TODO combine these for loops with the previous
     for ch in xrange(1, 33):  # tdt numbering
-        for cl in xrange(session.get_n_clusters(ch)):
-            waves = numpy.array(session.get_spike_waveforms(ch, cl))
+        channel_spikes = session.get_channel_spikes(ch)
+        for cl in xrange(channel_spikes.get_n_clusters()):
+            waves = channel_spikes.get_spike_waveforms(cl)
             if len(waves) == 0:
                 continue
             snrs = spikes.stats.waveforms_snr_ptp(waves)
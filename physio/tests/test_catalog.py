@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, time
+
+import numpy as np
+import tables
+
+import physio
+from .. import catalog
+from .. import cfg
+from .. import session
+from .. import summary
+
+def make_results_file(filename, version = physio.__version__):
+    f = tables.openFile(filename, 'w')
+    if version is not None:
+        f.root._v_attrs.PHYSIO_VERSION = version
+    f.createArray('/', 'TimeMatches', np.zeros((2, 2)))
+    f.close()
+
+def make_results_repo(directory):
+    """
+    Make a synthetic results repository (see catalog.Catalog)
+    """
+    layout = {'K4_1': {'0_100': physio.__version__, '200_300': physio.__version__, '10_20': physio.__version__},
+            'L3_2': {'0_100': physio.__version__, '100_200': '0.0.1'},
+            'L3_3': {'0_100': None},
+            'fake0_1': {'0_100': physio.__version__},
+            'M1_1': {}}
+    for (name, epochs) in layout.iteritems():
+        os.makedirs(os.path.join(directory, name))
+        for (epoch, version) in epochs.iteritems():
+            os.makedirs(os.path.join(directory, name, epoch))
+            make_results_file(os.path.join(directory, name, epoch, name + '.h5'), version)
+    # summaries
+    make_results_file(os.path.join(directory, 'K4_1', 'K4_1_0.h5'))
+    make_results_file(os.path.join(directory, 'K4_1', 'K4_1_2.h5'))
+    os.makedirs(os.path.join(directory, 'notasession'))
+    return layout
+
+def make_config(directory):
+    config = cfg.Config()
+    config.set('filesystem', 'resultsrepo', directory)
+    return config
+
+def test_catalog():
+    tmp = tempfile.mkdtemp()
+    try:
+        layout = make_results_repo(tmp)
+        config = make_config(tmp)
+        c = catalog.get_catalog(config)
+        assert os.path.exists(os.path.join(tmp, 'catalog.json'))
+        
+        assert session.get_sessions(config) == sorted(session.slow_get_sessions(config))
+        assert session.get_sessions(config) == sorted(layout.keys())
+        valid = session.get_valid_sessions(config)
+        assert valid == ['K4_1']
+        assert session.get_invalid_sessions(config) == ['L3_2', 'L3_3', 'M1_1', 'fake0_1']
+        for name in layout.keys():
+            assert session.check_session_validity(config, name) == \
+                    session.slow_check_session_validity(config, name)
+            sessionConfig = make_config(tmp)
+            sessionConfig.set_session(name)
+            assert c.get_epochs(name) == session.get_epochs(sessionConfig)
+            assert session.get_n_epochs(name, config) == len(layout[name])
+        assert c.get_epochs('K4_1') == ['0_100', '10_20', '200_300']
+        assert summary.get_summary_filenames(config) == \
+                [os.path.join(tmp, 'K4_1', 'K4_1_%i.h5' % i) for i in [0, 2]]
+        
+        # a new process loads the saved catalog
+        loaded = catalog.Catalog(tmp, os.path.join(tmp, 'catalog.json'))
+        assert loaded.sessions == c.sessions
+    finally:
+        catalog.CATALOGS.clear()
+        shutil.rmtree(tmp)
+
+def test_epochs_outputprefix():
+    tmp = tempfile.mkdtemp()
+    try:
+        layout = make_results_repo(os.path.join(tmp, 'results'))
+        # session output outside of the results repository
+        outputDir = os.path.join(tmp, 'output', 'K4_1')
+        for epoch in ['5_10', '0_5']:
+            os.makedirs(os.path.join(outputDir, epoch))
+            make_results_file(os.path.join(outputDir, epoch, 'K4_1.h5'))
+        config = make_config(os.path.join(tmp, 'results'))
+        config.set('session', 'outputprefix', outputDir)
+        config.set_session('K4_1')
+        assert session.get_epochs(config) == ['0_5', '5_10']
+        assert session.get_n_epochs('K4_1', config) == 2
+        assert session.get_epoch_dir(config, 1) == os.path.join(outputDir, '5_10')
+        
+        # other sessions (and output in the repository) use the catalog
+        assert session.get_n_epochs('L3_2', config) == len(layout['L3_2'])
+        config = make_config(os.path.join(tmp, 'results'))
+        config.set_session('K4_1')
+        assert session.get_epochs(config) == ['0_100', '10_20', '200_300']
+        assert session.get_epochs(config) == session.slow_get_epochs(config)
+    finally:
+        catalog.CATALOGS.clear()
+        shutil.rmtree(tmp)
+
+def test_catalog_refresh():
+    tmp = tempfile.mkdtemp()
+    readFileInfo = catalog.read_file_info
+    calls = []
+    def counting_read_file_info(filename, st, readVersion):
+        calls.append(filename)
+        return readFileInfo(filename, st, readVersion)
+    catalog.read_file_info = counting_read_file_info
+    try:
+        make_results_repo(tmp)
+        config = make_config(tmp)
+        c = catalog.get_catalog(config)
+        n = len(calls)
+        assert n == 9
+        
+        # nothing changed
+        catalog.get_catalog(config)
+        assert len(calls) == n
+        
+        # only changed files are read
+        filename = os.path.join(tmp, 'L3_2', '100_200', 'L3_2.h5')
+        make_results_file(filename)
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 10))
+        catalog.get_catalog(config)
+        assert calls[n:] == [filename]
+        assert session.check_session_validity(config, 'L3_2')
+        
+        # new epochs, removed files and removed sessions are seen immediately
+        os.makedirs(os.path.join(tmp, 'M1_1', '0_100'))
+        make_results_file(os.path.join(tmp, 'M1_1', '0_100', 'M1_1.h5'))
+        os.remove(os.path.join(tmp, 'K4_1', 'K4_1_2.h5'))
+        shutil.rmtree(os.path.join(tmp, 'L3_3'))
+        assert session.get_n_epochs('M1_1', config) == 1
+        assert len(calls) == n + 2
+        assert session.get_valid_sessions(config) == ['K4_1', 'L3_2', 'M1_1']
+        assert summary.get_summary_filenames(config) == [os.path.join(tmp, 'K4_1', 'K4_1_0.h5')]
+        assert catalog.Catalog(tmp, c.filename).sessions == c.sessions
+    finally:
+        catalog.read_file_info = readFileInfo
+        catalog.CATALOGS.clear()
+        shutil.rmtree(tmp)
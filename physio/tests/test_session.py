@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile
+
+import numpy as np
+import tables
+
+from ..h5 import combine
+from ..h5.events import add_events_file
+from ..h5.tests.test_events import Codec, Event
+from ..h5.tests.test_combine import make_channel_files
+from .. import clock
+from .. import session
+from ..spikes import stats
+
+def make_session_file(directory, nchannels = 2, nspikes = 1000):
+    """
+    Make a synthetic results file (channels and time matches)
+    """
+    filenames = make_channel_files(directory, nchannels, nspikes)
+    filename = os.path.join(directory, 'session.h5')
+    combine.combine(filenames, filename)
+    f = tables.openFile(filename, 'a')
+    f.createArray('/', 'TimeMatches', np.array([[0., 0.], [1000., 1000.]]))
+    f.root._v_attrs.EPOCH_START_AUDIO = 0.
+    f.root._v_attrs.EPOCH_END_AUDIO = 1000.
+    f.close()
+    return filename
+
+def test_spike_times_index():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_session_file(tmp)
+        # older files without an index use the table queries
+        noIndexFilename = os.path.join(tmp, 'noindex.h5')
+        shutil.copy(filename, noIndexFilename)
+        f = tables.openFile(noIndexFilename, 'a')
+        f.removeNode('/ClusterIndex', recursive = True)
+        f.close()
+        
+        s = session.Session(filename)
+        ns = session.Session(noIndexFilename)
+        assert s.has_cluster_index(1) and not ns.has_cluster_index(1)
+        for ch in [1, 2]:
+            for clu in [0, 2, 5]:
+                for timeRange in [None, (0.5, 5.), (0., 0.)]:
+                    st = s.get_spike_times(ch, clu, timeRange)
+                    assert np.all(st == ns.get_spike_times(ch, clu, timeRange))
+                    assert np.all(st == s.slow_get_spike_times(ch, clu, timeRange))
+                    sw = s.get_spike_waveforms(ch, clu, timeRange)
+                    nw = ns.get_spike_waveforms(ch, clu, timeRange)
+                    assert len(sw) == len(nw) == len(st)
+                    assert np.all(sw == nw)
+        s.close()
+        ns.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_channel_spikes():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_session_file(tmp)
+        s = session.Session(filename)
+        for ch in [1, 2]:
+            spikes = s.get_channel_spikes(ch)
+            assert spikes is s.get_channel_spikes(ch)
+            assert spikes.times.dtype == np.int64
+            assert spikes.get_n_clusters() == s.get_n_clusters(ch)
+            for clu in [-1, 0, 2, 5]:
+                for timeRange in [None, (0.5, 5.), (0., 0.)]:
+                    st = spikes.get_spike_times(clu, timeRange)
+                    assert np.all(st == s.slow_get_spike_times(ch, clu, timeRange))
+                    sw = spikes.get_spike_waveforms(clu, timeRange)
+                    assert len(sw) == len(st)
+                    if len(sw):
+                        assert np.all(sw == s.slow_get_spike_waveforms(ch, clu, timeRange))
+                        # slices are views of the channel arrays
+                        assert sw.base is spikes.waves
+        nbytes = s.get_channel_spikes(1).nbytes
+        s.close()
+        
+        # only channels that fit in the budget are kept
+        s = session.Session(filename, channel_cache_bytes = int(nbytes * 1.5))
+        first = s.get_channel_spikes(1)
+        s.get_channel_spikes(2)
+        assert s._channel_cache.keys() == [2]
+        assert s.get_channel_spikes(1) is not first
+        s.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_spike_waveforms():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_session_file(tmp)
+        noIndexFilename = os.path.join(tmp, 'noindex.h5')
+        shutil.copy(filename, noIndexFilename)
+        f = tables.openFile(noIndexFilename, 'a')
+        f.removeNode('/ClusterIndex', recursive = True)
+        f.close()
+        
+        for fn in [filename, noIndexFilename]:
+            s = session.Session(fn)
+            for clu in [0, 2, 5]:
+                for timeRange in [None, (0.5, 5.), (0., 0.)]:
+                    slow = s.slow_get_spike_waveforms(1, clu, timeRange)
+                    waves = s.get_spike_waveforms(1, clu, timeRange, blockSize = 7)
+                    assert waves.dtype == np.float32
+                    assert waves.flags.c_contiguous
+                    assert waves.shape == (len(slow), 40)
+                    blocks = list(s.iter_spike_waveforms(1, clu, timeRange, blockSize = 100))
+                    assert all([len(b) <= 100 for b in blocks])
+                    if len(slow) == 0:
+                        assert len(blocks) == 0
+                        continue
+                    assert np.all(waves == slow.astype(np.float32))
+                    assert np.all(np.vstack(blocks) == waves)
+                    
+                    mean, std, snrs = stats.waveforms_stats(blocks)
+                    assert np.allclose(mean, np.mean(waves, 0), atol = 1e-5)
+                    assert np.allclose(std, np.std(waves, 0), atol = 1e-5)
+                    assert np.allclose(snrs, stats.waveforms_snr_ptp(waves), atol = 1e-5)
+            s.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_cluster_counts():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_session_file(tmp)
+        # older files without counts count the table
+        oldFilename = os.path.join(tmp, 'old.h5')
+        shutil.copy(filename, oldFilename)
+        f = tables.openFile(oldFilename, 'a')
+        f.removeNode('/ClusterIndex', recursive = True)
+        for ch in [1, 2]:
+            del f.getNode('/Channels/ch%i' % ch).attrs.NCLUSTERS
+        f.close()
+        
+        s = session.Session(filename)
+        old = session.Session(oldFilename)
+        for ch in [1, 2]:
+            clus = s._file.getNode('/Channels/ch%i' % ch).col('clu')
+            assert s.get_n_clusters(ch) == old.get_n_clusters(ch) == s.slow_get_n_clusters(ch)
+            counts = s.get_cluster_spike_counts(ch)
+            assert len(counts) == s.get_n_clusters(ch)
+            assert np.all(counts == old.get_cluster_spike_counts(ch))
+            assert np.all(counts == [np.sum(clus == i) for i in xrange(len(counts))])
+        s.close()
+        old.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def make_trials_session_file(directory, ntrials = 200):
+    """
+    Make a synthetic results file with image trials, distractor times and failures
+    """
+    filename = make_session_file(directory, 1, 100)
+    eventsFilename = os.path.join(directory, 'events.h5')
+    names = ['#stimDisplayUpdate', 'Distractor_Time', 'failure', \
+            'gaze_h', 'gaze_v', 'pupil_radius', 'cobra_timestamp']
+    events = [(1, 1000, '500')] # codes, times (in microseconds), values
+    for t in xrange(10000, (ntrials + 2) * 1000000, 50000):
+        h = np.random.randn() * (5. if np.random.rand() < 0.05 else 0.5)
+        events += [(3, t, str(h)), (4, t, str(np.random.randn())), (5, t, '1.0'), (6, t, str(t))]
+    for i in xrange(ntrials):
+        t = (i + 1) * 1000000
+        if i == ntrials / 2:
+            events.append((1, t - 1000, '300'))
+        events.append((0, t, str([{'type': 'image', 'name': 's%i' % (i % 5), 'pos_x': float(i % 3)}, \
+                {'name': 'pixel clock', 'bit_code': i % 16}])))
+        if np.random.rand() < 0.3:
+            events.append((2, t + np.random.randint(1, 600000), '1'))
+    f = tables.openFile(eventsFilename, 'w')
+    g = f.createGroup('/', 'S1_1', '')
+    codec = f.createTable(g, 'codec', Codec)
+    codec.append(list(enumerate(names)))
+    events.sort(key = lambda e: e[1])
+    evs = f.createTable(g, 'events', Event)
+    evs.append([(c, t, i) for (i, (c, t, v)) in enumerate(events)])
+    values = f.createVLArray(g, 'values', tables.VLStringAtom())
+    for (c, t, v) in events:
+        values.append(v)
+    f.close()
+    add_events_file(eventsFilename, filename)
+    return filename
+
+def test_trial_table():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_trials_session_file(tmp)
+        s = session.Session(filename)
+        trials, stims = s.get_trial_table()
+        assert trials is s.get_trial_table()[0]
+        # dict arguments are cached
+        matched = s.get_stimuli({'name': 's1'})
+        assert matched is s.get_stimuli({'name': 's1'})
+        assert s.get_cache_stats()['get_stimuli']['hits'] >= 1
+        assert len(trials) == len(stims) == 200
+        assert np.all(trials['duration'][:100] == 0.5) and np.all(trials['duration'][100:] == 0.3)
+        assert 0 < np.sum(trials['failed']) < 200
+        for matchDict in [None, {'name': 's1'}, {'name': 's2', 'pos_x': 1.}, {'name': 'none'}]:
+            for timeRange in [None, (10., 100.)]:
+                result = s.get_trials(matchDict, timeRange)
+                slow = s.slow_get_trials(matchDict, timeRange)
+                for (r, sl) in zip(result, slow):
+                    assert len(r) == len(sl)
+                    assert all([a == b for (a, b) in zip(r, sl)])
+        s.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_gaze_filtered_trials():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = make_trials_session_file(tmp)
+        s = session.Session(filename)
+        for (stdThreshold, devThreshold) in [(None, None), (1., None), (None, 0.3), (1.5, 0.5)]:
+            for matchDict in [None, {'name': 's1'}]:
+                result = s.get_gaze_filtered_trials(matchDict, None, stdThreshold, devThreshold)
+                slow = s.slow_get_gaze_filtered_trials(matchDict, None, stdThreshold, devThreshold)
+                for (r, sl) in zip(result, slow):
+                    assert len(r) == len(sl)
+                    assert all([a == b for (a, b) in zip(r, sl)])
+        assert 0 < len(s.get_gaze_filtered_trials(None, None, 1.5, 0.5)[2]) < 200
+        s.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_timebase_default():
+    np.random.seed(0)
+    tmp = tempfile.mkdtemp()
+    try:
+        oldFilename = make_session_file(tmp, 1, 100)
+        # offsets that drift (so interpolation differs from the next match offset)
+        au = np.arange(1., 100., 5.)
+        matches = np.vstack((au, au - 0.5 - au * 1e-4 + np.random.rand(len(au)) * 1e-3)).T
+        f = tables.openFile(oldFilename, 'a')
+        f.removeNode('/TimeMatches')
+        f.createArray('/', 'TimeMatches', matches)
+        f.close()
+        newFilename = os.path.join(tmp, 'new.h5')
+        shutil.copy(oldFilename, newFilename)
+        f = tables.openFile(newFilename, 'a')
+        f.createArray('/', 'TimeSegments', \
+                clock.timebase.TimeBase(matches, interpolate = True).segments)
+        f.close()
+        
+        times = np.linspace(0., 100., 333)
+        old = session.Session(oldFilename)
+        new = session.Session(newFilename)
+        assert np.all(old._timebase.audio_to_mworks(times) == new._timebase.audio_to_mworks(times))
+        assert np.all(old._timebase.mworks_to_audio(times) == new._timebase.mworks_to_audio(times))
+        old.close()
+        new.close()
+        
+        # interpolation is opt-in (and uses the stored segments when present)
+        old = session.Session(oldFilename, interpolate = True)
+        new = session.Session(newFilename, interpolate = True)
+        default = session.Session(newFilename)
+        assert np.allclose(old._timebase.audio_to_mworks(times), new._timebase.audio_to_mworks(times))
+        assert not np.allclose(default._timebase.audio_to_mworks(times), new._timebase.audio_to_mworks(times))
+        old.close()
+        new.close()
+        default.close()
+    finally:
+        shutil.rmtree(tmp)
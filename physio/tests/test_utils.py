@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import hashlib, os, shutil, tempfile
+
+import numpy as np
+
+from .. import utils
+
+def test_canonical_key():
+    a = {'name': 'a', 'pos': [1, 2], 'size': {'x': 1., 'y': 2.}}
+    b = {'size': {'y': 2., 'x': 1.}, 'pos': [1, 2], 'name': 'a'}
+    assert utils.canonical_key(a) == utils.canonical_key(b)
+    assert hash(utils.canonical_key(a)) == hash(utils.canonical_key(b))
+    assert utils.canonical_key(a) != utils.canonical_key(dict(a, name='b'))
+    assert utils.canonical_key([1, 2]) != utils.canonical_key((1, 2))
+    x = np.arange(10.)
+    assert utils.canonical_key(x) == utils.canonical_key(x.copy())
+    assert utils.canonical_key(x) != utils.canonical_key(x.astype(int))
+    assert utils.canonical_key(x) != utils.canonical_key(x.reshape((2, 5)))
+    assert utils.canonical_key(x[::2]) == utils.canonical_key(np.arange(0., 10., 2.))
+    assert utils.canonical_key(np.float64(1.5)) == 1.5
+    try:
+        utils.canonical_key(object.__new__(type('Unhashable', (object,), {'__hash__': None})))
+        raise AssertionError("canonical_key did not fail for an unhashable object")
+    except TypeError:
+        pass
+
+def test_lru_cache():
+    cache = utils.LRUCache(maxEntries = 3)
+    for i in xrange(4):
+        cache.put(i, i)
+    assert (not 0 in cache) and (1 in cache)
+    assert cache.get(1) == (True, 1) # 1 is now most recent
+    cache.put(4, 4)
+    assert (not 2 in cache) and (1 in cache)
+    assert cache.get(2) == (False, None)
+    assert cache.get_stats() == dict(hits=1, misses=1, evictions=2, entries=3, bytes=0)
+    
+    cache = utils.LRUCache(maxEntries = None, maxBytes = 1000)
+    cache.put('a', np.zeros(50)) # 400 bytes
+    cache.put('b', np.zeros(50))
+    cache.put('c', np.zeros(50))
+    assert cache.nbytes == 800 and len(cache) == 2 and (not 'a' in cache)
+    cache.put('d', np.zeros(200)) # too large
+    assert len(cache) == 2 and (not 'd' in cache)
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+    
+    @utils.lru_memoize(maxEntries = 2)
+    def get(self, matchDict = None, values = None):
+        """Get"""
+        self.calls += 1
+        return self.calls
+
+def test_lru_memoize():
+    c = Counter()
+    assert c.get({'a': 1, 'b': [1, 2]}) == 1
+    assert c.get({'b': [1, 2], 'a': 1}) == 1
+    assert c.get(values = np.arange(3)) == 2
+    assert c.get(values = np.arange(3)) == 2
+    assert c.get({'a': 2}) == 3 # evicts {'a': 1, ...}
+    assert c.get({'a': 1, 'b': [1, 2]}) == 4
+    stats = utils.get_cache_stats(c)['get']
+    assert stats['hits'] == 2 and stats['misses'] == 4 and stats['evictions'] == 2
+    assert stats['entries'] == 2
+    # caches are per instance
+    assert Counter().get({'a': 2}) == 1
+    assert Counter.get.__doc__ == 'Get'
+    utils.clear_caches(c)
+    assert utils.get_cache_stats(c)['get']['entries'] == 0
+
+def test_file_digest():
+    tmp = tempfile.mkdtemp()
+    hashFile = utils.hash_file
+    calls = []
+    def counting_hash_file(*args, **kwargs):
+        calls.append(args)
+        return hashFile(*args, **kwargs)
+    utils.hash_file = counting_hash_file
+    try:
+        filename = os.path.join(tmp, 'data.h5')
+        data = np.random.bytes(3 * 1024 ** 2 + 17)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        md5 = hashlib.md5(data).hexdigest()
+        assert hashFile(filename, blockSize = 1000) == md5
+        assert hashFile(filename, useMmap = True, blockSize = 1000) == md5
+        assert hashFile(filename, 'sha1') == hashlib.sha1(data).hexdigest()
+        
+        assert utils.file_digest(filename) == md5
+        assert os.path.exists(utils.get_digests_filename(filename))
+        assert utils.file_digest(filename) == md5
+        # a new process reads the sidecar
+        utils.DIGESTS.clear()
+        assert utils.file_digest(filename) == md5
+        assert len(calls) == 1
+        
+        # changed files are hashed again
+        data = data[::-1]
+        with open(filename, 'wb') as f:
+            f.write(data)
+        st = os.stat(filename)
+        os.utime(filename, (st.st_atime, st.st_mtime + 10))
+        assert utils.file_digest(filename) == hashlib.md5(data).hexdigest()
+        assert len(calls) == 2
+        assert utils.file_digest(filename, cache = False) == hashlib.md5(data).hexdigest()
+        assert len(calls) == 3
+        
+        fast = utils.file_digest(filename, fast = True)
+        assert fast.split(':')[0] == ('xxh64' if utils.xxhash is not None else 'md5')
+        assert fast == utils.file_digest(filename, fast = True)
+        assert len(calls) == 3
+        # both digests are kept in the sidecar
+        utils.DIGESTS.clear()
+        assert utils.file_digest(filename) == hashlib.md5(data).hexdigest()
+        assert len(calls) == 3
+    finally:
+        utils.hash_file = hashFile
+        utils.DIGESTS.clear()
+        shutil.rmtree(tmp)
@@ -1,3 +1,4 @@
 import ranges
+import windows
 
-__all__ = ['ranges']
+__all__ = ['ranges', 'windows']
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+import physio
+
+def test_window_stats():
+    np.random.seed(0)
+    times = np.random.rand(5000) * 100.
+    values = np.random.randn(5000) * 3. + 1000.
+    stats = physio.timeseries.windows.WindowStats(times, values)
+    starts = np.hstack((np.random.rand(200) * 100., [-10., 50., 200.]))
+    ends = np.hstack((starts[:200] + np.random.rand(200) * 5., [-5., 50., 300.]))
+    means, stds, counts = stats.get_stats(starts, ends)
+    for (s, e, m, sd, n) in zip(starts, ends, means, stds, counts):
+        inWindow = values[(times > s) & (times < e)]
+        assert n == len(inWindow)
+        if n == 0:
+            assert np.isnan(m) and np.isnan(sd)
+            continue
+        assert np.allclose(m, np.mean(inWindow))
+        assert np.allclose(sd, np.std(inWindow))
+
+    # empty windows are kept without comparing their nan stats
+    with np.errstate(invalid='raise'):
+        keep = stats.cull(starts, ends, 3., 0.5)
+    median = np.median(values)
+    for (s, e, k) in zip(starts, ends, keep):
+        inWindow = values[(times > s) & (times < e)]
+        if len(inWindow) == 0:
+            assert k
+            continue
+        assert k == ((np.std(inWindow) <= 3.) and (abs(np.mean(inWindow) - median) <= 0.5))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+
+class WindowStats(object):
+    """
+    Mean and standard deviation of a time series over many time windows
+
+    Cumulative sums and sums of squares of the values are computed once
+    so the statistics of any batch of windows take two searchsorted calls
+    (instead of one mask over the whole series per window).
+    """
+    def __init__(self, times, values):
+        """
+        Parameters
+        ----------
+        times : 1d array
+            Sample times
+        values : 1d array
+            Sample values
+        """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        assert times.shape == values.shape, \
+                "times%s and values%s must be the same shape" % \
+                (times.shape, values.shape)
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='mergesort')
+            times, values = times[order], values[order]
+        self.times = times
+        self.values = values
+        # values are centered to reduce round off in the sums of squares
+        self.reference = np.mean(values) if len(values) else 0.
+        centered = values - self.reference
+        self.sums = np.hstack(([0.], np.cumsum(centered)))
+        self.squares = np.hstack(([0.], np.cumsum(centered ** 2)))
+
+    def get_bounds(self, starts, ends):
+        """
+        Find the samples in each window (start, end) (exclusive)
+
+        Returns
+        -------
+        lo : 1d array
+        hi : 1d array
+            Samples in window i are times[lo[i]:hi[i]]
+        """
+        starts = np.atleast_1d(np.asarray(starts, dtype=np.float64))
+        ends = np.atleast_1d(np.asarray(ends, dtype=np.float64))
+        lo = np.searchsorted(self.times, starts, side='right')
+        hi = np.maximum(lo, np.searchsorted(self.times, ends, side='left'))
+        return lo, hi
+
+    def get_stats(self, starts, ends):
+        """
+        Parameters
+        ----------
+        starts : 1d array
+            Start times of windows
+        ends : 1d array
+            End times of windows
+
+        Returns
+        -------
+        means : 1d array
+            Mean of values within each window (nan if the window is empty)
+        stds : 1d array
+            Standard deviation of values within each window (nan if the window is empty)
+        counts : 1d array
+            Number of values within each window
+        """
+        lo, hi = self.get_bounds(starts, ends)
+        counts = hi - lo
+        n = np.where(counts > 0, counts, 1).astype(np.float64)
+        sums = self.sums[hi] - self.sums[lo]
+        squares = self.squares[hi] - self.squares[lo]
+        means = sums / n
+        stds = np.sqrt(np.maximum(squares / n - means ** 2, 0.))
+        means = means + self.reference
+        means[counts == 0] = np.nan
+        stds[counts == 0] = np.nan
+        return means, stds, counts
+
+    def cull(self, starts, ends, stdThreshold=None, deviationThreshold=None,
+                reference=None):
+        """
+        Find windows with stable values
+
+        Parameters
+        ----------
+        starts, ends : 1d arrays
+            Window start and end times
+        stdThreshold : float
+            Windows with a standard deviation > stdThreshold are culled
+        deviationThreshold : float
+            Windows with a mean that deviates from reference by > deviationThreshold are culled
+        reference : float
+            Reference value (default = median of all values)
+
+        Returns
+        -------
+        keep : 1d array of bools
+            True for windows that were not culled (empty windows are kept)
+        """
+        means, stds, counts = self.get_stats(starts, ends)
+        keep = np.ones(len(means), dtype=bool)
+        # empty windows (with nan stats) are kept
+        full = np.nonzero(counts > 0)[0]
+        if stdThreshold is not None:
+            keep[full[stds[full] > stdThreshold]] = False
+        if deviationThreshold is not None:
+            if reference is None:
+                reference = np.median(self.values)
+            keep[full[np.abs(means[full] - reference) > deviationThreshold]] = False
+        return keep
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
-import glob, logging, os, re, sys, time
+import collections, glob, hashlib, json, logging, mmap, os, re, sys, time
 from contextlib import contextmanager
 
 import numpy as np
 import tables
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 class H5Maker:
     """
     Accepts either a file or string (filename) and allows with(file/filename) for h5 files
@@ -80,6 +85,170 @@ def regex_glob(directory, regex):
             groups.append(gs)
     return outFiles, groups
 
+def file_fingerprint(filename, blockSize = 1048576):
+    """
+    Quick fingerprint of a file's contents, used to detect changed input files
+    
+    Parameters
+    ----------
+    filename : string
+        File to fingerprint
+    blockSize : int
+        Number of bytes read (and hashed) from the beginning and end of the file
+    
+    Returns
+    -------
+    fingerprint : string
+        Hex digest of the file size, modification time and the hashed bytes
+    """
+    st = os.stat(filename)
+    h = hashlib.md5()
+    h.update('%i %i' % (st.st_size, int(st.st_mtime)))
+    with open(filename, 'rb') as f:
+        h.update(f.read(blockSize))
+        if st.st_size > blockSize:
+            f.seek(max(blockSize, st.st_size - blockSize))
+            h.update(f.read(blockSize))
+    return h.hexdigest()
+
+# block size used to hash whole files (see hash_file)
+DIGEST_BLOCK_SIZE = 16 * 1024 ** 2
+
+# digests computed in this process keyed by (path, size, mtime, algorithm)
+DIGESTS = {}
+
+def new_hash(algorithm):
+    """
+    Make a hash object for algorithm (any hashlib algorithm or xxh64 if xxhash is installed)
+    """
+    if algorithm == 'xxh64':
+        if xxhash is None:
+            raise ValueError("xxh64 requires the xxhash module")
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+def hash_file(filename, algorithm = 'md5', blockSize = DIGEST_BLOCK_SIZE, useMmap = False):
+    """
+    Hash the contents of a file in blocks (the result matches the md5sum utility for md5)
+    
+    Parameters
+    ----------
+    filename : string
+        File to hash
+    algorithm : string
+        Hash algorithm (see new_hash)
+    blockSize : int
+        Number of bytes hashed at a time
+    useMmap : bool
+        Memory map the file instead of reading it
+    
+    Returns
+    -------
+    digest : string
+        Hex digest of the file contents
+    """
+    h = new_hash(algorithm)
+    with open(filename, 'rb') as f:
+        if useMmap and (os.fstat(f.fileno()).st_size > 0):
+            m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                for start in xrange(0, len(m), blockSize):
+                    h.update(m[start:start + blockSize])
+            finally:
+                m.close()
+        else:
+            block = f.read(blockSize)
+            while block:
+                h.update(block)
+                block = f.read(blockSize)
+    return h.hexdigest()
+
+def partial_hash_file(filename, algorithm = 'md5', blockSize = 1048576):
+    """
+    Hash the size and the first and last blockSize bytes of a file
+    (like file_fingerprint but independent of the modification time)
+    """
+    size = os.stat(filename).st_size
+    h = new_hash(algorithm)
+    h.update('%i' % size)
+    with open(filename, 'rb') as f:
+        h.update(f.read(blockSize))
+        if size > blockSize:
+            f.seek(max(blockSize, size - blockSize))
+            h.update(f.read(blockSize))
+    return h.hexdigest()
+
+def get_digests_filename(filename):
+    """
+    Sidecar file (hidden, in the same directory) that caches the digests of filename
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, '.%s.digests' % name)
+
+def file_digest(filename, algorithm = 'md5', fast = False, cache = True, useMmap = False):
+    """
+    Digest of a file, cached (in process and in a sidecar file, see get_digests_filename)
+    until the file size or modification time changes
+    
+    Parameters
+    ----------
+    filename : string
+        File to hash
+    algorithm : string
+        Hash algorithm (see new_hash)
+    fast : bool
+        Only hash the size, beginning and end of the file (see partial_hash_file)
+        using xxh64 if xxhash is installed
+    cache : bool
+        Read and write cached digests
+    useMmap : bool
+        Memory map the file when hashing (see hash_file)
+    
+    Returns
+    -------
+    digest : string
+        Hex digest. Fast digests are prefixed with the algorithm (e.g. xxh64:<digest>)
+    """
+    if fast and (xxhash is not None):
+        algorithm = 'xxh64'
+    key = ('partial-%s' % algorithm) if fast else algorithm
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    cacheKey = (path, st.st_size, st.st_mtime, key)
+    if cache and (cacheKey in DIGESTS):
+        return DIGESTS[cacheKey]
+    
+    digestsFilename = get_digests_filename(path)
+    sidecar = None
+    if cache and os.path.exists(digestsFilename):
+        try:
+            with open(digestsFilename, 'r') as f:
+                sidecar = json.load(f)
+        except (IOError, ValueError) as E:
+            logging.warning("Failed to read digests %s: %s" % (digestsFilename, E))
+    if (sidecar is None) or (sidecar.get('size', None) != st.st_size) or \
+            (sidecar.get('mtime', None) != st.st_mtime):
+        sidecar = dict(size = st.st_size, mtime = st.st_mtime, digests = {})
+    
+    if not (cache and (key in sidecar['digests'])):
+        if fast:
+            digest = '%s:%s' % (algorithm, partial_hash_file(path, algorithm))
+        else:
+            digest = hash_file(path, algorithm, useMmap = useMmap)
+        if not cache:
+            return digest
+        sidecar['digests'][key] = digest
+        tmpFilename = '%s.%i.tmp' % (digestsFilename, os.getpid())
+        try:
+            with open(tmpFilename, 'w') as f:
+                json.dump(sidecar, f)
+            os.rename(tmpFilename, digestsFilename)
+        except (IOError, OSError) as E:
+            logging.debug("Failed to write digests %s: %s" % (digestsFilename, E))
+    digest = str(sidecar['digests'][key])
+    DIGESTS[cacheKey] = digest
+    return digest
+
 def get_git_commit_id():
     path = os.path.abspath(sys.argv[0]) # path of script
     cmd = "git log -n 1 --pretty=format:%%H %s" % path
@@ -128,6 +297,192 @@ class memoize(object):
             res = self.func(*args, **kw)
         return res
 
+def canonical_key(obj):
+    """
+    Convert an object (possibly containing dicts, lists or arrays) to a hashable key
+
+    Equal dicts give equal keys regardless of insertion order and arrays are
+    keyed by dtype, shape and a digest of their contents
+
+    Parameters
+    ----------
+    obj : object
+        Object to convert
+
+    Returns
+    -------
+    key : hashable
+        Stable key for obj
+    """
+    if isinstance(obj, dict):
+        return ('__dict__', tuple(sorted([(canonical_key(k), canonical_key(v)) \
+                for (k, v) in obj.iteritems()])))
+    if isinstance(obj, (list, tuple)):
+        return ('__%s__' % type(obj).__name__, tuple([canonical_key(i) for i in obj]))
+    if isinstance(obj, (set, frozenset)):
+        return ('__set__', tuple(sorted([canonical_key(i) for i in obj])))
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return ('__ndarray__', obj.shape, canonical_key(obj.tolist()))
+        return ('__ndarray__', obj.dtype.str, obj.shape, \
+                hashlib.md5(np.ascontiguousarray(obj).tostring()).hexdigest())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    hash(obj) # raises TypeError for other unhashable objects
+    return obj
+
+def estimate_bytes(obj):
+    """
+    Estimate the memory used by an object (arrays and containers are counted recursively)
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return obj.nbytes + sum([estimate_bytes(i) for i in obj.flat])
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum([estimate_bytes(k) + estimate_bytes(v) \
+                for (k, v) in obj.iteritems()])
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sys.getsizeof(obj) + sum([estimate_bytes(i) for i in obj])
+    try:
+        return sys.getsizeof(obj)
+    except TypeError:
+        return 0
+
+class LRUCache(object):
+    """
+    Least recently used cache bounded by number of entries and estimated bytes
+
+    Counters (hits, misses, evictions) and the current size are kept for profiling
+    """
+    def __init__(self, maxEntries=128, maxBytes=None):
+        """
+        Parameters
+        ----------
+        maxEntries : int
+            Maximum number of entries (None = unbounded)
+        maxBytes : int
+            Maximum total estimated bytes (see estimate_bytes) of entries (None = unbounded)
+        """
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict() # key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        found : bool
+            True if key was in the cache
+        value : object
+            Cached value (or None if not found)
+        """
+        if key in self.entries:
+            value, nbytes = self.entries.pop(key)
+            self.entries[key] = (value, nbytes)
+            self.hits += 1
+            return True, value
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        nbytes = estimate_bytes(value) if self.maxBytes is not None else 0
+        if (self.maxBytes is not None) and (nbytes > self.maxBytes):
+            return # too large to cache
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while ((self.maxEntries is not None) and (len(self.entries) > self.maxEntries)) or \
+                ((self.maxBytes is not None) and (self.nbytes > self.maxBytes)):
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def get_stats(self):
+        """
+        Returns
+        -------
+        stats : dict
+            hits, misses, evictions, entries and (estimated) bytes
+        """
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, \
+                entries=len(self.entries), bytes=self.nbytes)
+
+class lru_memoize(object):
+    """cache the return values of a method in a per-instance LRUCache
+
+    Unlike memoize, arguments may be unhashable (dicts, lists and arrays are
+    converted with canonical_key) and the cache is bounded:
+    class Obj(object):
+        @lru_memoize(maxEntries=10, maxBytes=1024 ** 2)
+        def get(self, matchDict=None):
+            ...
+    Obj().get({'name': 'a'}) # computed
+    Obj().get({'name': 'a'}) # cached on that instance
+
+    Use get_cache_stats(obj) to see the counters of all caches of an instance.
+    """
+    def __init__(self, maxEntries=128, maxBytes=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+    def __call__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.__name__ = func.__name__
+        return self
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.func
+        return partial(self.call, obj)
+    def get_cache(self, obj):
+        caches = obj.__dict__.setdefault('_lru_caches', {})
+        if not (self.func.__name__ in caches):
+            caches[self.func.__name__] = LRUCache(self.maxEntries, self.maxBytes)
+        return caches[self.func.__name__]
+    def call(self, obj, *args, **kw):
+        cache = self.get_cache(obj)
+        try:
+            key = canonical_key((args, kw))
+        except TypeError:
+            logging.debug("Uncachable arguments to %s: %s %s" % \
+                    (self.func.__name__, args, kw))
+            return self.func(obj, *args, **kw)
+        found, value = cache.get(key)
+        if not found:
+            value = self.func(obj, *args, **kw)
+            cache.put(key, value)
+        return value
+
+def get_cache_stats(obj):
+    """
+    Returns
+    -------
+    stats : dict
+        Statistics (see LRUCache.get_stats) of each lru_memoize cache of obj
+    """
+    return dict([(name, cache.get_stats()) for (name, cache) \
+            in obj.__dict__.get('_lru_caches', {}).iteritems()])
+
+def clear_caches(obj):
+    """
+    Clear all lru_memoize caches of obj
+    """
+    for cache in obj.__dict__.get('_lru_caches', {}).values():
+        cache.clear()
+
 import cPickle
 
 class memoize2:
@@ -161,9 +161,10 @@ for goodSession in goodSessions:
         #for ch in [6]:
         for ch in xrange(1,33):
             location = locations[ch-1]
-            for cl in xrange(session.get_n_clusters(ch)):
+            channel_spikes = session.get_channel_spikes(ch)
+            for cl in xrange(channel_spikes.get_n_clusters()):
                 tic = time.time()
-                waves = session.get_spike_waveforms(ch, cl)
+                waves = channel_spikes.get_spike_waveforms(cl)
                 snr = physio.spikes.stats.waveforms_snr(waves, snrw)
                 meansnr = snr
                 stdsnr = np.nan
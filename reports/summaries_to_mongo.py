@@ -102,23 +102,9 @@ def clean_gaze(gaze, acc_thresh=1000, dev_thresh=30):
 
 def cull_trials_by_gaze(trials, gaze, \
         std_thresh=numpy.inf, dev_thresh=5):
-    median_h = numpy.median(gaze['h'])
-    keep = numpy.ones(len(trials)).astype(bool)
-    for (i, trial) in enumerate(trials):
-        start, end = trial['time'], trial['time'] + trial['duration']
-        trial_gaze = gaze[numpy.logical_and(gaze['time'] > start, \
-                gaze['time'] < end)]
-
-        trial_mean_h = numpy.mean(trial_gaze['h'])
-        trial_std_h = numpy.std(trial_gaze['h'])
-
-        if (trial_std_h > std_thresh):
-            keep[i] = False
-            continue
-
-        if (abs(trial_mean_h - median_h) > dev_thresh):
-            keep[i] = False
-            continue
+    stats = physio.timeseries.windows.WindowStats(gaze['time'], gaze['h'])
+    keep = stats.cull(trials['time'], trials['time'] + trials['duration'], \
+            std_thresh, dev_thresh, numpy.median(gaze['h']))
     return trials[keep]
 
 
@@ -37,15 +37,16 @@ if not (os.path.exists(session_filename)):
 logging.debug("Opening %s" % session_filename)
 session = physio.session.Session(session_filename)
 
-n_clusters = session.get_n_clusters(channel)
+channel_spikes = session.get_channel_spikes(channel)
+n_clusters = channel_spikes.get_n_clusters()
 logging.debug("Channel %i has %i clusters" % (channel, n_clusters))
 
 spike_times = []
 spike_waveforms = []
 clusters = []
 for cluster in xrange(n_clusters):
-    st = session.get_spike_times(channel, cluster)
-    sw = session.get_spike_waveforms(channel, cluster)
+    st = channel_spikes.get_spike_times(cluster)
+    sw = channel_spikes.get_spike_waveforms(cluster)
     if len(st) != len(sw):
         raise IOError("len(times)[%i] != len(waves)[%i]" % \
                 (len(st), len(sw)))
@@ -50,7 +50,7 @@ for epochNumber in epochs:
     #logging.debug("N Trials: %i" % nTrials)
 
     channels = range(1, 33)
-    nclusters = [session.get_n_clusters(ch) for ch in channels]
+    nclusters = [session.get_channel_spikes(ch).get_n_clusters() for ch in channels]
     nclusters = min(10, max(nclusters))
     clusters = range(0, nclusters)
 
@@ -67,7 +67,7 @@ for epochNumber in epochs:
     for (x, channel) in enumerate(channels):
         for (y, cluster) in enumerate(clusters):
             logging.debug("\tPlotting[%i, %i]: ch %s : cl %s" % (x, y, channel, cluster))
-            spikes = session.get_spike_times(channel, cluster)
+            spikes = session.get_channel_spikes(channel).get_spike_times(cluster)
             if len(spikes) < 2: continue
             pl.subplot(subplotsHeight, subplotsWidth, subplotsWidth * y + x + 1)
             #physio.plotting.isi.plot(spikes, options.nbins)